@@ -7,10 +7,7 @@ import logging
 
 import numpy as np
 import numexpr as ne
-import matplotlib.pyplot as plt
-from matplotlib import _cntr
-from scipy.optimize import fmin_powell
-from scipy.ndimage.interpolation import zoom as image_zoom
+# matplotlib and most of scipy are imported only where needed: they take a long time to import
 
 from pax import utils
 from pax.exceptions import CoordinateOutOfRangeException
@@ -56,6 +53,7 @@ class PatternFitter(object):
 
         # Zoom the spatial map using linear interpolation, if desired
         if zoom_factor != 1:
+            from scipy.ndimage.interpolation import zoom as image_zoom
             self.data = image_zoom(self.data, zoom=[zoom_factor] * self.dimensions + [1], order=1)
 
         # Adjust the expected patterns to the PMT's quantum efficiencies, if desired
@@ -135,6 +133,7 @@ class PatternFitter(object):
 
         # The below code is for diagnostic plots only
         if plot:
+            import matplotlib.pyplot as plt
             plt.figure()
             plt.set_cmap('viridis')
             # Make the linspaces of coordinates along each dimension
@@ -253,6 +252,7 @@ class PatternFitter(object):
         if cls is not None and n_dim == 2:
             x, y = np.mgrid[:gofs.shape[0], :gofs.shape[1]]
             # Use matplotlib _Cntr module to trace contours (without plotting)
+            from matplotlib import _cntr
             c = _cntr.Cntr(x, y, gofs)
 
             for cl in cls:
@@ -296,6 +296,7 @@ class PatternFitter(object):
                     cl_segments.append(contour_points)
 
         if plot and n_dim == 2:
+            import matplotlib.pyplot as plt
             plt.scatter(*[[r] for r in result], marker='*', s=20, color='orange', label='Grid minimum')
             for i, contour in enumerate(cl_segments):
                 if len(contour) == 0:
@@ -329,6 +330,7 @@ class PatternFitter(object):
         #    warnflag 0, OK
         #    warnflag 1, maximum functions evaluations exceeded
         #    warnflag 2, maximum iterations exceeded
+        from scipy.optimize import fmin_powell
         rv = fmin_powell(safe_compute_gof,
                          start_coordinates, direc=direc,
                          args=(areas_observed, pmt_selection, square_syst_errors, statistic),
@@ -4,6 +4,7 @@ import glob
 import logging
 import six
 import itertools
+import json
 import os
 import time
 
@@ -20,6 +21,10 @@ if six.PY2:
 else:
     import importlib
 
+# Plugin modules loaded in this process, by file path, if process caches are enabled (see enable_process_caches).
+# Otherwise every Processor loads its plugin modules afresh.
+plugin_modules = None
+
 # For diagnosing suspected memory leaks, uncomment this code
 # and similar code in process_event
 # import gc
@@ -159,9 +164,15 @@ class Processor:
                     for event_number in pc['events_to_process']:
                         yield self.input_plugin.get_single_event(event_number)
                 self.get_events = get_events
+
+                def get_event_blocks():
+                    for event in get_events():
+                        yield [event]
+                self.get_event_blocks = get_event_blocks
             else:
-                # Let the input plugin decide which events to process:
+                # Let the input plugin decide which events to process, and how to group them in blocks:
                 self.get_events = self.input_plugin.get_events
+                self.get_event_blocks = self.input_plugin.get_event_blocks
 
             self.number_of_events = min(self.number_of_events, self.stop_after)
 
@@ -180,6 +191,8 @@ class Processor:
             self.log.debug("No action plugins specified: this will be a pretty boring processing run...")
 
         self.timer = utils.Timer()
+        self.events_processed = 0   # Set by run()
+        self.run_time = 0           # Wall-clock time in msec taken by run()
 
         # Sometimes the config tells us to start running immediately (e.g. if fetching from a queue
         if pc.get('autorun', False):
@@ -212,20 +225,9 @@ class Processor:
         self.log.debug('Instantiating %s' % name)
         name_module, name_class = name.split('.')
 
-        # Find and load the module which includes the plugin
-        if six.PY2:
-            file, pathname, description = imp.find_module(name_module, self.plugin_search_paths)
-            if file is None:
-                raise InvalidConfigurationError('Plugin %s not found.' % name)
-            plugin_module = imp.load_module(name_module, file, pathname, description)
-        else:
-            # imp has been deprecated in favor of importlib.
-            # Moreover, the above code gives non-closed file warnings in py3, so although it works,
-            # we really don't want to use it.
-            spec = importlib.machinery.PathFinder.find_spec(name_module, self.plugin_search_paths)
-            if spec is None:
-                raise InvalidConfigurationError('Plugin %s not found.' % name)
-            plugin_module = spec.loader.load_module()
+        plugin_module = load_plugin_module(name_module, self.plugin_search_paths)
+        if plugin_module is None:
+            raise InvalidConfigurationError('Plugin %s not found.' % name)
 
         this_plugin_config = {}
 
@@ -271,16 +273,68 @@ class Processor:
         """Process one event with all action plugins. Returns processed event."""
         total_plugins = len(self.action_plugins)
 
+        n_pulses = n_pulses_in(event)
+        times = []
+
         for j, plugin in enumerate(self.action_plugins):
             self.log.debug("%s (step %d/%d)" % (plugin.__class__.__name__, j, total_plugins))
             event = plugin.process_event(event)
-            plugin.total_time_taken += self.timer.punch()
+            dt = self.timer.punch()
+            plugin.total_time_taken += dt
+            times.append(dt)
+            n_pulses = max(n_pulses, n_pulses_in(event))
+
+        # Record the times only now: the number of pulses is only known after e.g. the ZLE has run
+        for plugin, dt in zip(self.action_plugins, times):
+            plugin.timing.add(dt, n_pulses)
 
         # Uncomment to diagnose memory leaks
         # gc.collect()  # don't care about stuff that would be garbage collected properly
         # objgraph.show_growth(limit=5)
         return event
 
+    def process_events(self, events):
+        """Process a list of events (e.g. a block from a queue) with all action plugins.
+        Returns list of processed events.
+        Plugins with a batched hook (e.g. transform_events) get the entire list at once,
+        other plugins get the events one by one.
+        """
+        total_plugins = len(self.action_plugins)
+        n_pulses = [n_pulses_in(event) for event in events]
+        # (plugin, list of times taken per event) of the plugins run so far
+        times = []
+
+        for j, plugin in enumerate(self.action_plugins):
+            self.log.debug("%s (step %d/%d)" % (plugin.__class__.__name__, j, total_plugins))
+            if plugin.has_batched_hook():
+                n_events = len(events)
+                events = plugin.process_events(events)
+                dt = self.timer.punch()
+                plugin.total_time_taken += dt
+                # We can't tell how the time was divided over the events, so spread it evenly
+                times.append((plugin, [dt / n_events] * n_events if n_events else []))
+                if len(events) != n_events:
+                    # The plugin dropped (or added) events, and we can't tell which. Record the times so far, with
+                    # the numbers of pulses known so far, then continue with the new events.
+                    add_timing(times, n_pulses)
+                    times = []
+                    n_pulses = [n_pulses_in(event) for event in events]
+            else:
+                # Time the events one by one, so the latency histograms see the per-event times
+                result = []
+                dts = []
+                for event in events:
+                    result.append(plugin.process_event(event))
+                    dt = self.timer.punch()
+                    plugin.total_time_taken += dt
+                    dts.append(dt)
+                events = result
+                times.append((plugin, dts))
+            n_pulses = [max(n, n_pulses_in(event)) for n, event in zip(n_pulses, events)]
+
+        add_timing(times, n_pulses)
+        return events
+
     def run(self, clean_shutdown=True):
         """Run the processor over all events, then shuts down the plugins (unless clean_shutdown=False)
 
@@ -299,38 +353,53 @@ class Processor:
             raise RuntimeError("Attempt to run a Processor twice!")
 
         i = 0  # in case loop does not run
+        run_start = utils.perf_counter()
         self.timer.punch()
         if self.config['pax'].get('show_progress_bar', True):
-            wrapper = tqdm
+            progress_bar = tqdm(desc='Event', total=self.number_of_events)
         else:
-            def wrapper(x, **kwargs):
-                return x
-        for i, event in enumerate(wrapper(self.get_events(),
-                                          desc='Event',
-                                          total=self.number_of_events)):
-            self.input_plugin.total_time_taken += self.timer.punch()
+            progress_bar = None
+        for events in self.get_event_blocks():
+            dt = self.timer.punch()
+            self.input_plugin.total_time_taken += dt
+            if i + len(events) > self.stop_after:
+                events = events[:max(0, int(self.stop_after - i))]
+            if len(events):
+                for event in events:
+                    self.input_plugin.timing.add(dt / len(events), n_pulses_in(event))
+                self.process_events(events)
+                i += len(events)
+                self.log.debug("Events %d-%d (%d processed)" % (events[0].event_number, events[-1].event_number, i))
+                if progress_bar is not None:
+                    progress_bar.update(len(events))
             if i >= self.stop_after:
                 self.log.info("User-defined limit of %d events reached." % i)
                 break
-            self.process_event(event)
-            self.log.debug("Event %d (%d processed)" % (event.event_number, i))
         else:   # If no break occurred:
             self.log.info("All events from input source have been processed.")
+        if progress_bar is not None:
+            progress_bar.close()
+        self.events_processed = i
+        self.run_time = (utils.perf_counter() - run_start) * 1000
 
         if self.config['pax']['print_timing_report']:
-            self.make_timing_report(i + 1)
+            self.make_timing_report(max(i, 1))
 
         # Shutdown all plugins now -- don't wait until this Processor instance gets deleted
         if clean_shutdown:
             self.shutdown()
 
     def make_timing_report(self, events_actually_processed):
-        all_plugins = [self.input_plugin] + self.action_plugins
+        all_plugins = [p for p in [self.input_plugin] + self.action_plugins if p is not None]
         timing_report = PrettyTable(['Plugin',
                                      '%',
                                      '/event (ms)',
                                      '#/s',
-                                     'Total (s)'])
+                                     'Total (s)',
+                                     'p50 (ms)',
+                                     'p90 (ms)',
+                                     'p99 (ms)',
+                                     'max (ms)'])
         timing_report.align = "r"
         timing_report.align["Plugin"] = "l"
         total_time = sum([plugin.total_time_taken for plugin in all_plugins])
@@ -349,30 +418,73 @@ class Processor:
                                        round(100 * t / total_time, 1),
                                        time_per_event_ms,
                                        event_rate_hz,
-                                       round(t / 1000, 1)])
+                                       round(t / 1000, 1)] + percentile_columns(plugin.timing))
             else:
                 timing_report.add_row([plugin.__class__.__name__,
                                        0,
                                        0,
                                        'n/a',
-                                       round(t / 1000, 1)])
+                                       round(t / 1000, 1)] + [''] * 4)
 
         if total_time > 0:
             timing_report.add_row(['TOTAL',
                                    round(100., 1),
                                    round(total_time / events_actually_processed, 1),
                                    round(1000 * events_actually_processed / total_time, 1),
-                                   round(total_time / 1000, 1)])
+                                   round(total_time / 1000, 1)] + [''] * 4)
         else:
             timing_report.add_row(['TOTAL',
                                    round(100., 1),
                                    0,
                                    'n/a',
-                                   round(total_time / 1000, 1)])
+                                   round(total_time / 1000, 1)] + [''] * 4)
         self.log.info("Timing report:\n" + str(timing_report))
 
+        # Time spent vs number of pulses in the event: shows where the heavy tail comes from
+        pulse_report = PrettyTable(['Pulses', 'Events', '/event (ms)', 'Slowest plugin', '% of bin'])
+        pulse_report.align = "r"
+        pulse_bins = sorted(set([b for plugin in self.action_plugins for b in plugin.timing.by_n_pulses]))
+        for b in pulse_bins:
+            times = [(plugin.timing.by_n_pulses[b][1], plugin.__class__.__name__)
+                     for plugin in self.action_plugins if b in plugin.timing.by_n_pulses]
+            n_events = max([plugin.timing.by_n_pulses[b][0]
+                            for plugin in self.action_plugins if b in plugin.timing.by_n_pulses])
+            bin_time = sum([t for t, _ in times])
+            slowest_time, slowest_name = max(times)
+            pulse_report.add_row([utils.pulse_bin_label(b),
+                                  n_events,
+                                  round(bin_time / n_events, 1),
+                                  slowest_name,
+                                  round(100 * slowest_time / bin_time, 1) if bin_time > 0 else 0])
+        if len(pulse_bins):
+            self.log.info("Time per event vs. number of pulses (action plugins only):\n" + str(pulse_report))
+
+    def get_timing_stats(self):
+        """Return dictionary with the timing information of all plugins, suitable for dumping to JSON"""
+        all_plugins = [p for p in [self.input_plugin] + self.action_plugins if p is not None]
+        return dict(pax_version=pax.__version__,
+                    events_processed=self.events_processed,
+                    run_time=self.run_time,
+                    plugins=[dict(name=plugin.__class__.__name__,
+                                  total_time_taken=plugin.total_time_taken,
+                                  time_waiting=plugin.time_waiting,
+                                  timing=plugin.timing.to_dict())
+                             for plugin in all_plugins],
+                    # Timing stats sent to our input by the processors upstream (see Queues.PushToQueue)
+                    upstream=getattr(self.input_plugin, 'pusher_timing_stats', []))
+
+    def write_timing_stats(self, filename):
+        """Dump the timing information of all plugins to filename as JSON, for comparing different builds"""
+        self.log.info("Writing timing information to %s" % filename)
+        with open(filename, mode='w') as outfile:
+            json.dump(self.get_timing_stats(), outfile, indent=4)
+
     def shutdown(self):
         """Call shutdown on all plugins"""
+        timing_file = self.config['pax'].get('timing_report_file', None)
+        if timing_file is not None:
+            self.write_timing_stats(timing_file)
+
         self.log.debug("Shutting down all plugins...")
         if self.input_plugin is not None:
             self.log.debug("Shutting down %s..." % self.input_plugin.name)
@@ -384,6 +496,26 @@ class Processor:
             ap.has_shut_down = True
 
 
+def n_pulses_in(event):
+    """Return the number of pulses in event, or 0 if it is not an Event (e.g. an encoded event proxy).
+    The per-event timing uses the largest number of pulses the event had anywhere in the processing chain.
+    """
+    return len(getattr(event, 'pulses', []))
+
+
+def add_timing(times, n_pulses):
+    """Add times, a list of (plugin, list of times the plugin took for each event), to the plugins' timing stats.
+    n_pulses is the list of the number of pulses in each event.
+    """
+    for plugin, dts in times:
+        for dt, n in zip(dts, n_pulses):
+            plugin.timing.add(dt, n)
+
+
+def percentile_columns(latency_histogram):
+    return [round(latency_histogram.percentile(q), 1) for q in (50, 90, 99)] + [round(latency_histogram.max, 1)]
+
+
 def setup_logging(level_str, name='processor'):
     if level_str is None:
         level_str = 'INFO'
@@ -399,3 +531,46 @@ def setup_logging(level_str, name='processor'):
     logger.debug('Logging initialized with level %s' % log_spec)
 
     return logger
+
+
+def enable_process_caches(enable=True):
+    """Let Processors created later in this process share plugin modules (see load_plugin_module) and large
+    read-only resources (see utils.cached_resource), rather than each loading their own.
+    This is meant for parallel.multiprocess_locally(prewarm=True): the processes it forks share the cached state
+    copy-on-write. Processors in the same process also share any state their plugin modules keep, so don't enable
+    this otherwise. Disabling clears the caches.
+    """
+    global plugin_modules
+    plugin_modules = {} if enable else None
+    utils.resource_cache = {} if enable else None
+
+
+def load_plugin_module(name_module, search_paths):
+    """Return the plugin module name_module found in search_paths, or None if there is no such module.
+    Loading a module executes it again (and compiles its numba functions again): if process caches are enabled
+    (see enable_process_caches), we reuse modules loaded earlier in this process instead.
+    """
+    if six.PY2:
+        file, pathname, description = imp.find_module(name_module, search_paths)
+        if file is None:
+            return None
+        if plugin_modules is not None and pathname in plugin_modules:
+            file.close()
+            return plugin_modules[pathname]
+        module = imp.load_module(name_module, file, pathname, description)
+        if plugin_modules is not None:
+            plugin_modules[pathname] = module
+        return module
+    else:
+        # imp has been deprecated in favor of importlib.
+        # Moreover, the above code gives non-closed file warnings in py3, so although it works,
+        # we really don't want to use it.
+        spec = importlib.machinery.PathFinder.find_spec(name_module, search_paths)
+        if spec is None:
+            return None
+        if plugin_modules is not None and spec.origin in plugin_modules:
+            return plugin_modules[spec.origin]
+        module = spec.loader.load_module()
+        if plugin_modules is not None:
+            plugin_modules[spec.origin] = module
+        return module
@@ -1,8 +1,16 @@
 """
 Python skeleton for data structure
 Extends python object to do a few tricks
+
+Fast model mode: if the environment variable PAX_FAST_MODEL=1 is set when pax is imported, StrictModel subclasses
+are built as __slots__ classes. Attribute assignments then skip StrictModel's type checking (values of int, float
+and bool fields are still converted to the declared python type), and the field lists are computed once per class.
+Objects are smaller and faster to create, change and serialize. Meant for production: develop in normal mode,
+where mistakes give a TypeError rather than a silently wrong type.
 """
 import json
+import os
+
 import bson
 import six
 import numpy as np
@@ -10,7 +18,155 @@ import decimal
 
 from pax.utils import Memoize
 
+if six.PY3:
+    long = int
+
+FAST_MODEL = os.environ.get('PAX_FAST_MODEL', '0') == '1'
+
+
+def array_to_bytes(a):
+    """Return bytes with the data of the numpy array a, for storage in BSON"""
+    if six.PY2:
+        # Python 2 bytes are strings, which BSON stores as text
+        return bson.Binary(a.tobytes())
+    # BSON encodes bytes as binary data, just like bson.Binary: using bytes saves Binary's copy of the data.
+    return a.tobytes()
+
+
+def array_to_buffer(a):
+    """Return a memoryview of unsigned bytes with the data of the numpy array a, without copying if possible"""
+    return memoryview(np.ascontiguousarray(a).reshape(-1).view(np.uint8))
+
+
+def collect_array_bytes(model_class, d, found):
+    """Append (dict, key) to found for each value in d, a dict decoded from BSON or MessagePack to initialize
+    model_class with, that holds the bytes of a numpy array field. Looks in child models and list fields too.
+    """
+    schema = model_class.get_field_schema()
+    for k, v in d.items():
+        # MessagePack returns byte-encoded keys
+        field_name = k.decode('ascii') if isinstance(k, bytes) else k
+        kind = schema.kinds.get(field_name)
+        if kind in ('array', 'structured_array') and isinstance(v, bytes):
+            found.append((d, k))
+        elif kind == 'model' and isinstance(v, dict):
+            collect_array_bytes(schema.defaults[field_name].__class__, v, found)
+        elif kind == 'list':
+            for el in v:
+                if isinstance(el, dict):
+                    collect_array_bytes(schema.list_field_info[field_name], el, found)
+
+
+def is_field_declaration(name, value):
+    """Return True if name = value in a Model class body declares a field (not a method, property or _internal)"""
+    return not (name.startswith('_') or callable(value) or
+                isinstance(value, (property, classmethod, staticmethod)))
+
+
+class FieldSchema(object):
+    """The fields declared in a Model class, compiled once per class (see Model.get_field_schema),
+    so serializers need not inspect the class or the values again for every object.
+      - names: field names, in lexical order
+      - defaults: dict field name => declared default (a ListField for list fields)
+      - kinds: dict field name => 'scalar', 'array', 'structured_array', 'model' or 'list'
+      - list_field_info: dict field name => type of elements, for list fields
+    """
+
+    def __init__(self, defaults):
+        self.defaults = defaults
+        self.names = tuple(sorted(defaults.keys()))
+        self.kinds = {}
+        self.list_field_info = {}
+        for k, v in defaults.items():
+            if isinstance(v, ListField):
+                self.kinds[k] = 'list'
+                self.list_field_info[k] = v.element_type
+            elif isinstance(v, Model):
+                self.kinds[k] = 'model'
+            elif isinstance(v, np.ndarray):
+                self.kinds[k] = 'array' if v.dtype.names is None else 'structured_array'
+            else:
+                self.kinds[k] = 'scalar'
+
+
+class ModelMeta(type):
+    """Metaclass of Model: in fast model mode, turns the field declarations of StrictModel subclasses into __slots__.
+    Classes which declare their own __slots__ (e.g. views into tables) are left alone.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        if FAST_MODEL and '__slots__' not in namespace and any(getattr(b, '_slotted_in_fast_mode', False)
+                                                               for b in bases):
+            namespace = mcs.make_slotted(bases, namespace)
+        return type.__new__(mcs, name, bases, namespace)
+
+    @staticmethod
+    def make_slotted(bases, namespace):
+        namespace = dict(namespace)
+        field_defaults = {}
+        for base in reversed(bases):
+            field_defaults.update(getattr(base, '_field_defaults', None) or {})
+        new_fields = [k for k, v in namespace.items() if is_field_declaration(k, v)]
+        for field_name in new_fields:
+            field_defaults[field_name] = namespace.pop(field_name)
+
+        namespace['__slots__'] = tuple(new_fields)
+        namespace['_field_defaults'] = field_defaults
+        namespace['_field_names'] = tuple(sorted(field_defaults.keys()))
+        namespace['_field_casts'] = {k: type(v) for k, v in field_defaults.items()
+                                     if type(v) in (int, float, bool, long)}
+        # Methods the class defines itself take precedence
+        for method_name, method in (('__getattr__', _slotted_getattr),
+                                    ('__setattr__', _slotted_setattr),
+                                    ('__getstate__', _slotted_getstate),
+                                    ('__setstate__', _slotted_setstate),
+                                    ('__str__', _slotted_str),
+                                    ('get_fields_data', _slotted_get_fields_data)):
+            namespace.setdefault(method_name, method)
+        return namespace
+
+
+def _slotted_getattr(self, key):
+    # Called only if the slot has not been set: fall back to the declared default,
+    # just like an unslotted instance falls back to the class attribute.
+    try:
+        return self._field_defaults[key]
+    except KeyError:
+        raise AttributeError("%s has no attribute %s" % (self.__class__.__name__, key))
 
+
+def _slotted_setattr(self, key, value):
+    cast = self._field_casts.get(key)
+    if cast is not None and value.__class__ is not cast:
+        value = cast(value)
+    object.__setattr__(self, key, value)
+
+
+def _slotted_getstate(self):
+    state = {}
+    for field_name in self._field_names:
+        try:
+            state[field_name] = object.__getattribute__(self, field_name)
+        except AttributeError:
+            pass
+    return state
+
+
+def _slotted_setstate(self, state):
+    for k, v in state.items():
+        object.__setattr__(self, k, v)
+
+
+def _slotted_str(self):
+    return str(_slotted_getstate(self))
+
+
+def _slotted_get_fields_data(self):
+    for field_name in self._field_names:
+        yield (field_name, getattr(self, field_name))
+
+
+@six.add_metaclass(ModelMeta)
 class Model(object):
     """Data modelling base class -- use for subclassing.
     Features:
@@ -25,6 +181,10 @@ class Model(object):
       - recursive initializiation of subclasses
       - dump as dictionary and JSON
     """
+    __slots__ = ()
+
+    #: In fast model mode, dict of field name => declared default of slotted classes (see ModelMeta)
+    _field_defaults = None
 
     def __init__(self, kwargs_dict=None, do_it_fast=False, **kwargs):
         if do_it_fast:
@@ -72,9 +232,11 @@ class Model(object):
                 if type(default_value) == np.ndarray:
                     if isinstance(v, np.ndarray):
                         pass
-                    elif isinstance(v, bytes):
-                        # Numpy arrays can be also initialized from a 'string' of bytes...
-                        v = np.fromstring(v, dtype=default_value.dtype)
+                    elif isinstance(v, (bytes, memoryview)):
+                        # Numpy arrays can be also initialized from a 'string' of bytes or a buffer...
+                        # This doesn't copy: the array is a view of the bytes, read-only unless the buffer
+                        # is writable (see from_decoded_dict)
+                        v = np.frombuffer(v, dtype=default_value.dtype)
                     elif hasattr(v, '__iter__'):
                         # ... or an iterable
                         v = np.array(v, dtype=default_value.dtype)
@@ -86,16 +248,30 @@ class Model(object):
 
                 setattr(self, k, v)
 
+    @classmethod        # Use only if attributes are fixed, as for StrictModel
+    @Memoize            # Caching decorator: the class declaration is inspected only once
+    def get_field_schema(cls):
+        """Return the FieldSchema of the fields declared in this class"""
+        output_class = cls.get_output_class()
+        if output_class is not cls:
+            return output_class.get_field_schema()
+        if cls._field_defaults is not None:
+            # Fast model mode: the declarations were moved out of the class dict, see ModelMeta
+            return FieldSchema(cls._field_defaults)
+        return FieldSchema({k: v for k, v in cls.__dict__.items() if is_field_declaration(k, v)})
+
+    @classmethod
+    def get_output_class(cls):
+        """Return the model class that output formats should store objects of this class as, and name their tables
+        (or classes, ...) after. Views into columnar tables (e.g. PulseView) return the class they are a view of.
+        """
+        return cls
+
     @classmethod        # Use only in initialization (or if attributes are fixed, as for StrictModel)
-    @Memoize            # Caching decorator, improves performance if a model is initialized often
     def get_list_field_info(cls):
         """Return dict with fielname => type of elements in collection fields in this class
         """
-        list_field_info = {}
-        for k, v in cls.__dict__.items():
-            if isinstance(v, ListField):
-                list_field_info[k] = v.element_type
-        return list_field_info
+        return cls.get_field_schema().list_field_info
 
     def __str__(self):
         return str(self.__dict__)
@@ -104,28 +280,13 @@ class Model(object):
         """Iterator over (key, value) tuples of all user-specified fields
         Returns keys in lexical order
         """
-        # TODO: increase performance by pre-sorting keys?
-        # self.__dict__.items() does not return default values set in class declaration
-        # Hence we need something more complicated
-
-        class_dict = self.__class__.__dict__
+        # self.__dict__.items() does not return default values set in class declaration,
+        # for these we yield the class-level value.
         self_dict = self.__dict__
-
-        for field_name in sorted(class_dict.keys()):
-            if field_name in self_dict:
-                # The instance has a value for this field: return it
-                yield (field_name, self_dict[field_name])
-            else:
-                # ... it doesnt. Should we return its value?
-                if field_name.startswith('_'):
-                    continue    # No, is internal
-                value_in_class = class_dict[field_name]
-                if callable(value_in_class):
-                    continue    # No, is a method
-                if isinstance(value_in_class, (property, classmethod)):
-                    continue    # No, is a property or classmethod
-                # Yes, yield the class-level value
-                yield (field_name, value_in_class)
+        schema = self.__class__.get_field_schema()
+        defaults = schema.defaults
+        for field_name in schema.names:
+            yield (field_name, self_dict.get(field_name, defaults[field_name]))
 
     @classmethod
     def get_dtype(cls):
@@ -146,36 +307,53 @@ class Model(object):
 
     def to_dict(self, convert_numpy_arrays_to=None, fields_to_ignore=None, nan_to_none=False,
                 use_decimal=False):
+        """Return dict of field name => value, with child models and list fields converted to dicts too.
+        convert_numpy_arrays_to can be:
+          - None: leave numpy arrays alone
+          - 'list': convert them to lists
+          - 'bytes': convert them to bytes containing their data (for BSON)
+          - 'buffer': convert them to memoryviews of their data. This doesn't copy the data, but the result is
+            only valid until you modify the model: use it only for encoders which support the buffer protocol
+            (e.g. msgpack).
+        To get a model back from the decoded result, use from_decoded_dict.
+        """
         result = {}
         if fields_to_ignore is None:
             fields_to_ignore = tuple()
+        kinds = self.__class__.get_field_schema().kinds
         for k, v in self.get_fields_data():
             if k in fields_to_ignore:
                 continue
-            if isinstance(v, Model):
+            kind = kinds[k]
+            if kind == 'model':
                 result[k] = v.to_dict(convert_numpy_arrays_to=convert_numpy_arrays_to,
                                       fields_to_ignore=fields_to_ignore,
                                       nan_to_none=nan_to_none,
                                       use_decimal=use_decimal)
-            elif isinstance(v, list):
+            elif kind == 'list':
                 result[k] = [el.to_dict(convert_numpy_arrays_to=convert_numpy_arrays_to,
                                         fields_to_ignore=fields_to_ignore,
                                         nan_to_none=nan_to_none,
                                         use_decimal=use_decimal) for el in v]
-            elif isinstance(v, np.ndarray) and convert_numpy_arrays_to is not None:
+            elif kind == 'scalar':
+                if nan_to_none and isinstance(v, float) and not np.isfinite(v):
+                    result[k] = None
+                elif use_decimal and isinstance(v, float):
+                    result[k] = decimal.Decimal("%f" % v)
+                else:
+                    result[k] = v
+            elif convert_numpy_arrays_to is not None:
                 if convert_numpy_arrays_to == 'list':
                     if use_decimal:
                         result[k] = [decimal.Decimal("%f" % a) if isinstance(a, float) else a for a in v.tolist()]
                     else:
                         result[k] = v.tolist()
                 elif convert_numpy_arrays_to == 'bytes':
-                    result[k] = bson.Binary(v.tostring())
+                    result[k] = array_to_bytes(v)
+                elif convert_numpy_arrays_to == 'buffer':
+                    result[k] = array_to_buffer(v)
                 else:
-                    raise ValueError('convert_numpy_arrays_to must be "list" or "bytes"')
-            elif nan_to_none and isinstance(v, float) and not np.isfinite(v):
-                result[k] = None
-            elif use_decimal and isinstance(v, float):
-                result[k] = decimal.Decimal("%f" % v)
+                    raise ValueError('convert_numpy_arrays_to must be "list", "bytes" or "buffer"')
             else:
                 result[k] = v
         return result
@@ -202,7 +380,25 @@ class Model(object):
             event_dict = next(reader)
         else:
             event_dict = bson.BSON.decode(x)
-        return cls(**event_dict)
+        return cls.from_decoded_dict(event_dict)
+
+    @classmethod
+    def from_decoded_dict(cls, d):
+        """Return a model initialized from d, a dict decoded from BSON or MessagePack (see to_dict).
+        The data of all arrays is copied into one writable buffer, and the arrays are views of it: so there is one
+        allocation per message rather than one per array, and plugins can modify the arrays in place or pass them to
+        numba kernels with explicit signatures (which accept only writable arrays).
+        """
+        found = []
+        collect_array_bytes(cls, d, found)
+        # Start each array at a multiple of 16 bytes, so the arrays are aligned
+        sizes = [len(container[k]) for container, k in found]
+        starts = np.cumsum([0] + [size + (-size % 16) for size in sizes])
+        buffer = np.empty(starts[-1], dtype=np.uint8)
+        for (container, k), start, size in zip(found, starts, sizes):
+            buffer[start:start + size] = np.frombuffer(container[k], dtype=np.uint8)
+            container[k] = memoryview(buffer[start:start + size])
+        return cls(**d)
 
 
 casting_allowed_for = {
@@ -225,7 +421,10 @@ class StrictModel(Model):
     """Model which enforces additional restrictions:
       - can't add new attributes: have to be fixed at class declaration
       - attributes can't change type or numpy dtype once set.
+    In fast model mode, subclasses are __slots__ classes without these checks, see ModelMeta.
     """
+    __slots__ = ()
+    _slotted_in_fast_mode = True
 
     def __setattr__(self, key, value):
 
@@ -394,6 +394,209 @@ class Peak(StrictModel):
     birthing_split_fraction = float('nan')
 
 
+class PeakTable(object):
+    """Columnar storage of peaks, see Event.get_peak_table.
+
+    Numeric fields are stored in a numpy structured array, data (see get_dtype). Per-channel arrays (e.g.
+    area_per_channel) are 2d columns of n_peaks x n_channels in there, other fixed-size arrays (e.g.
+    range_area_decile) likewise. Other fields (type, detector, hits, sum_waveform, reconstructed_positions, ...)
+    are stored in one python list per field, in objects.
+
+    Indexing or iterating the table gives PeakViews, which behave like Peaks but read and write the table.
+    Unlike Peaks, they do not type-check attribute assignments: numpy casts the values to the column's dtype.
+    Use append to add a peak: the table grows as needed.
+    """
+    _dtypes = {}
+
+    #: Names of all fields, of those not stored in the structured array, and of list fields (one fresh list per peak)
+    field_names = tuple(k for k, v in Peak.__new__(Peak).get_fields_data())
+    list_field_names = tuple(Peak.get_list_field_info().keys())
+
+    def __init__(self, n_channels):
+        self.n_channels = n_channels
+        self.dtype = self.get_dtype(n_channels)
+        self.n = 0
+        self.object_defaults = {}
+        # Rows beyond n are kept at the default values, so append is quick.
+        self.default_row = np.zeros(1, dtype=self.dtype)
+        for k, v in Peak.__new__(Peak).get_fields_data():
+            if k not in self.dtype.names:
+                self.object_defaults[k] = v
+            elif not self.dtype[k].shape or len(v) == self.dtype[k].shape[0]:
+                self.default_row[k][0] = v
+        self.data = np.zeros(0, dtype=self.dtype)
+        self.columns = {name: self.data[name] for name in self.dtype.names}
+        self.objects = {name: [] for name in self.object_defaults}
+
+    @classmethod
+    def get_dtype(cls, n_channels):
+        """Return numpy dtype of the numeric fields for a table of peaks in an event with n_channels channels"""
+        if n_channels in cls._dtypes:
+            return cls._dtypes[n_channels]
+        type_mapping = {'int':    np.int64,
+                        'float':  np.float64,
+                        'long':   np.int64,
+                        'bool':   np.bool_}
+        dtype = []
+        for field_name, default_value in Peak.__new__(Peak).get_fields_data():
+            value_type = default_value.__class__.__name__
+            if value_type in type_mapping:
+                dtype.append((field_name, type_mapping[value_type]))
+            elif isinstance(default_value, np.ndarray) and default_value.dtype.names is None:
+                if field_name.endswith('_per_channel'):
+                    dtype.append((field_name, default_value.dtype, (n_channels,)))
+                elif len(default_value):
+                    dtype.append((field_name, default_value.dtype, default_value.shape))
+        cls._dtypes[n_channels] = result = np.dtype(dtype)
+        return result
+
+    @classmethod
+    def from_peaks(cls, peaks, n_channels):
+        """Make a peak table from a list of Peaks (whose data is copied into the table)"""
+        table = cls(n_channels)
+        # Copy views in bulk: collect indices of consecutive views into the same table
+        source, indices = None, []
+        for peak in peaks:
+            if isinstance(peak, PeakView) and peak._table is source:
+                indices.append(peak._index)
+                continue
+            if indices:
+                table.append_rows(source, indices)
+            source, indices = None, []
+            if isinstance(peak, PeakView):
+                source, indices = peak._table, [peak._index]
+            else:
+                # Per-channel arrays of peaks which never had them set are empty: leave them at zero.
+                table.append(**{k: v for k, v in peak.get_fields_data()
+                                if not (isinstance(v, np.ndarray) and not len(v) and k in table.columns)})
+        if indices:
+            table.append_rows(source, indices)
+        return table
+
+    def _reserve(self, n_extra):
+        """Make sure the table can hold n_extra more peaks"""
+        if self.n + n_extra > len(self.data):
+            new_data = np.empty(max(2 * len(self.data), self.n + n_extra, 16), dtype=self.dtype)
+            new_data[:self.n] = self.data[:self.n]
+            new_data[self.n:] = self.default_row
+            self.data = new_data
+            self.columns = {name: self.data[name] for name in self.dtype.names}
+
+    def append(self, **kwargs):
+        """Add a peak with field values from kwargs (other fields get the Peak defaults), return a PeakView of it"""
+        self._reserve(1)
+        i = self.n
+        self.n += 1
+        for name, default in self.object_defaults.items():
+            self.objects[name].append([] if name in self.list_field_names else default)
+        view = PeakView(self, i)
+        for k, v in kwargs.items():
+            setattr(view, k, v)
+        return view
+
+    def append_rows(self, other, indices):
+        """Copy the peaks at indices in the PeakTable other to the end of this table"""
+        self._reserve(len(indices))
+        self.data[self.n:self.n + len(indices)] = other.data[np.asarray(indices, dtype=np.int64)]
+        for name, values in self.objects.items():
+            other_values = other.objects[name]
+            if name in self.list_field_names:
+                values.extend([list(other_values[i]) for i in indices])
+            else:
+                values.extend([other_values[i] for i in indices])
+        self.n += len(indices)
+
+    def __getstate__(self):
+        # The columns are views into data: rebuild them after unpickling rather than pickling copies
+        state = self.__dict__.copy()
+        del state['columns']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.columns = {name: self.data[name] for name in self.dtype.names}
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError("Peak index %d out of range" % i)
+        return PeakView(self, i)
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield PeakView(self, i)
+
+    def __getattr__(self, name):
+        # Access the numeric columns of the table as attributes, e.g. table.area
+        columns = self.__dict__.get('columns', {})
+        if name in columns:
+            return columns[name][:self.n]
+        raise AttributeError(name)
+
+
+class PeakView(Peak):
+    """A Peak whose data is stored in a PeakTable.
+    Reading or setting an attribute reads or modifies the table.
+    """
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        object.__setattr__(self, '_table', table)
+        object.__setattr__(self, '_index', index)
+
+    def __reduce__(self):
+        return PeakView, (self._table, self._index)
+
+    @classmethod
+    def get_output_class(cls):
+        return Peak
+
+    def __setattr__(self, key, value):
+        # No type checking as in StrictModel: the table's dtype takes care of that.
+        table = self._table
+        if key in table.objects:
+            table.objects[key][self._index] = value
+        elif key in table.columns:
+            table.columns[key][self._index] = value
+        else:
+            raise AttributeError("Peak has no field %s" % key)
+
+    def get_fields_data(self):
+        for field_name in PeakTable.field_names:
+            yield field_name, getattr(self, field_name)
+
+    def __str__(self):
+        return str(dict(self.get_fields_data()))
+
+
+def _peak_table_column(name, kind):
+    # Assignment is handled by PeakView.__setattr__
+    if kind == 'object':
+        def fget(self):
+            return self._table.objects[name][self._index]
+    elif kind == 'array':
+        def fget(self):
+            return self._table.columns[name][self._index]
+    else:
+        def fget(self):
+            return self._table.columns[name].item(self._index)
+    return property(fget)
+
+
+for _field_name in PeakTable.field_names:
+    if _field_name not in PeakTable.get_dtype(1).names:
+        _kind = 'object'
+    elif PeakTable.get_dtype(1)[_field_name].shape:
+        _kind = 'array'
+    else:
+        _kind = 'scalar'
+    setattr(PeakView, _field_name, _peak_table_column(_field_name, _kind))
+
+
 class SumWaveform(StrictModel):
     """Class used to store sum (filtered or not) waveform information.
     """
@@ -409,14 +612,61 @@ class SumWaveform(StrictModel):
     channel_list = np.array([], dtype=np.uint16)
 
     #: Array of samples, units of pe/bin.
+    #: For sparse sum waveforms, only the samples in the intervals listed in interval_left are stored.
     samples = np.array([], dtype=np.float32)
 
+    #: If True, the sum waveform is zero outside some intervals of the event, and only the samples inside these
+    #: are stored (concatenated in samples). Use get_samples to get the samples of part of the event.
+    is_sparse = False
+
+    #: For sparse sum waveforms: index in the event of the first sample of each interval.
+    #: Intervals are sorted and do not overlap.
+    interval_left = np.array([], dtype=np.int64)
+
+    #: For sparse sum waveforms: index in samples of the first sample of each interval.
+    interval_offset = np.array([], dtype=np.int64)
+
     def is_filtered(self):
         if self.name_of_filter != 'none':
             return True
         else:
             return False
 
+    def get_intervals(self):
+        """Return (interval_left, interval_right, interval_offset) arrays of the intervals whose samples are stored,
+        right bounds inclusive. A dense sum waveform is one interval, starting at the start of the event.
+        """
+        if not self.is_sparse:
+            return (np.zeros(1, dtype=np.int64), np.array([len(self.samples) - 1], dtype=np.int64),
+                    np.zeros(1, dtype=np.int64))
+        interval_right = self.interval_left + np.diff(np.concatenate((self.interval_offset,
+                                                                      [len(self.samples)]))) - 1
+        return self.interval_left, interval_right.astype(np.int64), self.interval_offset
+
+    def get_samples(self, left, right):
+        """Return the samples from left to right (inclusive) in the event, in pe/bin.
+        This is a view of samples if possible (always for dense sum waveforms, and if left-right lies in one interval
+        for sparse ones), so don't modify it. Otherwise a new array is returned, with zeros outside the intervals.
+        """
+        if not self.is_sparse:
+            return self.samples[left:right + 1]
+        n = right - left + 1
+        interval_left, interval_right, interval_offset = self.get_intervals()
+        first_i = np.searchsorted(interval_right, left)
+        if first_i < len(interval_left) and interval_left[first_i] <= left and right <= interval_right[first_i]:
+            start = interval_offset[first_i] + left - interval_left[first_i]
+            return self.samples[start:start + n]
+
+        result = np.zeros(n, dtype=self.samples.dtype)
+        for i in range(first_i, len(interval_left)):
+            if interval_left[i] > right:
+                break
+            l = max(left, interval_left[i])
+            r = min(right, interval_right[i])
+            start = interval_offset[i] + l - interval_left[i]
+            result[l - left:r - left + 1] = self.samples[start:start + r - l + 1]
+        return result
+
 
 class Pulse(Model):
     """A region of raw digitizer data.
@@ -492,6 +742,175 @@ class Pulse(Model):
             self.right = self.left + len(self.raw_data) - 1
 
 
+class PulseTable(object):
+    """Columnar storage of all pulses in an event, see Event.get_pulse_table.
+
+    The raw data of all pulses is kept in one contiguous int16 array, samples. Pulse i's raw data is
+    samples[offset[i]:offset[i] + n_samples[i]]. If some pulse's raw data is floating-point (e.g. after
+    DesaturatePulses replaced it by a reconstructed waveform), samples is a float64 array instead.
+    The other pulse fields (left, right, channel, baseline, noise_sigma, ...) are stored as one numpy array per field,
+    e.g. table.baseline[i].
+    This lets numba kernels process all pulses of an event in one call, and output code write one buffer.
+
+    Indexing or iterating the table gives PulseViews, which behave like Pulses but read and write the table.
+    """
+
+    #: Names of the per-pulse fields stored as columns (besides offset and n_samples)
+    field_names = tuple(k for k, v in Model.get_fields_data(Pulse.__new__(Pulse))
+                        if isinstance(v, (int, float)))
+
+    #: Buffer with spare capacity samples is a view of, if it was made by append_samples
+    _samples_buffer = None
+
+    def __init__(self, samples=None, offset=None, n_samples=None, **columns):
+        """Make a pulse table from the sample buffer, offset and n_samples arrays and the other columns.
+        Columns not given are filled with the Pulse defaults.
+        """
+        self.samples = np.zeros(0, dtype=np.int16) if samples is None else \
+            np.asarray(samples, dtype=self.get_samples_dtype(samples))
+        self.offset = np.zeros(0, dtype=np.int64) if offset is None else np.asarray(offset, dtype=np.int64)
+        self.n_samples = np.diff(np.concatenate((self.offset, [len(self.samples)]))) if n_samples is None \
+            else np.asarray(n_samples, dtype=np.int64)
+        n = len(self.offset)
+        for name in self.field_names:
+            default = getattr(Pulse, name)
+            dtype = np.float64 if isinstance(default, float) else np.int64
+            if name in columns:
+                setattr(self, name, np.asarray(columns[name], dtype=dtype))
+            else:
+                setattr(self, name, np.ones(n, dtype=dtype) * default)
+
+    @classmethod
+    def from_pulses(cls, pulses):
+        """Make a pulse table from a list of Pulse objects (whose data is copied into the table)"""
+        n_samples = np.array([len(p.raw_data) for p in pulses], dtype=np.int64)
+        offset = np.zeros(len(pulses), dtype=np.int64)
+        offset[1:] = np.cumsum(n_samples)[:-1]
+        if len(pulses):
+            raw_data = [p.raw_data for p in pulses]
+            samples = np.concatenate(raw_data).astype(cls.get_samples_dtype(*raw_data))
+        else:
+            samples = np.zeros(0, dtype=np.int16)
+        return cls(samples, offset, n_samples, **{name: [getattr(p, name) for p in pulses]
+                                                  for name in cls.field_names})
+
+    @staticmethod
+    def get_samples_dtype(*raw_data):
+        """Return the dtype of a sample buffer which can hold all the raw data arrays without loss:
+        int16, or float64 if any of them are floating-point.
+        """
+        if any(np.issubdtype(np.asarray(w).dtype, np.floating) for w in raw_data):
+            return np.float64
+        return np.int16
+
+    def __len__(self):
+        return len(self.offset)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Pulse index %d out of range" % i)
+        return PulseView(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield PulseView(self, i)
+
+    def get_raw_data(self, i):
+        """Return the raw data of pulse i (a view into samples, not a copy)"""
+        return self.samples[self.offset[i]:self.offset[i] + self.n_samples[i]]
+
+    def set_raw_data(self, i, w):
+        """Set the raw data of pulse i to w.
+        If w is a slice of samples (e.g. you shrunk the pulse), only offset and n_samples are changed.
+        Otherwise, w is appended to samples (which is converted to float64 if w is floating-point). Samples has spare
+        capacity for this, so replacing the data of many pulses (e.g. in DesaturatePulses) takes time proportional to
+        the data added, not to the data in the table. When the capacity runs out, the samples are moved to a new
+        buffer (twice as large): raw data you got from the table before that is then a copy, changing it no longer
+        changes the table.
+        """
+        w = np.asarray(w)
+        itemsize = self.samples.itemsize
+        buffer_start = self.samples.__array_interface__['data'][0]
+        w_start = w.__array_interface__['data'][0] if len(w) else buffer_start
+        in_buffer = (w.dtype == self.samples.dtype and w.ndim == 1 and (len(w) < 2 or w.strides[0] == itemsize) and
+                     buffer_start <= w_start and
+                     w_start + itemsize * len(w) <= buffer_start + itemsize * len(self.samples))
+        if in_buffer:
+            self.offset[i] = (w_start - buffer_start) // itemsize
+        else:
+            self.offset[i] = len(self.samples)
+            self.append_samples(w)
+        self.n_samples[i] = len(w)
+
+    def append_samples(self, w):
+        """Append the samples w to samples, using the spare capacity of the buffer samples is a view of if possible"""
+        n = len(self.samples)
+        dtype = self.get_samples_dtype(self.samples, w)
+        buffer = self._samples_buffer
+        if not (buffer is not None and buffer.dtype == dtype and len(buffer) >= n + len(w) and
+                self.samples.base is buffer):
+            buffer = np.empty(max(2 * n, n + len(w)), dtype=dtype)
+            buffer[:n] = self.samples
+            self._samples_buffer = buffer
+        buffer[n:n + len(w)] = w
+        self.samples = buffer[:n + len(w)]
+
+    def __getstate__(self):
+        # Don't pickle the spare capacity of the samples buffer
+        state = self.__dict__.copy()
+        state.pop('_samples_buffer', None)
+        return state
+
+
+class PulseView(Pulse):
+    """A Pulse whose data is stored in a PulseTable.
+    Reading or setting an attribute reads or modifies the table.
+    """
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        object.__setattr__(self, '_table', table)
+        object.__setattr__(self, '_index', index)
+
+    def __reduce__(self):
+        return PulseView, (self._table, self._index)
+
+    @classmethod
+    def get_output_class(cls):
+        return Pulse
+
+    @property
+    def raw_data(self):
+        return self._table.get_raw_data(self._index)
+
+    @raw_data.setter
+    def raw_data(self, value):
+        self._table.set_raw_data(self._index, value)
+
+    def get_fields_data(self):
+        for field_name in sorted(PulseTable.field_names + ('raw_data',)):
+            yield field_name, getattr(self, field_name)
+
+    def __str__(self):
+        return str(dict(self.get_fields_data()))
+
+
+def _pulse_table_column(name):
+    def fget(self):
+        return getattr(self._table, name)[self._index].item()
+
+    def fset(self, value):
+        getattr(self._table, name)[self._index] = value
+
+    return property(fget, fset)
+
+
+for _field_name in PulseTable.field_names:
+    setattr(PulseView, _field_name, _pulse_table_column(_field_name))
+
+
 class Interaction(StrictModel):
     """An interaction in the TPC, reconstructed from a pair of S1 and S2 peaks.
     """
@@ -710,6 +1129,37 @@ class Event(StrictModel):
         """
         return Event(n_channels=1, start_time=10, length=1, sample_duration=int(10 * units.ns))
 
+    def get_pulse_table(self):
+        """Return a PulseTable with the data of all pulses in event.pulses.
+        Unless the pulses were already views into one pulse table, their data is copied into a new table,
+        and event.pulses is replaced by views into it. Changes to the table are thus visible in event.pulses,
+        and vice versa -- until you put other pulses in event.pulses.
+        """
+        pulses = self.pulses
+        if len(pulses) and isinstance(pulses[0], PulseView):
+            table = pulses[0]._table
+            if len(table) == len(pulses) and all(isinstance(p, PulseView) and p._table is table and p._index == i
+                                                 for i, p in enumerate(pulses)):
+                return table
+        table = PulseTable.from_pulses(pulses)
+        self.pulses = list(table)
+        return table
+
+    def get_peak_table(self):
+        """Return a PeakTable with the data of all peaks in event.peaks.
+        Unless the peaks are already views into one peak table (in the same order), their data is copied into a
+        new table, and event.peaks is replaced by views into it.
+        """
+        peaks = self.peaks
+        if len(peaks) and isinstance(peaks[0], PeakView):
+            table = peaks[0]._table
+            if len(table) == len(peaks) and all(isinstance(p, PeakView) and p._table is table and p._index == i
+                                                 for i, p in enumerate(peaks)):
+                return table
+        table = PeakTable.from_peaks(peaks, self.n_channels)
+        self.peaks = list(table)
+        return table
+
     def duration(self):
         """Duration of event window in units of ns
         """
@@ -1,12 +1,13 @@
 import numba
+from pax.numba_cache import jit
 import numpy as np
 
 from pax import units, exceptions
 from pax.datastructure import Hit
 
 
-@numba.jit(numba.int64[:](numba.from_dtype(Hit.get_dtype())[:]),
-           nopython=True)
+@jit(numba.int64[:](numba.from_dtype(Hit.get_dtype())[:]),
+     nopython=True)
 def gaps_between_hits(hits):
     """Return array of gaps between hits: a hit's 'gap' is the # of samples before that hit free of other hits.
     The gap of the first hit is 0 by definition.
@@ -96,8 +97,29 @@ def get_detector_by_channel(config):
     return detector_by_channel
 
 
-@numba.jit(numba.void(numba.float64[:], numba.int64[:, :], numba.int64, numba.int64),
-           nopython=True)
+def use_parallel_kernels(config, n_pulses):
+    """Return True if the multi-threaded versions of the pulse-level kernels should be used for an event with
+    n_pulses pulses. If so, also sets the number of threads numba uses.
+      - config should be a configuration dictionary (self.config in a pax plugin). We use its
+        parallel_kernel_min_pulses (the minimum number of pulses) and numba_threads (number of threads, 0 for
+        numba's default, i.e. the number of cores; 1 disables multi-threading) settings.
+    """
+    n_threads = config.get('numba_threads', 1)
+    if n_threads == 1 or n_pulses < config.get('parallel_kernel_min_pulses', float('inf')):
+        return False
+    if hasattr(numba, 'set_num_threads'):
+        max_threads = numba.config.NUMBA_NUM_THREADS
+        numba.set_num_threads(max_threads if n_threads == 0 else min(n_threads, max_threads))
+    return True
+
+
+# Waveform sample types the raw data kernels are compiled for: raw ADC counts, and floats for pulses whose
+# raw data was replaced by a float waveform (e.g. by DesaturatePulses)
+raw_data_types = (numba.int16, numba.float64)
+
+
+@jit([numba.void(t[:], numba.int64[:, :], numba.int64, numba.int64) for t in raw_data_types],
+     nopython=True)
 def extend_intervals(w, intervals, left_extension, right_extension):
     """Extends intervals on w by left_extension to left and right_extension to right, never exceeding w's bounds
     :param w: Waveform intervals live on. Only used for edges (kind of pointless to pass...)
@@ -132,17 +154,9 @@ def extend_intervals(w, intervals, left_extension, right_extension):
             intervals[i][0] = max(min_possible_l, intervals[i][0] - left_extension)
 
 
-@numba.jit(numba.int32(numba.float64[:], numba.float64, numba.int64[:, :]),
-           nopython=True)
-def find_intervals_above_threshold(w, threshold, result_buffer):
-    """Fills result_buffer with l, r bounds of intervals in w > threshold.
-    :param w: Waveform to do hitfinding in
-    :param threshold: Threshold for including an interval
-    :param result_buffer: numpy N*2 array of ints, will be filled by function.
-                          if more than N intervals are found, none past the first N will be processed.
-    :returns : number of intervals processed
-    Boundary indices are inclusive, i.e. the right boundary is the last index which was > threshold
-    """
+@jit(nopython=True)
+def _find_intervals_above_threshold(w, reference_baseline, sign, baseline, threshold, result_buffer):
+    """find_intervals_above_threshold for the waveform (reference_baseline + sign * w) - baseline"""
     result_buffer_size = len(result_buffer)
     last_index_in_w = len(w) - 1
 
@@ -150,7 +164,8 @@ def find_intervals_above_threshold(w, threshold, result_buffer):
     current_interval = 0
     current_interval_start = -1
 
-    for i, x in enumerate(w):
+    for i in range(len(w)):
+        x = (reference_baseline + sign * w[i]) - baseline
 
         if not in_interval and x > threshold:
             # Start of an interval
@@ -175,3 +190,27 @@ def find_intervals_above_threshold(w, threshold, result_buffer):
 
     n_intervals = current_interval      # No +1, as current_interval was incremented also when the last interval closed
     return n_intervals
+
+
+@jit(numba.int32(numba.float64[:], numba.float64, numba.int64[:, :]),
+     nopython=True)
+def find_intervals_above_threshold(w, threshold, result_buffer):
+    """Fills result_buffer with l, r bounds of intervals in w > threshold.
+    :param w: Waveform to do hitfinding in
+    :param threshold: Threshold for including an interval
+    :param result_buffer: numpy N*2 array of ints, will be filled by function.
+                          if more than N intervals are found, none past the first N will be processed.
+    :returns : number of intervals processed
+    Boundary indices are inclusive, i.e. the right boundary is the last index which was > threshold
+    """
+    return _find_intervals_above_threshold(w, 0.0, 1.0, 0.0, threshold, result_buffer)
+
+
+@jit([numba.int32(t[:], numba.float64, numba.float64, numba.float64, numba.int64[:, :]) for t in raw_data_types],
+     nopython=True)
+def find_intervals_above_threshold_raw(raw_data, reference_baseline, baseline, threshold, result_buffer):
+    """Like find_intervals_above_threshold, for the waveform (reference_baseline - raw_data) - baseline
+    (i.e. baseline-corrected and inverted, so hits point up). The waveform is computed on the fly from the raw data,
+    not stored in a float array.
+    """
+    return _find_intervals_above_threshold(raw_data, reference_baseline, -1.0, baseline, threshold, result_buffer)
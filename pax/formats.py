@@ -4,8 +4,9 @@ and because csv is nice for debugging.
 
 Here are the definitions of how to serialize our data structure to and from various formats.
 Please be careful when editing this file:
- - Do not add any dependencies (e.g. imports at head of file without try-except), this file has to stay import-able
-   even if not all the python modules for all the formats are installed.
+ - Do not add any dependencies (e.g. imports at head of file), this file has to stay import-able
+   even if not all the python modules for all the formats are installed. Import them in the format's __init__
+   instead: this also keeps pax's startup fast if you don't use these formats.
  - Do not use python3-specific syntax, this file should be importable by python2 applications.
    (but in a sense this applies to all of pax, we aim to support python 2 and 3)
 """
@@ -17,16 +18,6 @@ import numpy as np
 
 base_logger = logging.getLogger('TableWriter')
 
-try:
-    import pandas
-except ImportError:
-    base_logger.warning("You don't have pandas -- if you use any of the pandas formats, pax will crash!")
-
-try:
-    import h5py
-except ImportError:
-    base_logger.warning("You don't have h5py -- if you use the hdf5 format, pax will crash!")
-
 
 class TableFormat(object):
     """Base class for bulk output formats
@@ -100,8 +91,14 @@ class HDF5Dump(TableFormat):
     supports_write_in_chunks = True
     supports_read_back = True
 
+    def __init__(self, *args, **kwargs):
+        # Avoid importing h5py until it is needed
+        import h5py
+        self.h5py = h5py
+        TableFormat.__init__(self, *args, **kwargs)
+
     def open(self, name, mode):
-        self.f = h5py.File(name, mode)
+        self.f = self.h5py.File(name, mode)
 
     def close(self):
         self.f.close()
@@ -299,6 +296,12 @@ class PandasFormat(TableFormat):
     pandas_format_key = None
     supports_array_fields = False
 
+    def __init__(self, *args, **kwargs):
+        # Avoid importing pandas until it is needed
+        import pandas
+        self.pandas = pandas
+        TableFormat.__init__(self, *args, **kwargs)
+
     def open(self, name, mode):
         self.filename = name
 
@@ -310,12 +313,12 @@ class PandasFormat(TableFormat):
                 if len(records[column_name].shape) != 1:
                     # This is an array field. Pandas doesn't like this: we should convert it to a list of lists,
                     # then store it as an object-dtype Series
-                    df_series_dict[column_name] = pandas.Series(records[column_name].tolist(),
-                                                                dtype=np.dtype("object"))
+                    df_series_dict[column_name] = self.pandas.Series(records[column_name].tolist(),
+                                                                     dtype=np.dtype("object"))
                 else:
-                    df_series_dict[column_name] = pandas.Series(records[column_name],
-                                                                dtype=records[column_name].dtype)
-            df = pandas.DataFrame(df_series_dict)
+                    df_series_dict[column_name] = self.pandas.Series(records[column_name],
+                                                                     dtype=records[column_name].dtype)
+            df = self.pandas.DataFrame(df_series_dict)
             self.write_pandas_dataframe(name, df)
 
     def write_pandas_dataframe(self, df_name, df):
@@ -345,7 +348,7 @@ class PandasHDF5(PandasFormat):
     file_extension = 'hdf5'
 
     def open(self, name, mode):
-        self.store = pandas.HDFStore(name, complevel=9, complib='blosc')
+        self.store = self.pandas.HDFStore(name, complevel=9, complib='blosc')
 
     def close(self):
         self.store.close()
@@ -0,0 +1,117 @@
+"""Compilation of pax's numba kernels, with a persistent on-disk cache
+
+Use pax.numba_cache.jit instead of numba.jit in pax (and its plugins): the compiled machine code is then stored on disk,
+so the next process (a multiprocessing worker, the next paxer job on the batch queue...) can load it rather than
+compiling the kernel again.
+
+The cache lives in a directory per pax version, numba version, python version and hash of the sources of all pax
+modules with kernels (see kernel_modules). Within that directory numba keys the entries by the source file and the
+argument types (including the fields of record dtypes like Hit's).
+Numba itself only checks the timestamp of the file defining a kernel, not of the files defining the kernels it calls:
+after editing e.g. dsputils.extend_intervals, HitFinder's kernels would keep running the old code. The source hash in
+the directory name prevents this: editing any kernel module starts a new cache. Kernels in plugin modules outside
+the pax package are not hashed, so don't let them call kernels from other modules you edit, or disable the cache.
+Caches of old versions are not cleaned up: you may want to delete the base directory once in a while.
+
+Environment variables:
+ - PAX_NUMBA_CACHE_DIR: base directory of the cache (default ~/.cache/pax/numba).
+   If you set NUMBA_CACHE_DIR yourself, we leave numba's cache location alone (and can't add the source hash to it).
+ - PAX_NUMBA_CACHE=0: disable the on-disk cache.
+
+Fill the cache in advance with warm_cache(), or paxer --warm_cache.
+"""
+import glob
+import hashlib
+import logging
+import os
+import sys
+
+import numba
+
+import pax
+from pax import utils
+
+log = logging.getLogger('numba_cache')
+
+
+def get_cache_dir():
+    """Return the directory where we store compiled kernels for this pax, numba and python version"""
+    base_dir = os.environ.get('PAX_NUMBA_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'pax', 'numba'))
+    return os.path.join(base_dir, 'pax%s_numba%s_py%d%d_%s' % (pax.__version__, numba.__version__,
+                                                               sys.version_info[0], sys.version_info[1],
+                                                               kernel_sources_hash()))
+
+
+def kernel_sources_hash():
+    """Return a short hash of the sources of all pax modules which define numba kernels"""
+    h = hashlib.sha1()
+    for path in kernel_modules():
+        with open(path, 'rb') as infile:
+            h.update(infile.read())
+    return h.hexdigest()[:12]
+
+
+def setup_cache():
+    """Point numba's cache to our cache directory. Returns False if caching is disabled or impossible."""
+    if os.environ.get('PAX_NUMBA_CACHE', '1') == '0':
+        return False
+    if os.environ.get('NUMBA_CACHE_DIR'):
+        # The user knows what they are doing
+        return True
+    cache_dir = get_cache_dir()
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+    except OSError:
+        pass
+    if not os.access(cache_dir, os.W_OK):
+        log.warning("Cannot write to numba cache directory %s, pax kernels will be compiled in every process" %
+                    cache_dir)
+        return False
+    # Numba reads this whenever a cached function is defined, so this must happen before any kernels are defined.
+    numba.config.CACHE_DIR = cache_dir
+    return True
+
+
+cache_enabled = setup_cache()
+
+
+def jit(*args, **kwargs):
+    """numba.jit, but caching compiled code on disk (unless disabled, see module docstring)"""
+    kwargs.setdefault('cache', cache_enabled)
+    return numba.jit(*args, **kwargs)
+
+
+def kernel_modules():
+    """Return paths of all pax modules (including the plugins) which define numba kernels"""
+    result = []
+    for pattern in ('*.py', os.path.join('plugins', '*', '*.py'), os.path.join('trigger_plugins', '*.py')):
+        for path in sorted(glob.glob(os.path.join(utils.PAX_DIR, pattern))):
+            with open(path, 'rb') as infile:
+                if b'@jit(' in infile.read():
+                    result.append(path)
+    return result
+
+
+def warm_cache():
+    """Compile all pax kernels with an explicit signature, filling the on-disk cache.
+    Kernels without a signature are compiled (and cached) the first time they are called.
+    Returns list of names of modules loaded.
+    """
+    if not cache_enabled:
+        log.warning("The numba cache is disabled, warming it is pointless.")
+    from pax import core
+    loaded = []
+    for path in kernel_modules():
+        module_dir, module_file = os.path.split(path)
+        module_name = os.path.splitext(module_file)[0]
+        if os.path.basename(os.path.dirname(module_dir)) == 'plugins':
+            # Load plugins like the processor does, so the cache entries match
+            core.load_plugin_module(module_name, [module_dir])
+        elif os.path.basename(module_dir) == 'trigger_plugins':
+            __import__('pax.trigger_plugins.' + module_name)
+        else:
+            __import__('pax.' + module_name)
+        loaded.append(module_name)
+        log.debug("Compiled kernels in %s" % module_name)
+    return loaded
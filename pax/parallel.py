@@ -1,25 +1,41 @@
 from copy import deepcopy
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
+import gc
+import json
 import multiprocessing
 import time
 import traceback
 import pickle
 
 from . import utils, exceptions
-from .core import Processor
-from .configuration import combine_configs
+from .core import Processor, percentile_columns, enable_process_caches
+from .configuration import combine_configs, load_configuration
 
-import psutil
-import rabbitpy
+from prettytable import PrettyTable
 
 try:
     import queue
 except ImportError:
     import Queue as queue
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8: no shared memory, and no out-of-band pickling either
+    shared_memory = None
+
+try:
+    from multiprocessing.connection import wait as wait_for_sentinels
+except ImportError:
+    # Python 2
+    wait_for_sentinels = None
+
 Empty = queue.Empty
 
+# Default maximum number of event blocks waiting on a queue, see Queues.PushToQueue
+DEFAULT_MAX_QUEUE_BLOCKS = 100
+
 # Pax data queue message codes
 REGISTER_PUSHER = -11
 PUSHER_DONE = -12
@@ -38,6 +54,9 @@ class RabbitQueue:
     """
 
     def __init__(self, queue_name, uri=DEFAULT_RABBIT_URI):
+        # Avoid importing rabbitpy until it is needed
+        import rabbitpy
+        self.rabbitpy = rabbitpy
         self.queue_name = queue_name
         self.conn = rabbitpy.Connection(uri)
         self.channel = self.conn.channel()
@@ -46,11 +65,14 @@ class RabbitQueue:
 
     def put(self, message):
         message = pickle.dumps(message)
-        rabbitpy.Message(self.channel, message).publish('', self.queue_name)
-
-    def get(self, **kwargs):
-        """Get an item from the queue. Kwargs are ignored (often used in standard library queue.get calls)"""
-        msg = self.queue.get(acknowledge=False)
+        self.rabbitpy.Message(self.channel, message).publish('', self.queue_name)
+
+    def get(self, block=False, timeout=None):
+        """Get an item from the queue. Unlike the standard library queues, does not block by default.
+        If block=True, waits (for at most timeout seconds) until an item arrives.
+        """
+        # RabbitMQ's basic get can't wait for messages, so we have to poll
+        msg = poll(lambda: self.queue.get(acknowledge=False), timeout=timeout if block else 0)
         if msg is None:
             raise Empty
         return pickle.loads(msg.body)
@@ -63,11 +85,32 @@ class RabbitQueue:
         self.conn.close()
 
 
+def poll(f, timeout=None, max_interval=0.1):
+    """Call f until it returns something other than None, then return that. Returns None if this doesn't happen
+    within timeout seconds (None to wait forever). Polls quickly at first, then at exponentially increasing intervals
+    up to max_interval seconds, so we resume soon after f succeeds without hammering whatever f asks
+    (e.g. a message broker or a queue manager process).
+    """
+    start = time.time()
+    interval = 0.001
+    while True:
+        result = f()
+        if result is not None:
+            return result
+        remaining = float('inf') if timeout is None else timeout - (time.time() - start)
+        if remaining <= 0:
+            return None
+        time.sleep(min(interval, remaining))
+        interval = min(2 * interval, max_interval)
+
+
 class RabbitFanOut(RabbitQueue):
     """A wrapper similar to RabbitQueue for RabbitMQ FanOut exchanges
     """
 
     def __init__(self, exchange_name, uri=DEFAULT_RABBIT_URI):
+        import rabbitpy
+        self.rabbitpy = rabbitpy
         self.conn = rabbitpy.Connection(uri)
         self.channel = self.conn.channel()
         self.exchange = rabbitpy.Exchange(self.channel, exchange_name, exchange_type='fanout')
@@ -78,7 +121,114 @@ class RabbitFanOut(RabbitQueue):
 
     def put(self, message):
         message = pickle.dumps(message)
-        rabbitpy.Message(self.channel, message).publish(self.exchange)
+        self.rabbitpy.Message(self.channel, message).publish(self.exchange)
+
+
+##
+# Shared memory queue for local multiprocessing
+##
+
+DEFAULT_SHM_SLOT_SIZE = 64 * 1024**2   # bytes
+
+
+class SharedMemoryQueue:
+    """A queue for local multiprocessing which passes large buffers (e.g. the pulses' raw_data and the hits arrays)
+    through shared memory, rather than pickling them through the multiprocessing manager process.
+    Behaves like the python standard library queues -- at least the put, get and qsize methods...
+
+    Messages are pickled with protocol 5. Buffers which can be pickled out-of-band (e.g. contiguous numpy arrays)
+    are copied into a free slot of a shared memory segment, so only the pickle header and the buffer sizes
+    go through the (manager) control queue. If no slot is free, put waits until the consumer releases one.
+    Only messages whose buffers don't fit in a slot are pickled in-band and sent through the control queue instead.
+    The consumer copies the buffers out of the slot in one go, then immediately releases the slot.
+    The queue holds at most maxsize messages (0 for no limit), and at most n_slots of them with buffers.
+    """
+
+    def __init__(self, manager, n_slots=8, slot_size=DEFAULT_SHM_SLOT_SIZE, maxsize=0):
+        if shared_memory is None:
+            raise RuntimeError("Shared memory queues require python 3.8 or higher")
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=n_slots * slot_size)
+        self.control = manager.Queue(maxsize)
+        self.free_slots = manager.Queue()
+        for i in range(n_slots):
+            self.free_slots.put(i)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=state['shm'])
+
+    def put(self, message, block=True, timeout=None):
+        """Put message on the queue. Like the standard library queues, waits (for at most timeout seconds) until
+        there is room for it if block=True, and raises queue.Full if there is no room (in time).
+        """
+        buffers = []
+        header = pickle.dumps(message, protocol=5, buffer_callback=buffers.append)
+        buffers = [b.raw() for b in buffers]
+        offsets = aligned_offsets([len(b) for b in buffers])
+
+        if not len(buffers) or offsets[-1] > self.slot_size:
+            if len(buffers):
+                # Too large for a slot: pickle again, now with all buffers in-band
+                header = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+            self.control.put((None, header, None), block=block, timeout=timeout)
+            return
+
+        start_time = time.time()
+        try:
+            slot = self.free_slots.get(block=block, timeout=timeout)
+        except Empty:
+            raise queue.Full
+        if timeout is not None:
+            timeout = max(0, timeout - (time.time() - start_time))
+
+        start = slot * self.slot_size
+        for b, offset in zip(buffers, offsets):
+            self.shm.buf[start + offset:start + offset + len(b)] = b
+        try:
+            self.control.put((slot, header, [len(b) for b in buffers]), block=block, timeout=timeout)
+        except queue.Full:
+            self.free_slots.put(slot)
+            raise
+
+    def get(self, block=True, timeout=None):
+        slot, header, sizes = self.control.get(block=block, timeout=timeout)
+        if slot is None:
+            return pickle.loads(header)
+
+        offsets = aligned_offsets(sizes)
+        start = slot * self.slot_size
+        with self.shm.buf[start:start + offsets[-1]] as slot_view:
+            data = memoryview(bytearray(slot_view))
+        self.free_slots.put(slot)
+        return pickle.loads(header, buffers=[data[offset:offset + size] for offset, size in zip(offsets, sizes)])
+
+    def qsize(self):
+        return self.control.qsize()
+
+    def close(self):
+        """Detach from the shared memory in this process. The segment stays until unlink is called."""
+        self.shm.close()
+
+    def unlink(self):
+        """Destroy the shared memory segment. Call this once, when no process needs the queue anymore."""
+        self.shm.unlink()
+
+
+def aligned_offsets(sizes, alignment=8):
+    """Return offsets at which to store buffers of sizes consecutively, with each buffer aligned to alignment bytes.
+    The last element is the total size needed, so the result has one more element than sizes.
+    """
+    offsets = [0]
+    for size in sizes:
+        offsets.append(offsets[-1] + size + (-size % alignment))
+    return offsets
 
 
 def add_rabbit_command_line_args(parser):
@@ -107,10 +257,16 @@ def url_from_parsed_args(parsed_args):
 ##
 
 
-def multiprocess_configuration(n_cpus, pax_id, base_config_kwargs, processing_queue_kwargs, output_queue_kwargs):
-    """Yields configuration override dicts for multiprocessing"""
+def multiprocess_configuration(n_cpus, pax_id, base_config_kwargs, processing_queue_kwargs, output_queue_kwargs,
+                               worker_numba_threads=1):
+    """Yields configuration override dicts for multiprocessing
+    If the configuration leaves numba_threads at 0 (numba's default, all cores), the workers use worker_numba_threads
+    threads in the multi-threaded kernels instead: otherwise each worker with a large event would use all cores.
+    """
     # Config overrides for child processes
-    common_override = dict(pax=dict(autorun=True, show_progress_bar=False),
+    # The host process makes a single timing report for all processes, see merge_timing_stats
+    common_override = dict(pax=dict(autorun=True, show_progress_bar=False,
+                                    print_timing_report=False, timing_report_file=None),
                            DEFAULT=dict(pax_id=pax_id))
 
     input_override = dict(pax=dict(plugin_group_names=['input', 'output'],
@@ -129,6 +285,8 @@ def multiprocess_configuration(n_cpus, pax_id, base_config_kwargs, processing_qu
                        'Queues.PushToQueue': dict(preserve_ids=True,
                                                   many_to_one=True,
                                                   **output_queue_kwargs)}
+    if load_configuration_from_kwargs(base_config_kwargs)['DEFAULT'].get('numba_threads', 0) == 0:
+        worker_override['DEFAULT'] = dict(numba_threads=worker_numba_threads)
 
     output_override = dict(pax=dict(plugin_group_names=['input', 'output'],
                                     encoder_plugin=None,
@@ -158,7 +316,10 @@ def maybe_multiprocess(args, **config_kwargs):
             url = url_from_parsed_args(args)
             multiprocess_remotely(n_cpus=args.cpus, url=url, **config_kwargs)
         else:
-            multiprocess_locally(n_cpus=args.cpus, **config_kwargs)
+            multiprocess_locally(n_cpus=args.cpus,
+                                 shared_memory_slot_size=int(getattr(args, 'shared_memory', 0) * 1024**2),
+                                 prewarm=getattr(args, 'prewarm', False),
+                                 **config_kwargs)
     else:
         pax_instance = Processor(**config_kwargs)
 
@@ -170,11 +331,36 @@ def maybe_multiprocess(args, **config_kwargs):
             print("Exiting")
 
 
-def multiprocess_locally(n_cpus, **kwargs):
-    # Setup an output and worker queue
+def multiprocess_locally(n_cpus, shared_memory_slot_size=0, prewarm=False, **kwargs):
+    """Process with n_cpus worker processes on this machine, with pax config kwargs (config_names, config_dict, etc).
+    If shared_memory_slot_size > 0, events travel between the processes through a SharedMemoryQueue with slots of
+    this many bytes, instead of being pickled through the manager process.
+    If prewarm, the heavy read-only state of the workers (plugin modules and their compiled numba code, maps, ...)
+    is loaded once in this process, then shared copy-on-write with the worker processes we fork from it.
+    """
+    start_time = utils.perf_counter()
+
+    # Setup an output and worker queue. They hold at most max_queue_blocks blocks: pushers block until there is room.
+    config = load_configuration_from_kwargs(kwargs)
+    push_config = {}
+    for section in ('DEFAULT', 'Queues', 'Queues.PushToQueue'):
+        push_config.update(config.get(section, {}))
+    max_queue_blocks = push_config.get('max_queue_blocks', DEFAULT_MAX_QUEUE_BLOCKS)
+
     manager = multiprocessing.Manager()
-    processing_queue = manager.Queue()
-    output_queue = manager.Queue()
+    if shared_memory_slot_size > 0 and shared_memory is None:
+        print("Shared memory queues require python 3.8 or higher, using ordinary queues instead.")
+        shared_memory_slot_size = 0
+    if shared_memory_slot_size > 0:
+        # Enough slots for every worker to have a block waiting and a block in processing.
+        # Pushers wait for a free slot, so this also limits the number of blocks on each queue.
+        processing_queue = SharedMemoryQueue(manager, n_slots=2 * n_cpus + 2, slot_size=shared_memory_slot_size,
+                                             maxsize=max_queue_blocks)
+        output_queue = SharedMemoryQueue(manager, n_slots=2 * n_cpus + 2, slot_size=shared_memory_slot_size,
+                                         maxsize=max_queue_blocks)
+    else:
+        processing_queue = manager.Queue(max_queue_blocks)
+        output_queue = manager.Queue(max_queue_blocks)
 
     # Initialize the various worker processes
     running_workers = []
@@ -183,34 +369,68 @@ def multiprocess_locally(n_cpus, **kwargs):
                                          pax_id='local',
                                          base_config_kwargs=kwargs,
                                          processing_queue_kwargs=dict(queue=processing_queue),
-                                         output_queue_kwargs=dict(queue=output_queue))
-
-    for process_type, config_kwargs in configs:
-        w = start_safe_processor(manager, **config_kwargs)
-        w.process_type = process_type
-        running_workers.append(w)
-
-    # Check the health / status of the workers every second.
-    while len(running_workers):
-        time.sleep(1)
-
-        # Filter out only the running workers
-        p_by_status = group_by_status(running_workers)
-        running_workers = p_by_status['running']
-
-        if len(p_by_status['crashed']):
-            for p in running_workers:
-                p.terminate()
-            exctype, traceback = get_exception_from_process(p_by_status['crashed'][0])
-            raise exctype("Pax multiprocessing crashed due to exception in one of the workers. Dumping traceback:\n" +
-                          traceback)
+                                         output_queue_kwargs=dict(queue=output_queue),
+                                         # Divide the cores over the workers
+                                         worker_numba_threads=max(1, multiprocessing.cpu_count() // n_cpus))
+
+    mp_context = None
+    if prewarm:
+        if not hasattr(multiprocessing, 'get_context'):
+            # Python 2 always forks on unix, and can't do anything else
+            mp_context = multiprocessing
+        else:
+            mp_context = multiprocessing.get_context('fork')
 
-        status_line(running_workers, processing_queue, output_queue)
+    try:
+        prewarmed = False
+        try:
+            for process_type, config_kwargs in configs:
+                if prewarm and not prewarmed and process_type == 'worker':
+                    prewarm_processor(config_kwargs)
+                    prewarmed = True     # Once is enough
+                w = start_safe_processor(manager, mp_context=mp_context, **config_kwargs)
+                w.process_type = process_type
+                running_workers.append(w)
+        finally:
+            if prewarmed:
+                # The workers have their copies now. Processors started later in this process shouldn't share
+                # the cached state, and it should be garbage collected again once nothing uses it.
+                enable_process_caches(False)
+                if hasattr(gc, 'unfreeze'):
+                    gc.unfreeze()
+        all_workers = running_workers[:]
+
+        # Check the health / status of the workers every second, or as soon as one exits.
+        while len(running_workers):
+            wait_for_exit(running_workers, timeout=1)
+
+            # Filter out only the running workers
+            p_by_status = group_by_status(running_workers)
+            running_workers = p_by_status['running']
+
+            if len(p_by_status['crashed']):
+                for p in running_workers:
+                    p.terminate()
+                exctype, traceback = get_exception_from_process(p_by_status['crashed'][0])
+                raise exctype("Pax multiprocessing crashed due to exception in one of the workers. "
+                              "Dumping traceback:\n" + traceback)
+
+            status_line(running_workers, processing_queue, output_queue)
+
+    finally:
+        for q in (processing_queue, output_queue):
+            if isinstance(q, SharedMemoryQueue):
+                q.close()
+                q.unlink()
+
+    timing_stats = [(w.process_type, w.shared_dict.get('timing_stats')) for w in all_workers]
+    report_timing_stats(timing_stats, (utils.perf_counter() - start_time) * 1000, kwargs)
 
 
 def multiprocess_remotely(n_cpus=2, pax_id=None, url=DEFAULT_RABBIT_URI,
                           startup_queue_name='pax_startup', crash_watch_fanout_name='pax_crashes',
                           **kwargs):
+    start_time = utils.perf_counter()
     manager = multiprocessing.Manager()
     if pax_id is None:
         pax_id = 'pax_%s' % utils.randomstring(6)
@@ -237,10 +457,12 @@ def multiprocess_remotely(n_cpus=2, pax_id=None, url=DEFAULT_RABBIT_URI,
             # Endpoints start as local processes
             w = start_safe_processor(manager, **config_kwargs)
             w.pax_id = pax_id
+            w.process_type = process_type
             local_paxes.append(w)
         else:
             # Workers start as remote processes
             startup_queue.put((pax_id, config_kwargs))
+    all_local_paxes = local_paxes[:]
 
     # Check the health / status of the workers every second.
     while len(local_paxes):
@@ -251,6 +473,162 @@ def multiprocess_remotely(n_cpus=2, pax_id=None, url=DEFAULT_RABBIT_URI,
 
         status_line(local_paxes, processing_queue, output_queue)
 
+    # The remote workers sent their timing stats to the output process, along with their last events
+    timing_stats = []
+    for w in all_local_paxes:
+        stats = w.shared_dict.get('timing_stats')
+        timing_stats.append((w.process_type, stats))
+        if w.process_type == 'output' and stats is not None:
+            timing_stats.extend([('worker', x) for x in stats['upstream']])
+    report_timing_stats(timing_stats, (utils.perf_counter() - start_time) * 1000, kwargs)
+
+
+def load_configuration_from_kwargs(config_kwargs):
+    """Return the pax configuration for the Processor kwargs config_kwargs (config_names, config_dict, etc),
+    without looking in the runs database.
+    """
+    return load_configuration(**{k: v for k, v in config_kwargs.items()
+                                 if k in ('config_names', 'config_paths', 'config_string', 'config_dict')})
+
+
+def prewarm_processor(config_kwargs):
+    """Load the heavy read-only state a Processor with config_kwargs needs in this process:
+    plugin modules (with their numba functions), maps and pattern files, noise data, etc.
+    We do this by initializing a processor with the same configuration, but without its input and output plugins
+    (which would connect to queues, open files, etc). Processes forked from this process afterwards find everything
+    in the module and resource caches, which we enable in this process (see core.enable_process_caches).
+    Once the processes are forked, multiprocess_locally disables the caches again, and undoes the gc.freeze below.
+    """
+    enable_process_caches()
+    config_kwargs = config_kwargs.copy()
+    config = load_configuration_from_kwargs(config_kwargs)
+    config_kwargs['config_dict'] = combine_configs(
+        {k: v.copy() for k, v in config_kwargs.get('config_dict', {}).items()},
+        dict(pax=dict(autorun=False,
+                      plugin_group_names=[g for g in config['pax']['plugin_group_names']
+                                          if g not in ('input', 'output')])))
+    processor = Processor(**config_kwargs)
+    # Only the state the processor loaded into the caches is needed
+    del processor
+
+    # Move everything loaded so far out of the garbage collector's sight: otherwise the collector's bookkeeping writes
+    # to the pages holding the objects, which forces the forked processes to make their own copy of them.
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def report_timing_stats(timing_stats, wall_time, config_kwargs):
+    """Print and/or dump the merged timing_stats of all processes, as the pax configuration specifies.
+    timing_stats is a list of (process_type, timing_stats) tuples, wall_time the total time in msec the processing took.
+    """
+    config = load_configuration_from_kwargs(config_kwargs)
+    merged = merge_timing_stats(timing_stats, wall_time)
+    if config['pax']['print_timing_report']:
+        print("\n" + make_merged_timing_report(merged))
+    timing_file = config['pax'].get('timing_report_file', None)
+    if timing_file is not None:
+        with open(timing_file, mode='w') as outfile:
+            json.dump(merged, outfile, indent=4)
+
+
+def merge_timing_stats(timing_stats, wall_time):
+    """Merge the timing stats (see Processor.get_timing_stats) of several processes into one dictionary
+    timing_stats is a list of (process_type, timing_stats) tuples. Processes which sent no stats (e.g. because they
+    crashed) are ignored. wall_time is the total time in msec the processing took.
+    """
+    process_types = OrderedDict()
+    plugins = OrderedDict()
+    for process_type, stats in timing_stats:
+        if stats is None:
+            continue
+        busy_time = sum([p['total_time_taken'] for p in stats['plugins']])
+        waiting_time = sum([p['time_waiting'] for p in stats['plugins']])
+        pt = process_types.setdefault(process_type, dict(n_processes=0, events_processed=0,
+                                                         busy_time=0, waiting_time=0, run_time=0))
+        pt['n_processes'] += 1
+        pt['events_processed'] += stats['events_processed']
+        pt['busy_time'] += busy_time
+        pt['waiting_time'] += waiting_time
+        pt['run_time'] += stats['run_time']
+
+        for p in stats['plugins']:
+            key = (process_type, p['name'])
+            timing = utils.LatencyHistogram.from_dict(p['timing'])
+            if key not in plugins:
+                plugins[key] = dict(process_type=process_type, name=p['name'], n_processes=0,
+                                    total_time_taken=0, time_waiting=0, timing=timing)
+            else:
+                plugins[key]['timing'].merge(timing)
+            plugins[key]['n_processes'] += 1
+            plugins[key]['total_time_taken'] += p['total_time_taken']
+            plugins[key]['time_waiting'] += p['time_waiting']
+
+    for pt in process_types.values():
+        # Fraction of the time the processes of this type were busy, rather than waiting on a queue
+        pt['utilization'] = pt['busy_time'] / pt['run_time'] if pt['run_time'] > 0 else 0
+
+    total_busy_time = sum([p['total_time_taken'] for p in plugins.values()])
+    for p in plugins.values():
+        p['cpu_share'] = p['total_time_taken'] / total_busy_time if total_busy_time > 0 else 0
+        p['timing'] = p['timing'].to_dict()
+
+    # Every event passes through the output process, so that counts the events for the whole chain.
+    if 'output' in process_types:
+        events_processed = process_types['output']['events_processed']
+    else:
+        events_processed = sum([pt['events_processed'] for pt in process_types.values()])
+
+    return dict(wall_time=wall_time,
+                events_processed=events_processed,
+                events_per_second=1000 * events_processed / wall_time if wall_time > 0 else 0,
+                process_types=process_types,
+                plugins=list(plugins.values()))
+
+
+def make_merged_timing_report(merged):
+    """Return a human-readable report (string) of the output of merge_timing_stats"""
+    result = "Processed %d events in %0.1f s: %0.2f events/s\n" % (
+        merged['events_processed'], merged['wall_time'] / 1000, merged['events_per_second'])
+
+    process_report = PrettyTable(['Process', '#', 'Events', 'Busy (s)', 'Waiting (s)', 'Busy %'])
+    process_report.align = "r"
+    process_report.align["Process"] = "l"
+    for process_type, pt in merged['process_types'].items():
+        process_report.add_row([process_type,
+                                pt['n_processes'],
+                                pt['events_processed'],
+                                round(pt['busy_time'] / 1000, 1),
+                                round(pt['waiting_time'] / 1000, 1),
+                                round(100 * pt['utilization'], 1)])
+    result += str(process_report) + "\n"
+    if len(merged['process_types']):
+        bottleneck = max(merged['process_types'].items(), key=lambda x: x[1]['utilization'])[0]
+        result += "Busiest process type (likely bottleneck): %s\n" % bottleneck
+
+    plugin_report = PrettyTable(['Process', 'Plugin', 'CPU %', '/event (ms)', 'Waiting (s)',
+                                 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'max (ms)'])
+    plugin_report.align = "r"
+    plugin_report.align["Process"] = "l"
+    plugin_report.align["Plugin"] = "l"
+    for p in merged['plugins']:
+        timing = utils.LatencyHistogram.from_dict(p['timing'])
+        plugin_report.add_row([p['process_type'],
+                               p['name'],
+                               round(100 * p['cpu_share'], 1),
+                               round(p['total_time_taken'] / timing.n, 1) if timing.n else 0,
+                               round(p['time_waiting'] / 1000, 1)] + percentile_columns(timing))
+    result += str(plugin_report)
+    return result
+
+
+def wait_for_exit(processes, timeout):
+    """Wait until one of the multiprocessing.Process'es in processes exits, or for timeout seconds"""
+    if wait_for_sentinels is None:
+        time.sleep(timeout)
+    else:
+        wait_for_sentinels([p.sentinel for p in processes], timeout=timeout)
+
 
 def status_line(local_processes, processing_queue, output_queue):
     # Uncomment to diagnose memory leak issues. Don't give me the lecture about commented code being unnecessary
@@ -338,11 +716,15 @@ def group_by_status(plist):
     return result
 
 
-def start_safe_processor(manager, **kwargs):
+def start_safe_processor(manager, mp_context=None, **kwargs):
     """Start a processor with kwargs in a new process. Return multiprocessing.Process instance, with
-    dict with shared info in the shared_dict attribute."""
+    dict with shared info in the shared_dict attribute.
+    mp_context is the multiprocessing context (e.g. multiprocessing.get_context('fork')) to use, default is the default.
+    """
     shared_dict = manager.dict()
-    w = multiprocessing.Process(target=safe_processor, args=[shared_dict], kwargs=kwargs)
+    if mp_context is None:
+        mp_context = multiprocessing
+    w = mp_context.Process(target=safe_processor, args=[shared_dict], kwargs=kwargs)
     w.start()
     w.shared_dict = shared_dict
     return w
@@ -354,7 +736,9 @@ def safe_processor(shared_dict, **kwargs):
         # import cProfile
         # import os
         # cProfile.runctx('Processor(**kwargs)', globals(), locals(), 'profile-%s.out' % os.getpid())
-        Processor(**kwargs)
+        p = Processor(**kwargs)
+        # Let the host process know how we spent our time, so it can make a report for all processes
+        shared_dict['timing_stats'] = p.get_timing_stats()
     except Exception as e:
         shared_dict['exception_type'] = e.__class__.__name__
         shared_dict['traceback'] = traceback.format_exc()
@@ -381,6 +765,7 @@ def get_mem_usage(pid):
     Returns 0 if process does not exist (anymore).
     Maintains a cache to make sure this is not polled more than once per second
     """
+    import psutil
     try:
         return psutil.Process(pid).memory_info().rss / 1e6
     except psutil.NoSuchProcess:
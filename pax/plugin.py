@@ -12,9 +12,10 @@ import os
 from time import strftime
 
 import numpy as np
+import six
 import pax    # for version
-from pax import dsputils
-from pax.datastructure import Event, ReconstructedPosition, Peak
+from pax import dsputils, utils
+from pax.datastructure import Event, ReconstructedPosition, PeakTable
 
 
 class BasePlugin(object):
@@ -27,6 +28,8 @@ class BasePlugin(object):
         self.processor = processor
         self.log = logging.getLogger(self.name)
         self.total_time_taken = 0   # Total time in msec spent in this plugin
+        self.timing = utils.LatencyHistogram()      # Distribution of time spent per event
+        self.time_waiting = 0       # Time in msec spent waiting on other processes (e.g. on queues), not included above
         self.config = config_values
         self._pre_startup()
         y = self.startup()
@@ -68,6 +71,14 @@ class InputPlugin(BasePlugin):
         """Iterate over all events in the data source"""
         raise NotImplementedError
 
+    def get_event_blocks(self):
+        """Iterate over lists of events ("blocks") from the data source.
+        By default every event is its own block. Input plugins which receive events in natural groups
+        (e.g. Queues.PullFromQueue) should override this, so plugins with a batched hook get the whole group at once.
+        """
+        for event in self.get_events():
+            yield [event]
+
 
 class ProcessPlugin(BasePlugin):
     """Plugin that can process events"""
@@ -97,6 +108,38 @@ class ProcessPlugin(BasePlugin):
     def _process_event(self, event):
         raise NotImplementedError
 
+    def process_events(self, events):
+        """Process a list of events at once. Returns list of processed events.
+        If the plugin does not implement a batched hook (see has_batched_hook), each event is passed through
+        process_event in turn.
+        """
+        if not self.has_batched_hook():
+            return [self.process_event(event) for event in events]
+
+        if self.do_input_check:
+            for event in events:
+                if not isinstance(event, Event):
+                    raise RuntimeError("%s received a %s instead of an Event" % (self.name, type(event)))
+        if len(events):
+            event_range = '%s-%s' % (events[0].event_number, events[-1].event_number)
+            self.log = EventLoggingAdapter(self._log, dict(event_number=event_range))
+        if self.has_shut_down:
+            raise RuntimeError("%s was asked to process events, but it has already shut down!" % self.name)
+
+        events = self._process_events(events)
+        if self.do_output_check:
+            for event in events:
+                if not isinstance(event, Event):
+                    raise RuntimeError("%s returned a %s instead of an event." % (self.name, type(event)))
+        return events
+
+    def has_batched_hook(self):
+        """Return True if this plugin overrides a hook that processes several events at once"""
+        return False
+
+    def _process_events(self, events):
+        raise NotImplementedError
+
 
 class TransformPlugin(ProcessPlugin):
 
@@ -104,9 +147,21 @@ class TransformPlugin(ProcessPlugin):
         """Do your magic. Return event"""
         raise NotImplementedError
 
+    def transform_events(self, events):
+        """Do your magic on a list of events (e.g. a block from a queue). Return list of events.
+        Override this (in addition to transform_event) if your plugin can vectorize across events.
+        """
+        return [self.transform_event(event) for event in events]
+
+    def has_batched_hook(self):
+        return overrides(self, TransformPlugin, 'transform_events')
+
     def _process_event(self, event):
         return self.transform_event(event)
 
+    def _process_events(self, events):
+        return self.transform_events(events)
+
 
 class OutputPlugin(ProcessPlugin):
 
@@ -134,17 +189,46 @@ class OutputPlugin(ProcessPlugin):
         """
         raise NotImplementedError
 
+    def write_events(self, events):
+        """Write a list of events (e.g. a block from a queue). Return None.
+        Override this (in addition to write_event) if your plugin can write several events at once.
+        """
+        for event in events:
+            self.write_event(event)
+
+    def has_batched_hook(self):
+        return overrides(self, OutputPlugin, 'write_events')
+
     def _process_event(self, event):
         result = self.write_event(event)
         if result is not None:
             raise RuntimeError("%s returned a %s instead of None" % (self.name, type(event)))
         return event
 
+    def _process_events(self, events):
+        result = self.write_events(events)
+        if result is not None:
+            raise RuntimeError("%s returned a %s instead of None" % (self.name, type(result)))
+        return events
+
 
 class ClusteringPlugin(TransformPlugin):
-    """Base class for peak building / clustering plugins"""
+    """Base class for peak building / clustering plugins
+    Peaks made by build_peak are rows in a PeakTable, which is compacted (dropping the peaks which did not make it
+    into event.peaks) after each event. Each event needs a new table: if you override transform_event, start it
+    with self.peak_table = None (build_peak then makes a new one when needed).
+    """
+    peak_table = None
+
+    def _process_event(self, event):
+        event = self.transform_event(event)
+        event.get_peak_table()
+        # Don't keep the table alive until the next event
+        self.peak_table = None
+        return event
 
     def transform_event(self, event):
+        self.peak_table = None
         self.event = event
         new_peaks = []
         for peak in event.peaks:
@@ -167,7 +251,9 @@ class ClusteringPlugin(TransformPlugin):
         """
         hits.sort(order='left_central')     # Hits must always be in sorted time order
 
-        peak = Peak(detector=detector, hits=hits, **kwargs)
+        if self.peak_table is None:
+            self.peak_table = PeakTable(self.config['n_channels'])
+        peak = self.peak_table.append(detector=detector, hits=hits, **kwargs)
 
         peak.area_per_channel = dsputils.count_hits_per_channel(peak, self.config, weights=hits['area'])
         peak.n_contributing_channels = np.sum(peak.does_channel_contribute)
@@ -243,6 +329,12 @@ class PosRecPlugin(TransformPlugin):
         raise NotImplementedError
 
 
+def overrides(plugin_instance, base_class, method_name):
+    """Return True if plugin_instance's class overrides method_name of base_class"""
+    return (six.get_unbound_function(getattr(plugin_instance.__class__, method_name)) is not
+            six.get_unbound_function(getattr(base_class, method_name)))
+
+
 class EventLoggingAdapter(logging.LoggerAdapter):
     """Prepends event number to log messages
     Adapted from https://docs.python.org/3.4/howto/logging-cookbook.html#context-info
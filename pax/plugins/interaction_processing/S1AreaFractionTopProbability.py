@@ -110,7 +110,7 @@ class S1AreaFractionTopProbability(plugin.TransformPlugin):
 
     def startup(self):
         aftmap_filename = utils.data_file_name('s1_aft_xyz_XENON1T_06Mar2017.json')
-        self.aft_map = InterpolatingMap(aftmap_filename)
+        self.aft_map = utils.cached_resource(InterpolatingMap, aftmap_filename)
         self.low_pe_threshold = 10  # below this in PE, transition to hits
 
     def transform_event(self, event):
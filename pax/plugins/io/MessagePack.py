@@ -9,7 +9,7 @@ class EncodeMessagePack(WriteZippedEncoder):
 
     def encode_event(self, event):
         event_dict = event.to_dict(fields_to_ignore=self.config['fields_to_ignore'],
-                                   convert_numpy_arrays_to='bytes')
+                                   convert_numpy_arrays_to='buffer')
         return msgpack.packb(event_dict, use_single_float=self.config.get('use_single_float', False))
 
 
@@ -20,4 +20,4 @@ class DecodeMessagePack(ReadZippedDecoder):
         # MessagePack returns byte keys, which we can't pass as keyword arguments
         # Unfortunately we have to duplicate this code in data_model too
         event_dict = {k.decode('ascii'): v for k, v in event_dict.items()}
-        return datastructure.Event(**event_dict)
+        return datastructure.Event.from_decoded_dict(event_dict)
@@ -1,8 +1,11 @@
 import time
 import heapq
 
+import numpy as np
+
 from pax import plugin, utils, exceptions, datastructure
-from pax.parallel import queue, RabbitQueue, NO_MORE_EVENTS, REGISTER_PUSHER, PUSHER_DONE, DEFAULT_RABBIT_URI
+from pax.parallel import queue, poll, RabbitQueue, NO_MORE_EVENTS, REGISTER_PUSHER, PUSHER_DONE, DEFAULT_RABBIT_URI
+from pax.parallel import DEFAULT_MAX_QUEUE_BLOCKS
 
 
 def get_queue_from_config(config):
@@ -16,6 +19,28 @@ def get_queue_from_config(config):
                            config.get('queue_url', DEFAULT_RABBIT_URI))
 
 
+def event_size(event):
+    """Return the approximate size in bytes of the data in event (raw data and hits), or in the data of an EventProxy
+    Used for sizing event blocks, so doesn't need to be exact.
+    """
+    if isinstance(event, datastructure.EventProxy):
+        return data_size(event.data)
+    return sum([p.raw_data.nbytes for p in event.pulses]) + event.all_hits.nbytes
+
+
+def data_size(x):
+    """Return the total size in bytes of the arrays and byte strings in x, which may be (nested in) a dict or list"""
+    if isinstance(x, np.ndarray):
+        return x.nbytes
+    elif isinstance(x, (bytes, bytearray)):
+        return len(x)
+    elif isinstance(x, dict):
+        return sum([data_size(v) for v in x.values()])
+    elif isinstance(x, (list, tuple)):
+        return sum([data_size(v) for v in x])
+    return 0
+
+
 class PullFromQueue(plugin.InputPlugin):
     # We may get eventproxies rather than real events
     do_output_check = False
@@ -27,23 +52,29 @@ class PullFromQueue(plugin.InputPlugin):
         # NB! If you enable this, you must GUARANTEE no other process will be consuming from this queue
         # (otherwise there will be holes in the event block ids, triggering an infinite wait)
         self.ordered_pull = self.config.get('ordered_pull', False)
-        self.time_slept_since_last_response = 0
+        self.last_response_time = utils.perf_counter()
         self.block_heap = []
         self.pushers = []
+        self.pusher_timing_stats = []
 
         # If no message has been received for this amount of seconds, crash.
         self.timeout_after_sec = self.config.get('timeout_after_sec', float('inf'))
         self.max_blocks_on_heap = self.config.get('max_blocks_on_heap', 250)
 
     def get_block(self):
-        """Get a block of events from the queue, or raise queue.Empty if no events are available
+        """Get a block of events from the queue, or raise queue.Empty if no events arrive within a second
         """
         if self.no_more_events:
             # There are no more events.
             # There could be stuff left on the queue, but then it's a None = NoMoreEvents message for other consumers.
             raise queue.Empty
 
-        head, body = self.queue.get(block=True, timeout=1)
+        # Time spent waiting for a message shouldn't count for the timing report
+        self.total_time_taken += self.processor.timer.punch()
+        try:
+            head, body = self.queue.get(block=True, timeout=1)
+        finally:
+            self.time_waiting += self.processor.timer.punch()
 
         if head == NO_MORE_EVENTS:
             # The last event has been popped from the queue. Push None back on the queue for
@@ -62,8 +93,15 @@ class PullFromQueue(plugin.InputPlugin):
 
         elif head == PUSHER_DONE:
             # A pusher just proclaimed it will no longer push events
-            self.pushers.remove(body)
-            self.log.debug("Removed pusher: %s. %d remaining pushers" % (body, len(self.pushers)))
+            # It usually also sends the timing information of its processor, so we can make a report on all processes
+            # involved, even if they run on another machine.
+            if isinstance(body, tuple):
+                pusher_name, timing_stats = body
+                self.pusher_timing_stats.append(timing_stats)
+            else:
+                pusher_name = body
+            self.pushers.remove(pusher_name)
+            self.log.debug("Removed pusher: %s. %d remaining pushers" % (pusher_name, len(self.pushers)))
             if not len(self.pushers):
                 # No pushers left, stop processing once there are no more events.
                 # This assumes all pushers will register before the first one is done!
@@ -76,6 +114,14 @@ class PullFromQueue(plugin.InputPlugin):
         return block_id, event_block
 
     def get_events(self):
+        for event_block in self.get_event_blocks():
+            for event in event_block:
+                self.log.debug("Yielding event number %d" % event.event_number)
+                yield event
+
+    def get_event_blocks(self):
+        """Yield the event blocks from the queue, so plugins with a batched hook can process an entire block at once
+        """
         block_heap = self.block_heap
         block_id = -1
 
@@ -107,7 +153,7 @@ class PullFromQueue(plugin.InputPlugin):
                 else:
                     block_id, event_block = self.get_block()
 
-                self.time_slept_since_last_response = 0
+                self.last_response_time = utils.perf_counter()
 
             except queue.Empty:
                 if self.no_more_events and not len(block_heap):
@@ -115,17 +161,21 @@ class PullFromQueue(plugin.InputPlugin):
                     # We're done, no more events!
                     break
 
-                # The queue is empty so we must wait for the next event / The event we wan't hasn't arrived on the heap.
-                self.log.debug("Found empty queue, no more events is %s, len block heap is %s, sleeping for 1 sec" % (
+                # No block arrived for a second / The event we wan't hasn't arrived on the heap.
+                # get_block already waited for the queue, so we can just try again.
+                self.log.debug("Found empty queue, no more events is %s, len block heap is %s" % (
                     self.no_more_events, len(block_heap)))
                 if len(block_heap) > 0.3 * self.max_blocks_on_heap:
                     self.log.warning("%d blocks on heap, will crash if more than %d" % (len(block_heap),
                                                                                         self.max_blocks_on_heap))
-
-                time.sleep(1)
-                self.processor.timer.last_t = time.time()    # Time spent idling shouldn't count for the timing report
-                self.time_slept_since_last_response += 1
-                if self.time_slept_since_last_response > self.timeout_after_sec:
+                if self.no_more_events:
+                    # get_block won't even look at the queue anymore, but the block we want hasn't arrived.
+                    # This shouldn't happen; wait until we time out rather than spinning.
+                    time.sleep(1)
+
+                # Time spent idling shouldn't count for the timing report
+                self.time_waiting += self.processor.timer.punch()
+                if utils.perf_counter() - self.last_response_time > self.timeout_after_sec:
                     raise exceptions.QueueTimeoutException(
                         "Waited for more than %s seconds to receive events; "
                         "lost confidence they will ever come." % self.timeout_after_sec)
@@ -133,11 +183,9 @@ class PullFromQueue(plugin.InputPlugin):
                 continue
 
             self.log.debug("Now processing block %d, %d events" % (block_id, len(event_block)))
-            for i, event in enumerate(event_block):
-                self.log.debug("Yielding event number %d" % event.event_number)
-                yield event
+            yield event_block
 
-        self.log.debug("Exited get_events loop")
+        self.log.debug("Exited get_event_blocks loop")
 
     def shutdown(self):
         if hasattr(self.queue, 'close'):
@@ -151,7 +199,7 @@ class PushToQueue(plugin.OutputPlugin):
 
     def startup(self):
         self.queue = get_queue_from_config(self.config)
-        self.max_queue_blocks = self.config.get('max_queue_blocks', 100)
+        self.max_queue_blocks = self.config.get('max_queue_blocks', DEFAULT_MAX_QUEUE_BLOCKS)
         self.max_block_size = self.config.get('event_block_size', 10)
         self.preserve_ids = self.config.get('preserve_ids', False)
         self.many_to_one = self.config.get('many_to_one', False)
@@ -165,18 +213,44 @@ class PushToQueue(plugin.OutputPlugin):
             self.pusher_name = utils.randomstring(20)
             self.queue.put((REGISTER_PUSHER, self.pusher_name))
 
+        # Adaptive block sizing: end a block once its events reach target_block_bytes (of raw data),
+        # or once producing its events took target_block_time seconds, whichever comes first.
+        # Blocks always have between min_event_block_size and max_event_block_size events.
+        # If neither target is given, all blocks have event_block_size events.
+        # Only applies if we set the block ids ourselves: with preserve_ids, we push on the blocks as we got them.
+        self.target_block_bytes = self.config.get('target_block_bytes', None)
+        self.target_block_time = self.config.get('target_block_time', None)
+        self.adaptive = not self.preserve_ids and (self.target_block_bytes is not None or
+                                                   self.target_block_time is not None)
+        if self.adaptive:
+            self.min_block_size = self.config.get('min_event_block_size', 1)
+            self.max_block_size = self.config.get('max_event_block_size', 1000)
+        self.current_block_bytes = 0
+        self.current_block_start = utils.perf_counter()
+
         self.current_block = []
         self.current_block_id = 0
 
+    def write_events(self, events):
+        """Write a list of events. With preserve_ids, these are the events of one or more complete blocks
+        we received from upstream (see Processor.process_events), so we can push them on immediately.
+        """
+        for event in events:
+            self.write_event(event)
+        if self.preserve_ids:
+            self.send_block()
+
     def write_event(self, event):
         if self.preserve_ids:
             # Someone else already set the block ids. Good for us.
             assert event.block_id >= 0    # Datastructure default is -1, if we see that here we are in big doodoo
             if event.block_id != self.current_block_id:
-                # A change in the block id must always be just after sending a block
-                # otherwise the pax chain is using inconsistent event block sizes
-                assert len(self.current_block) == 0
+                # A new block has started. Blocks can have different sizes (e.g. due to adaptive block sizing
+                # upstream), so we only know a block is complete once we see an event from the next one.
+                self.send_block()
                 self.current_block_id = event.block_id
+            self.current_block.append(event)
+            return
 
         else:
             # We are responsible for setting the block id's.
@@ -189,36 +263,77 @@ class PushToQueue(plugin.OutputPlugin):
                 event.block_id = self.current_block_id
 
         self.current_block.append(event)
-        # Send events once the max block size is reached. Do not wait until event with next id arrives:
+        if self.adaptive:
+            self.current_block_bytes += event_size(event)
+        # Send events once the block is complete. Do not wait until event with next id arrives:
         # that can take forever if we're doing low-rate processing with way to much cores.
-        if len(self.current_block) == self.max_block_size:
+        if self.block_complete():
             self.send_block()
 
-            # If we're setting the id's, from now on, we have to set with the next number
-            if not self.preserve_ids:
-                self.current_block_id += 1
+            # From now on, we have to set ids with the next number
+            self.current_block_id += 1
+
+    def block_complete(self):
+        n = len(self.current_block)
+        if not self.adaptive:
+            return n >= self.max_block_size
+        if n < self.min_block_size:
+            return False
+        if n >= self.max_block_size:
+            return True
+        if self.target_block_bytes is not None and self.current_block_bytes >= self.target_block_bytes:
+            return True
+        if self.target_block_time is not None and \
+                utils.perf_counter() - self.current_block_start >= self.target_block_time:
+            return True
+        return False
 
     def send_block(self):
         """Sends the current block if it has any events in it, then resets the current block to []
         Does NOT change self.current_block_id!
         """
-        seconds_slept_with_queue_full = 0
         if len(self.current_block):
-            while self.queue.qsize() >= self.max_queue_blocks:
-                self.log.info("Max queue size %d reached, waiting to push block" % self.max_queue_blocks)
-                seconds_slept_with_queue_full += 1
-                time.sleep(1)
-                if seconds_slept_with_queue_full >= self.timeout_after_sec:
-                    raise exceptions.QueueTimeoutException(
-                        "Blocked from pushing to the queue for more than %s seconds; "
-                        "lost confidence we will ever be able to." % self.timeout_after_sec)
-            self.queue.put((self.current_block_id, self.current_block))
+            self.put_block((self.current_block_id, self.current_block))
         self.current_block = []
+        self.current_block_bytes = 0
+        self.current_block_start = utils.perf_counter()
+
+    def put_block(self, message):
+        """Put message on the queue, waiting (for at most timeout_after_sec seconds) while the queue is full"""
+        if self.try_put(message, timeout=0):
+            return
+        # Time spent blocked on a full queue shouldn't count for the timing report
+        self.total_time_taken += self.processor.timer.punch()
+        self.log.info("Queue is full, waiting to push block")
+        if not self.try_put(message, timeout=self.timeout_after_sec):
+            raise exceptions.QueueTimeoutException(
+                "Blocked from pushing to the queue for more than %s seconds; "
+                "lost confidence we will ever be able to." % self.timeout_after_sec)
+        self.time_waiting += self.processor.timer.punch()
+
+    def try_put(self, message, timeout):
+        """Put message on the queue if there is room for it within timeout seconds. Returns whether we did.
+        Local queues are bounded (see parallel.multiprocess_locally), so we just block on them until there is room.
+        RabbitMQ queues can't block, so there we poll until the queue holds less than max_queue_blocks blocks.
+        """
+        if isinstance(self.queue, RabbitQueue):
+            if poll(lambda: True if self.queue.qsize() < self.max_queue_blocks else None, timeout=timeout) is None:
+                return False
+            self.queue.put(message)
+            return True
+        try:
+            if timeout == 0:
+                self.queue.put(message, block=False)
+            else:
+                self.queue.put(message, timeout=None if timeout == float('inf') else timeout)
+        except queue.Full:
+            return False
+        return True
 
     def shutdown(self):
         self.send_block()
         if self.many_to_one:
-            self.queue.put((PUSHER_DONE, self.pusher_name))
+            self.queue.put((PUSHER_DONE, (self.pusher_name, self.processor.get_timing_stats())))
         else:
             self.queue.put((NO_MORE_EVENTS, None))
         if hasattr(self.queue, 'close'):
@@ -84,15 +84,17 @@ class EncodeROOTClass(plugin.TransformPlugin):
         instance python object
         Returns nothing: modifies root_objetc in place
         """
-        obj_name = python_object.__class__.__name__
+        obj_name = python_object.get_output_class().__name__
         fields_to_ignore = self.config['fields_to_ignore']
-        list_field_info = python_object.get_list_field_info()
+        schema = python_object.__class__.get_field_schema()
+        list_field_info = schema.list_field_info
 
         for field_name, field_value in python_object.get_fields_data():
             if field_name in fields_to_ignore:
                 continue
 
-            elif isinstance(field_value, list) or field_name in self.config['structured_array_fields']:
+            kind = schema.kinds[field_name]
+            if kind == 'list' or field_name in self.config['structured_array_fields']:
                 # Collection field -- recursively initialize collection elements
                 if field_name in self.config['structured_array_fields']:
                     # Convert the entries from numpy structured array to ordinary pax data models
@@ -115,7 +117,7 @@ class EncodeROOTClass(plugin.TransformPlugin):
                     root_vector.push_back(element_root_object)
                 self.last_collection[element_model_name] = field_value
 
-            elif isinstance(field_value, np.ndarray):
+            elif kind in ('array', 'structured_array'):
                 # Unfortunately we can't store numpy arrays directly into ROOT's ROOT.PyXXXBuffer.
                 # Doing so will not give an error, but the data will be mangled!
                 # Instead we have to use python's old array module...
@@ -137,7 +139,7 @@ class EncodeROOTClass(plugin.TransformPlugin):
 
     def _get_index(self, py_object):
         """Return index of py_object in last collection of models of corresponding type seen in event"""
-        return self.last_collection[py_object.__class__.__name__].index(py_object)
+        return self.last_collection[py_object.get_output_class().__name__].index(py_object)
 
     def get_root_type(self, field_name, python_type):
         if field_name in self.config['force_types']:
@@ -147,7 +149,7 @@ class EncodeROOTClass(plugin.TransformPlugin):
     def _build_model_class(self, model):
         """Return ROOT C++ class definition corresponding to instance of data_model.Model
         """
-        model_name = model.__class__.__name__
+        model_name = model.get_output_class().__name__
         self.log.debug('Building ROOT class for %s' % model_name)
 
         list_field_info = model.get_list_field_info()
@@ -312,10 +314,12 @@ class ReadROOTClass(plugin.InputPlugin):
         """Sets attribute values of py_object to corresponding values in root_object
         Returns nothing (modifies py_object in place)
         """
+        schema = py_object.__class__.get_field_schema()
         for field_name, default_value in py_object.get_fields_data():
 
             if field_name in fields_to_ignore:
                 continue
+            kind = schema.kinds[field_name]
 
             try:
                 root_value = getattr(root_object, field_name)
@@ -333,8 +337,8 @@ class ReadROOTClass(plugin.InputPlugin):
                                           for fn in dtype.names])
                                    for x in root_value], dtype=dtype)
 
-            elif isinstance(default_value, list):
-                child_class_name = py_object.get_list_field_info()[field_name].__name__
+            elif kind == 'list':
+                child_class_name = schema.list_field_info[field_name].__name__
                 result = []
                 for child_i in range(len(root_value)):
                     child_py_object = getattr(datastructure, child_class_name)()
@@ -343,7 +347,7 @@ class ReadROOTClass(plugin.InputPlugin):
                                                  fields_to_ignore)
                     result.append(child_py_object)
 
-            elif isinstance(default_value, np.ndarray):
+            elif kind in ('array', 'structured_array'):
                 try:
                     if not len(root_value):
                         # Empty! no point to assign the value. Errors for
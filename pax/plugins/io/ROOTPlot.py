@@ -88,7 +88,7 @@ class ROOTWaveformDisplay(plugin.OutputPlugin):
             waveform = event.get_sum_waveform(w['internal_name'])
             h = ROOT.TH1D("g", titlestring, len(sum_waveform_x), 0,
                           self.samples_to_us*(len(sum_waveform_x)-1))
-            for i, s in enumerate(waveform.samples):
+            for i, s in enumerate(waveform.get_samples(0, event.length() - 1)):
                 h.SetBinContent(i, s)
             h.SetStats(0)
             h.GetXaxis().SetTitle("Time [#mus]")
@@ -196,7 +196,7 @@ class TableWriter(plugin.OutputPlugin):
         :param index_fields: list of (index_field_name, value) tuples denoting multi-index trail
         """
         # List to contain data from this model, will be made into tuple later
-        m_name = m.__class__.__name__
+        m_name = m.get_output_class().__name__
         m_indices = [x[1] for x in index_fields]
         m_data = []
 
@@ -213,15 +213,17 @@ class TableWriter(plugin.OutputPlugin):
             }
             first_time_seen = True
 
+        schema = m.__class__.get_field_schema()
         for field_name, field_value in m.get_fields_data():
 
             if field_name in self.config['fields_to_ignore']:
                 continue
 
-            if isinstance(field_value, list):
+            kind = schema.kinds[field_name]
+            if kind == 'list':
                 # This is a model collection field.
                 # Get its type (can't get from the list itself, could be empty)
-                child_class_name = m.get_list_field_info()[field_name]
+                child_class_name = schema.list_field_info[field_name]
 
                 # Store the absolute start index & number of children
                 child_start = self.get_index_of(child_class_name)
@@ -241,10 +243,10 @@ class TableWriter(plugin.OutputPlugin):
                 # appended to the index trail
                 for new_index, child_model in enumerate(field_value):
                     self._model_to_tuples(child_model,
-                                          index_fields + [(type(child_model).__name__,
+                                          index_fields + [(child_model.get_output_class().__name__,
                                                            new_index)])
 
-            elif isinstance(field_value, np.ndarray) and field_value.dtype.names is not None:
+            elif kind == 'structured_array':
                 # Hey this is already a structured array :-) Treat like a collection field (except don't recurse)
                 if field_name not in self.data:
                     self.data[field_name] = {
@@ -259,7 +261,7 @@ class TableWriter(plugin.OutputPlugin):
                 for element in field_value.tolist():
                     self.data[field_name]['tuples'].append(tuple(m_indices + list(element)))
 
-            elif isinstance(field_value, np.ndarray) and not self.output_format.supports_array_fields:
+            elif kind == 'array' and not self.output_format.supports_array_fields:
                 # Hack for formats without array field support: NumpyArrayFields must get their own dataframe
                 #  -- assumes field names are unique!
                 # dataframe columns = str(positions in the array) ('0', '1', '2', ...)
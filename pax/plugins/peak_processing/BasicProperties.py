@@ -1,57 +1,59 @@
 import numpy as np
-# import numba
+import numba
+from pax.numba_cache import jit
 
-from pax import plugin, dsputils
+from pax import plugin
+from pax.datastructure import Hit
 
 
 class BasicProperties(plugin.TransformPlugin):
     """Computes basic properties of each peak, based on the hits.
+    Properties of all peaks are computed at once, on the columns of the event's peak table and the concatenated hits
+    of all peaks.
     """
 
-    def transform_event(self, event):
-        first_top_ch = np.min(np.array(self.config['channels_top']))
-        last_top_ch = np.max(np.array(self.config['channels_top']))
+    def startup(self):
+        self.first_top_ch = np.min(np.array(self.config['channels_top']))
+        self.last_top_ch = np.max(np.array(self.config['channels_top']))
 
-        for peak in event.peaks:
-            # area, area_per_channel, left, right are already computed in ClusterPlugin.build_peak
-            # lone hit marking is also done there already.
-            hits = peak.hits
-            if len(hits) == 0:
-                raise ValueError("Can't compute properties of an empty peak!")
-
-            peak.hits_per_channel = dsputils.count_hits_per_channel(peak, self.config).astype(np.int16)
-            n_saturated_tot = hits['n_saturated'].sum()
-            if n_saturated_tot:
-                peak.n_saturated_per_channel = dsputils.count_hits_per_channel(
-                    peak, self.config, weights=hits['n_saturated']).astype(np.int16)
-            else:
-                peak.n_saturated_per_channel = np.zeros(self.config['n_channels'], dtype=np.int16)
-
-            peak.mean_amplitude_to_noise = np.average(hits['height']/hits['noise_sigma'], weights=hits['area'])
-
-            peak.n_hits = np.sum(peak.hits_per_channel)
-            peak.n_saturated_samples = np.sum(peak.n_saturated_per_channel)
-            peak.n_saturated_channels = len(np.where(peak.n_saturated_per_channel)[0])
-
-            # Compute top fraction
-            peak.area_fraction_top = np.sum(peak.area_per_channel[first_top_ch:last_top_ch + 1]) / peak.area
-            peak.hits_fraction_top = np.sum(peak.hits_per_channel[first_top_ch:last_top_ch + 1]) / peak.n_hits
-
-            # Compute timing quantities
-            peak.hit_time_mean, peak.hit_time_std = weighted_mean_variance(hits['center'], hits['area'])
-            peak.hit_time_std **= 0.5  # Convert variance to std
-            peak.n_contributing_channels_top = np.sum((peak.area_per_channel[first_top_ch:last_top_ch + 1] > 0))
-
-            # Store some properties of the largest hit
-            largest_hit_i = np.argmax(hits['area'])
-            peak.largest_hit_area = hits[largest_hit_i]['area']
-            peak.largest_hit_channel = hits[largest_hit_i]['channel']
+    def transform_event(self, event):
+        peaks = event.get_peak_table()
+        if not len(peaks):
+            return event
+
+        # area, area_per_channel, left, right are already computed in ClusterPlugin.build_peak
+        # lone hit marking is also done there already.
+        hits_per_peak = peaks.objects['hits']
+        n_hits = np.array([len(hits) for hits in hits_per_peak], dtype=np.int64)
+        if not np.all(n_hits):
+            raise ValueError("Can't compute properties of an empty peak!")
+        peak_start = np.concatenate(([0], np.cumsum(n_hits))).astype(np.int64)
+
+        hits_per_channel = peaks.hits_per_channel
+        n_saturated_per_channel = peaks.n_saturated_per_channel
+        compute_peak_hit_properties(np.concatenate(hits_per_peak), peak_start,
+                                    hits_per_channel, n_saturated_per_channel,
+                                    peaks.mean_amplitude_to_noise, peaks.hit_time_mean, peaks.hit_time_std,
+                                    peaks.largest_hit_area, peaks.largest_hit_channel)
+
+        peaks.n_hits[:] = hits_per_channel.sum(axis=1)
+        peaks.n_saturated_samples[:] = n_saturated_per_channel.sum(axis=1)
+        peaks.n_saturated_channels[:] = np.sum(n_saturated_per_channel != 0, axis=1)
+
+        # Compute top fraction
+        top = slice(self.first_top_ch, self.last_top_ch + 1)
+        area_per_channel_top = peaks.area_per_channel[:, top]
+        peaks.area_fraction_top[:] = area_per_channel_top.sum(axis=1) / peaks.area
+        peaks.hits_fraction_top[:] = hits_per_channel[:, top].sum(axis=1) / peaks.n_hits
+        peaks.n_contributing_channels_top[:] = np.sum(area_per_channel_top > 0, axis=1)
 
         return event
 
 
 class SumWaveformProperties(plugin.TransformPlugin):
-    """Computes properties based on the hits-only sum waveform"""
+    """Computes properties based on the hits-only sum waveform.
+    The properties of all peaks in a detector are computed in one call of compute_sum_waveform_properties.
+    """
 
     def startup(self):
         self.dt = dt = self.config['sample_duration']
@@ -59,74 +61,51 @@ class SumWaveformProperties(plugin.TransformPlugin):
         self.tight_coincidence_samples = self.config['tight_coincidence_window'] // dt
         if not self.wv_field_len % 2:
             raise ValueError('peak_waveform_length must be an even multiple of the sample size')
+        self.fractions_desired = np.linspace(0, 1, 21)
 
     def transform_event(self, event):
-        dt = self.dt
-        field_length = self.wv_field_len
-        for peak in event.peaks:
-            peak.sum_waveform = np.zeros(field_length, dtype=peak.sum_waveform.dtype)
-            peak.sum_waveform_top = np.zeros(field_length, dtype=peak.sum_waveform.dtype)
-
-            # Get the waveform (in pe/bin) and compute basic sum-waveform derived properties
-            w = event.get_sum_waveform(peak.detector).samples[peak.left:peak.right + 1]
-
-            if w.sum() == 0:
-                self.log.warning("Sum waveform of peak %d-%d (%0.2f pe area) in detector %s sums to zero! "
-                                 "Cannot compute sum waveform properties for this peak. If you see this, "
-                                 "there is either a bug in pax, or you are using a negative low_threshold for "
-                                 "the hitfinder (so a peak can have <=0 area) and you have very bad luck." %
-                                 (peak.left, peak.right, peak.area, peak.detector))
-                continue
-
-            # Center of gravity in the hits-only sum waveform. Identical to peak.hit_time_mean...
-            # We may remove one from the data structure, but it's a useful sanity check
-            # (particularly since some hits got removed in the noise rejection)
-
-            # Don't weigh negative samples for computation of center of gravity
-            weights = np.clip(w, 0, float('inf'))
-            if not np.sum(weights) > 0:
-                self.log.warning("Sum waveform of peak %d-%d (%0.2f pe area) sums to a nonpositive value... unusual!"
-                                 " Cannot align peak's sum waveform, storing zeros instead." % (peak.left,
-                                                                                                peak.right, peak.area))
-                peak.center_time = float('nan')
-                continue
-            else:
-                peak.center_time = (peak.left + np.average(np.arange(len(w)),
-                                                           weights=weights)) * dt
-
-            # Index in peak waveform nearest to center of gravity (for sum-waveform alignment)
-            cog_idx = int(round(peak.center_time / dt)) - peak.left
-            # Index of the peak's maximum
-            max_idx = np.argmax(w)
-            peak.index_of_maximum = peak.left + max_idx
-            # Amplitude at the maximum
-            peak.height = w[max_idx]
-
-            # Compute area decile points
-            # TODO: reactivate tests after refactor
-            area_times = np.ones(21) * float('nan')
-            integrate_until_fraction(w, fractions_desired=np.linspace(0, 1, 21), results=area_times)
-            area_times *= dt
-            area_midpoint = area_times[10]
-
-            # Before storing area midpoint, convert to time in event
-            peak.area_midpoint = area_midpoint + peak.left * dt
-
-            # Store widths and rise times
-            peak.range_area_decile = area_times[10:] - area_times[10::-1]
-            peak.area_decile_from_midpoint = area_times[::2] - area_midpoint
-
-            # Compute a tight coincidence count (useful for distinguishing S1s from junk)
-            x = peak.hits['index_of_maximum']
-            l = peak.index_of_maximum - self.tight_coincidence_samples
-            r = peak.index_of_maximum + self.tight_coincidence_samples
-            peak.tight_coincidence = len(np.unique(peak.hits['channel'][(x >= l) & (x <= r)]))
-
-            # Store the waveform; for tpc also store the top waveform
-            put_w_in_center_of_field(w, peak.sum_waveform, cog_idx)
-            if peak.detector == 'tpc':
-                put_w_in_center_of_field(event.get_sum_waveform('tpc_top').samples[peak.left:peak.right + 1],
-                                         peak.sum_waveform_top, cog_idx)
+        peaks = event.get_peak_table()
+        n_peaks = len(peaks)
+        if not n_peaks:
+            return event
+
+        hits_per_peak = peaks.objects['hits']
+        peak_hit_start = np.concatenate(([0], np.cumsum([len(hits) for hits in hits_per_peak]))).astype(np.int64)
+        hits = np.concatenate(hits_per_peak)
+
+        sum_waveforms = np.zeros((n_peaks, self.wv_field_len), dtype=np.float32)
+        sum_waveforms_top = np.zeros((n_peaks, self.wv_field_len), dtype=np.float32)
+        status = np.zeros(n_peaks, dtype=np.int64)
+
+        detectors = np.array(peaks.objects['detector'])
+        for detector in np.unique(detectors):
+            # For tpc peaks, we also store the top waveform
+            w = event.get_sum_waveform(detector)
+            w_top = event.get_sum_waveform('tpc_top') if detector == 'tpc' else w
+            args = ((np.where(detectors == detector)[0], peaks.left, peaks.right, hits, peak_hit_start) +
+                    (w.samples,) + w.get_intervals() + (w_top.samples,) + w_top.get_intervals() +
+                    (detector == 'tpc', self.fractions_desired, float(self.dt), float(self.tight_coincidence_samples),
+                     self.config['n_channels'], status,
+                     peaks.center_time, peaks.index_of_maximum, peaks.height, peaks.area_midpoint,
+                     peaks.range_area_decile, peaks.area_decile_from_midpoint, peaks.tight_coincidence,
+                     sum_waveforms, sum_waveforms_top))
+            compute_sum_waveform_properties(*args)
+
+        peaks.objects['sum_waveform'][:] = list(sum_waveforms)
+        peaks.objects['sum_waveform_top'][:] = list(sum_waveforms_top)
+
+        for peak_i in np.where(status == SUM_WAVEFORM_ZERO)[0]:
+            peak = peaks[peak_i]
+            self.log.warning("Sum waveform of peak %d-%d (%0.2f pe area) in detector %s sums to zero! "
+                             "Cannot compute sum waveform properties for this peak. If you see this, "
+                             "there is either a bug in pax, or you are using a negative low_threshold for "
+                             "the hitfinder (so a peak can have <=0 area) and you have very bad luck." %
+                             (peak.left, peak.right, peak.area, peak.detector))
+        for peak_i in np.where(status == SUM_WAVEFORM_NONPOSITIVE)[0]:
+            peak = peaks[peak_i]
+            self.log.warning("Sum waveform of peak %d-%d (%0.2f pe area) sums to a nonpositive value... unusual!"
+                             " Cannot align peak's sum waveform, storing zeros instead." % (peak.left,
+                                                                                            peak.right, peak.area))
 
         return event
 
@@ -142,20 +121,110 @@ class CountCoincidentNoisePulses(plugin.TransformPlugin):
         return event
 
 
-# @numba.jit(numba.void(numba.float32[:], numba.float64[:], numba.float64[:]),
-#            nopython=True, cache=True)
-# For some reason numba doesn't clean up its memory properly for this function... leave it in python for now
+# Status codes of peaks whose sum waveform properties could not be computed, see compute_sum_waveform_properties
+SUM_WAVEFORM_ZERO = 1
+SUM_WAVEFORM_NONPOSITIVE = 2
+
+
+@jit(nopython=True)
+def _block_sum(a, start, n, zero):
+    """Return the sum of a[start:start + n] (n <= 128) in the type of zero, as numpy's pairwise summation does it"""
+    if n < 8:
+        result = zero
+        for i in range(start, start + n):
+            result += a[i]
+        return result
+    r0 = zero + a[start]
+    r1 = zero + a[start + 1]
+    r2 = zero + a[start + 2]
+    r3 = zero + a[start + 3]
+    r4 = zero + a[start + 4]
+    r5 = zero + a[start + 5]
+    r6 = zero + a[start + 6]
+    r7 = zero + a[start + 7]
+    end = start + n - n % 8
+    for i in range(start + 8, end, 8):
+        r0 += a[i]
+        r1 += a[i + 1]
+        r2 += a[i + 2]
+        r3 += a[i + 3]
+        r4 += a[i + 4]
+        r5 += a[i + 5]
+        r6 += a[i + 6]
+        r7 += a[i + 7]
+    result = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+    for i in range(end, start + n):
+        result += a[i]
+    return result
+
+
+@jit(nopython=True)
+def _pairwise_sum(a, start, n, zero):
+    """Return the sum of a[start:start + n], in the type of zero, adding the elements in the same order as numpy's
+    pairwise summation does for a contiguous array. So we get exactly the same result as numpy's sum.
+    Numpy splits the array in two (at a multiple of 8) until blocks have at most 128 elements, then adds up the
+    sums of the halves. We walk the same tree with explicit stacks rather than recursion.
+    """
+    if n <= 128:
+        return _block_sum(a, start, n, zero)
+    node_start = np.zeros(128, dtype=np.int64)
+    node_n = np.zeros(128, dtype=np.int64)
+    node_split = np.zeros(128, dtype=np.bool_)
+    values = np.full(128, zero)
+    node_start[0] = start
+    node_n[0] = n
+    n_nodes = 1
+    n_values = 0
+    while n_nodes:
+        i = n_nodes - 1
+        if node_n[i] <= 128:
+            values[n_values] = _block_sum(a, node_start[i], node_n[i], zero)
+            n_values += 1
+            n_nodes -= 1
+        elif not node_split[i]:
+            node_split[i] = True
+            n2 = node_n[i] // 2
+            n2 -= n2 % 8
+            # Push the right half first, so the left half is summed first
+            for child_start, child_n in ((node_start[i] + n2, node_n[i] - n2), (node_start[i], n2)):
+                node_start[n_nodes] = child_start
+                node_n[n_nodes] = child_n
+                node_split[n_nodes] = False
+                n_nodes += 1
+        else:
+            # Both halves are done
+            values[n_values - 2] = values[n_values - 2] + values[n_values - 1]
+            n_values -= 1
+            n_nodes -= 1
+    return values[0]
+
+
+@jit(nopython=True)
+def _buffered_pairwise_sum(a, start, n, zero):
+    """Like _pairwise_sum, for sums in which numpy has to cast the elements (e.g. float32 array summed as float64):
+    numpy then sums buffers of 8192 elements pairwise, and adds up the results.
+    """
+    result = zero
+    for block_start in range(start, start + n, 8192):
+        result += _pairwise_sum(a, block_start, min(8192, start + n - block_start), zero)
+    return result
+
+
+@jit(numba.void(numba.float32[:], numba.float64[:], numba.float64[:]),
+     nopython=True, error_model='numpy')
 def integrate_until_fraction(w, fractions_desired, results):
     """For array of fractions_desired, integrate w until fraction of area is reached, place sample index in results
     Will add last sample needed fractionally.
     eg. if you want 25% and a sample takes you from 20% to 30%, 0.5 will be added.
     Assumes fractions_desired is sorted and all in [0, 1]!
+    The area and fractions are float32, as they were when this was done in python with numpy scalars.
     """
-    area_tot = w.sum()
-    fraction_seen = 0
+    area_tot = _pairwise_sum(w, 0, len(w), np.float32(0))
+    fraction_seen = np.float32(0)
     current_fraction_index = 0
     needed_fraction = fractions_desired[current_fraction_index]
-    for i, x in enumerate(w):
+    for i in range(len(w)):
+        x = w[i]
         # How much of the area is in this sample?
         fraction_this_sample = x/area_tot
         # Will this take us over the fraction we seek?
@@ -178,6 +247,7 @@ def integrate_until_fraction(w, fractions_desired, results):
         raise RuntimeError("Fraction not reached in waveform? What the ...?")
 
 
+@jit(nopython=True)
 def put_w_in_center_of_field(w, field, center_index):
     """Stores (part of) the array w in a fixed length array field, with center_index in field's center.
     Assumes field has odd length.
@@ -187,28 +257,196 @@ def put_w_in_center_of_field(w, field, center_index):
         raise ValueError("put_w_in_center_of_field requires an odd field length (so center is clear)")
     field_center = int(field_length/2)      # Index of center of field
 
+    # Part of w to store
+    w_start = 0
+    w_stop = len(w)
+
     left_overhang = center_index - field_center
     if left_overhang > 0:
         # Chop off the left overhang
-        w = w[left_overhang:]
+        w_start = left_overhang
         center_index -= left_overhang
-        assert center_index == field_center
 
-    right_overhang = len(w) - field_length + (field_center - center_index)
+    right_overhang = w_stop - w_start - field_length + (field_center - center_index)
     if right_overhang > 0:
         # Chop off any remaining right overhang
-        w = w[:len(w)-right_overhang]
+        w_stop -= right_overhang
 
     start_idx = field_center - center_index
-    field[start_idx:start_idx + len(w)] = w
-
-
-def weighted_mean_variance(values, weights):
+    field[start_idx:start_idx + w_stop - w_start] = w[w_start:w_stop]
+
+
+@jit(numba.void(numba.from_dtype(Hit.get_dtype())[:], numba.int64[:],
+                numba.int16[:, :], numba.int16[:, :],
+                numba.float64[:], numba.float64[:], numba.float64[:],
+                numba.float64[:], numba.int64[:]),
+     nopython=True, error_model='numpy')
+def compute_peak_hit_properties(hits, peak_start,
+                                hits_per_channel, n_saturated_per_channel,
+                                mean_amplitude_to_noise, hit_time_mean, hit_time_std,
+                                largest_hit_area, largest_hit_channel):
+    """Compute the properties of all peaks which depend only on their hits, and store them in the other arguments
+    (peak table columns). The hits of peak i are hits[peak_start[i]:peak_start[i + 1]].
+    Means and the hit time std are weighted by hit area.
+    """
+    for peak_i in range(len(peak_start) - 1):
+        start = peak_start[peak_i]
+        stop = peak_start[peak_i + 1]
+        hits_per_channel[peak_i, :] = 0
+        n_saturated_per_channel[peak_i, :] = 0
+        sum_area = 0.0
+        sum_amplitude_to_noise = 0.0
+        sum_center = 0.0
+        largest_hit_i = start
+        for hit_i in range(start, stop):
+            hit = hits[hit_i]
+            hits_per_channel[peak_i, hit.channel] += 1
+            n_saturated_per_channel[peak_i, hit.channel] += hit.n_saturated
+            sum_area += hit.area
+            sum_amplitude_to_noise += hit.height / hit.noise_sigma * hit.area
+            sum_center += hit.center * hit.area
+            if hit.area > hits[largest_hit_i].area:
+                largest_hit_i = hit_i
+        if sum_area == 0:
+            raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+
+        mean = sum_center / sum_area
+        variance = 0.0
+        for hit_i in range(start, stop):
+            variance += (hits[hit_i].center - mean) ** 2 * hits[hit_i].area
+        variance /= sum_area
+
+        mean_amplitude_to_noise[peak_i] = sum_amplitude_to_noise / sum_area
+        hit_time_mean[peak_i] = mean
+        hit_time_std[peak_i] = variance ** 0.5
+        largest_hit_area[peak_i] = hits[largest_hit_i].area
+        largest_hit_channel[peak_i] = hits[largest_hit_i].channel
+
+
+@jit(nopython=True)
+def _get_samples(samples, interval_left, interval_right, interval_offset, left, right, buffer):
+    """Return the samples from left to right (inclusive) of a sum waveform, given by its samples and intervals
+    (see SumWaveform.get_intervals): a view of samples if they are in one interval, else buffer filled with them.
     """
-    Return the weighted mean, and the weighted sum square deviation from the weighted mean.
-    values, weights -- Numpy ndarrays with the same shape.
-    Stolen from http://stackoverflow.com/questions/2413522/weighted-standard-deviation-in-numpy
+    n = right - left + 1
+    first_i = np.searchsorted(interval_right, left)
+    if first_i < len(interval_left) and interval_left[first_i] <= left and right <= interval_right[first_i]:
+        start = interval_offset[first_i] + left - interval_left[first_i]
+        return samples[start:start + n]
+
+    w = buffer[:n]
+    w[:] = 0
+    for i in range(first_i, len(interval_left)):
+        if interval_left[i] > right:
+            break
+        l = max(left, interval_left[i])
+        r = min(right, interval_right[i])
+        start = interval_offset[i] + l - interval_left[i]
+        w[l - left:r - left + 1] = samples[start:start + r - l + 1]
+    return w
+
+
+@jit(numba.void(numba.int64[:], numba.int64[:], numba.int64[:],
+                numba.from_dtype(Hit.get_dtype())[:], numba.int64[:],
+                numba.float32[:], numba.int64[:], numba.int64[:], numba.int64[:],
+                numba.float32[:], numba.int64[:], numba.int64[:], numba.int64[:],
+                numba.boolean, numba.float64[:], numba.float64, numba.float64, numba.int64,
+                numba.int64[:], numba.float64[:], numba.int64[:], numba.float64[:],
+                numba.float64[:], numba.float64[:, :], numba.float64[:, :], numba.int64[:],
+                numba.float32[:, :], numba.float32[:, :]),
+     nopython=True, error_model='numpy')
+def compute_sum_waveform_properties(peak_indices, lefts, rights, hits, peak_hit_start,
+                                    samples, interval_left, interval_right, interval_offset,
+                                    top_samples, top_interval_left, top_interval_right, top_interval_offset,
+                                    store_top, fractions_desired, dt, tight_coincidence_samples, n_channels,
+                                    status, center_time, index_of_maximum, height,
+                                    area_midpoint, range_area_decile, area_decile_from_midpoint, tight_coincidence,
+                                    sum_waveform, sum_waveform_top):
+    """Compute the sum waveform properties of the peaks at peak_indices, whose sum waveform (and top sum waveform,
+    stored only if store_top) is given by its samples and intervals (see SumWaveform.get_intervals).
+      - lefts, rights, center_time, ... tight_coincidence: peak table columns
+      - hits, peak_hit_start: hits of all peaks; the hits of peak i are hits[peak_hit_start[i]:peak_hit_start[i + 1]]
+      - sum_waveform, sum_waveform_top: n_peaks * field length arrays of zeros, in which we store the peak waveforms
+      - status: set to SUM_WAVEFORM_ZERO or SUM_WAVEFORM_NONPOSITIVE for peaks whose properties could not be computed
+    Sums are done in the same order as numpy does them (see _pairwise_sum), so results are identical to computing
+    the properties peak by peak with numpy.
     """
-    weighted_mean = np.average(values, weights=weights)
-    weighted_variance = np.average((values-weighted_mean)**2, weights=weights)  # Fast and numerically precise
-    return weighted_mean, weighted_variance
+    # Buffers for all peaks
+    max_length = 1
+    for peak_i in peak_indices:
+        max_length = max(max_length, rights[peak_i] - lefts[peak_i] + 1)
+    w_buffer = np.zeros(max_length, dtype=np.float32)
+    top_buffer = np.zeros(max_length, dtype=np.float32)
+    weights = np.zeros(max_length, dtype=np.float32)
+    weighted_indices = np.zeros(max_length, dtype=np.float64)
+    area_times = np.zeros(len(fractions_desired))
+    midpoint_i = len(fractions_desired) // 2
+    channel_seen = np.zeros(n_channels, dtype=np.bool_)
+
+    for peak_i in peak_indices:
+        left = lefts[peak_i]
+        n = rights[peak_i] - left + 1
+        w = _get_samples(samples, interval_left, interval_right, interval_offset, left, rights[peak_i], w_buffer)
+
+        if _pairwise_sum(w, 0, n, np.float32(0)) == 0:
+            status[peak_i] = SUM_WAVEFORM_ZERO
+            continue
+
+        # Center of gravity in the hits-only sum waveform. Identical to peak.hit_time_mean...
+        # We may remove one from the data structure, but it's a useful sanity check
+        # (particularly since some hits got removed in the noise rejection)
+
+        # Don't weigh negative samples for computation of center of gravity
+        for i in range(n):
+            weights[i] = max(w[i], np.float32(0))
+            weighted_indices[i] = i * weights[i]
+        if not _pairwise_sum(weights, 0, n, np.float32(0)) > 0:
+            status[peak_i] = SUM_WAVEFORM_NONPOSITIVE
+            center_time[peak_i] = np.nan
+            continue
+        center_time[peak_i] = (left + _pairwise_sum(weighted_indices, 0, n, 0.0) /
+                               _buffered_pairwise_sum(weights, 0, n, 0.0)) * dt
+
+        # Index in peak waveform nearest to center of gravity (for sum-waveform alignment)
+        cog_idx = int(np.rint(center_time[peak_i] / dt)) - left
+        # Index of the peak's maximum
+        max_idx = np.argmax(w)
+        index_of_maximum[peak_i] = left + max_idx
+        # Amplitude at the maximum
+        height[peak_i] = w[max_idx]
+
+        # Compute area decile points
+        area_times[:] = np.nan
+        integrate_until_fraction(w, fractions_desired, area_times)
+        for j in range(len(area_times)):
+            area_times[j] *= dt
+        area_midpoint_in_peak = area_times[midpoint_i]
+
+        # Before storing area midpoint, convert to time in event
+        area_midpoint[peak_i] = area_midpoint_in_peak + left * dt
+
+        # Store widths and rise times
+        for j in range(midpoint_i + 1):
+            range_area_decile[peak_i, j] = area_times[midpoint_i + j] - area_times[midpoint_i - j]
+            area_decile_from_midpoint[peak_i, j] = area_times[2 * j] - area_midpoint_in_peak
+
+        # Compute a tight coincidence count (useful for distinguishing S1s from junk):
+        # the number of channels with a hit maximum near the peak's maximum
+        l = index_of_maximum[peak_i] - tight_coincidence_samples
+        r = index_of_maximum[peak_i] + tight_coincidence_samples
+        n_coincident = 0
+        for hit_i in range(peak_hit_start[peak_i], peak_hit_start[peak_i + 1]):
+            x = hits[hit_i].index_of_maximum
+            if l <= x <= r and not channel_seen[hits[hit_i].channel]:
+                channel_seen[hits[hit_i].channel] = True
+                n_coincident += 1
+        for hit_i in range(peak_hit_start[peak_i], peak_hit_start[peak_i + 1]):
+            channel_seen[hits[hit_i].channel] = False
+        tight_coincidence[peak_i] = n_coincident
+
+        # Store the waveform; for tpc also store the top waveform
+        put_w_in_center_of_field(w, sum_waveform[peak_i], cog_idx)
+        if store_top:
+            w_top = _get_samples(top_samples, top_interval_left, top_interval_right, top_interval_offset,
+                                 left, rights[peak_i], top_buffer)
+            put_w_in_center_of_field(w_top, sum_waveform_top[peak_i], cog_idx)
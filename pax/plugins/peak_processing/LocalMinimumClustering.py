@@ -1,93 +1,120 @@
 from pax import plugin, datastructure, dsputils
+from pax.numba_cache import jit
 import numba
 import numpy as np
 import logging
-from pax.plugins.signal_processing.HitFinder import build_hits
+from pax.dsputils import raw_data_types
+from pax.plugins.signal_processing.HitFinder import build_hits_raw, HITS_BUFFER_FULL
 log = logging.getLogger('LocalMinimumClusteringHelpers')
 
 
 class LocalMinimumClustering(plugin.ClusteringPlugin):
+    """Split peaks at significant local minima in their sum waveform, see find_split_points.
+    Hits that straddle a split point are themselves split into two hits. The hits of all peaks in the event are split
+    in one call to split_hits, which writes the new hits into a buffer reused between events.
+    """
+
+    def startup(self):
+        self.adc_to_pe = np.array([dsputils.adc_to_pe(self.config, ch) for ch in range(self.config['n_channels'])],
+                                  dtype=np.float64)
+        self.hits_buffer = np.zeros(0, dtype=datastructure.Hit.get_dtype())
+        self.hit_origin_buffer = np.zeros(0, dtype=np.int64)
+
+    def transform_event(self, event):
+        self.peak_table = None
+        self.event = event
+
+        # Find the split points (sample indices within the peak) of each peak
+        split_peaks = []
+        split_points = []
+        for peak_i, peak in enumerate(event.peaks):
+            points = self.get_split_points(peak)
+            if len(points):
+                self.log.debug("Splitting %d-%d into %d peaks" % (peak.left, peak.right, len(points) + 1))
+                split_peaks.append(peak_i)
+                split_points.append(points)
+        if not split_peaks:
+            return event
+
+        # Split the hits straddling the split points, for all peaks at once
+        hits = np.concatenate([event.peaks[peak_i].hits for peak_i in split_peaks])
+        peak_hit_start = np.cumsum([0] + [len(event.peaks[peak_i].hits) for peak_i in split_peaks]).astype(np.int64)
+        peak_split_start = np.cumsum([0] + [len(points) for points in split_points]).astype(np.int64)
+        event_split_points = np.concatenate([np.array(points, dtype=np.int64) + event.peaks[peak_i].left
+                                             for peak_i, points in zip(split_peaks, split_points)])
+        new_hits, new_peak_hit_start, hit_origin = self.split_peak_hits(hits, peak_hit_start,
+                                                                        event_split_points, peak_split_start)
+
+        # Build the new peaks, and put them where the split peaks were
+        new_peaks = {peak_i: list(self.split_peak(event.peaks[peak_i], points,
+                                                  new_hits[new_peak_hit_start[i]:new_peak_hit_start[i + 1]]))
+                     for i, (peak_i, points) in enumerate(zip(split_peaks, split_points))}
+        event.peaks = [p for peak_i, peak in enumerate(event.peaks) for p in new_peaks.get(peak_i, [peak])]
 
-    def cluster_peak(self, peak):
-        if peak.type == 'lone_hit':
-            return [peak]
-        w = self.event.get_sum_waveform(peak.detector).samples[peak.left:peak.right + 1]
-        split_points = list(find_split_points(w,
-                                              min_height=self.config['min_height'],
-                                              min_ratio=self.config.get('min_ratio', 3)))
-        if not len(split_points):
-            return [peak]
-        else:
-            self.log.debug("Splitting %d-%d into %d peaks" % (peak.left, peak.right, len(split_points) + 1))
-            return list(self.split_peak(peak, split_points))
-
-    def finalize_event(self):
         # Update the event.all_hits field (for plotting), since new hits were created
-        # Note we must separately get out the rejected hits, they are not in any peak...
-        self.event.all_hits = np.concatenate([p.hits for p in self.event.peaks] +
-                                             [self.event.all_hits[self.event.all_hits['is_rejected']]])
-
-        # Restores order after shenanigans here
-        # Important if someone uses (dict_)group_by from recarray tools later
-        # As is done, for example in the hitfinder diagnostic plots... if you don't do this you get really strange
-        # things there (missing hits were things were split, which makes you think there is a bug
-        # in LocalMinimumClustering, but actually there isn't...)
-        self.event.all_hits.sort(order='found_in_pulse')
-
-    def split_peak(self, peak, split_points):
-        """Yields new peaks split from peak at split_points = sample indices within peak
-        Samples at the split points will fall to the right (so if we split [0, 5] on 2, you get [0, 1] and [2, 5]).
-        Hits that straddle a split point are themselves split into two hits: peak.hits is updated.
+        was_split = np.ones(len(hits), dtype=np.bool_)
+        was_split[hit_origin[hit_origin >= 0]] = False
+        self.replace_hits(hits[was_split], new_hits[hit_origin < 0])
+        return event
+
+    def get_split_points(self, peak):
+        """Return list of sample indices within peak at which peak should be split"""
+        if peak.type == 'lone_hit':
+            return []
+        w = self.event.get_sum_waveform(peak.detector).get_samples(peak.left, peak.right)
+        return list(find_split_points(w,
+                                      min_height=self.config['min_height'],
+                                      min_ratio=self.config.get('min_ratio', 3)))
+
+    def split_peak_hits(self, hits, peak_hit_start, split_points, peak_split_start):
+        """Split the hits of several peaks at split_points (indices in the event), see split_hits.
+        Returns (new hits, index of the first new hit of each peak, index in hits each new hit was copied from or -1).
+        The new hits are a view of this plugin's buffer, which is reused for the next event.
+        """
+        pulses = self.event.get_pulse_table()
+        if len(self.hits_buffer) < 2 * len(hits):
+            self.hits_buffer = np.zeros(2 * len(hits), dtype=self.hits_buffer.dtype)
+            self.hit_origin_buffer = np.zeros(2 * len(hits), dtype=np.int64)
+        new_peak_hit_start = np.zeros(len(peak_hit_start), dtype=np.int64)
+        piece_buffer = np.zeros(3, dtype=self.hits_buffer.dtype)
+        while True:
+            n_hits = split_hits(hits, peak_hit_start, split_points, peak_split_start,
+                                pulses.samples, pulses.offset, pulses.n_samples, pulses.left, pulses.baseline,
+                                pulses.noise_sigma, self.adc_to_pe, float(self.config['digitizer_reference_baseline']),
+                                float(self.config['sample_duration']),
+                                self.hits_buffer, self.hit_origin_buffer, new_peak_hit_start, piece_buffer)
+            if n_hits != HITS_BUFFER_FULL:
+                break
+            self.log.debug("Hits buffer is full, growing it.")
+            self.hit_origin_buffer = np.zeros(2 * len(self.hits_buffer), dtype=np.int64)
+            self.hits_buffer = np.zeros(2 * len(self.hits_buffer), dtype=self.hits_buffer.dtype)
+        return self.hits_buffer[:n_hits], new_peak_hit_start, self.hit_origin_buffer[:n_hits]
+
+    def replace_hits(self, old_hits, new_hits):
+        """Replace old_hits by new_hits in event.all_hits.
+        event.all_hits is sorted by pulse (see SumWaveform), which other plugins expect, e.g. if they use
+        (dict_)group_by from recarray tools. We insert the new hits where the pulse's hits are, so it stays sorted.
         """
-        # First, split hits that straddle the split points
-        # Hits may have to be split several times; for each split point we modify the 'hits' list, splitting only
-        # the hits we need.
-        hits = peak.hits
-        for x in split_points:
-            x += peak.left   # Convert to index in event
-
-            # Select hits that must be split: start before x and end after it.
-            selection = (hits['left'] <= x) & (hits['right'] > x)
-            hits_to_split = hits[selection]
-
-            # new_hits will be a list of hit arrays, which we concatenate later to make the new 'hits' list
-            # Start with the hits that don't have to be split: we definitely want to retain those!
-            new_hits = [hits[True ^ selection]]
-
-            for h in hits_to_split:
-                pulse_i = h['found_in_pulse']
-                pulse = self.event.pulses[pulse_i]
-
-                # Get the pulse waveform in ADC counts above baseline (because it's what build_hits expect)
-                baseline_to_subtract = self.config['digitizer_reference_baseline'] - pulse.baseline
-                w = baseline_to_subtract - pulse.raw_data.astype(np.float64)
-
-                # Use the hitfinder's build_hits to compute the properties of these hits
-                # Damn this is ugly... but at least we don't have duplicate property computation code
-                hits_buffer = np.zeros(2, dtype=datastructure.Hit.get_dtype())
-                adc_to_pe = dsputils.adc_to_pe(self.config, h['channel'])
-                hit_bounds = np.array([[h['left'], x], [x+1, h['right']]], dtype=np.int64)
-                hit_bounds -= pulse.left   # build_hits expects hit bounds relative to pulse start
-                build_hits(w,
-                           hit_bounds=hit_bounds,
-                           hits_buffer=hits_buffer,
-                           adc_to_pe=adc_to_pe,
-                           channel=h['channel'],
-                           noise_sigma_pe=pulse.noise_sigma * adc_to_pe,
-                           dt=self.config['sample_duration'],
-                           start=pulse.left,
-                           pulse_i=pulse_i,
-                           saturation_threshold=self.config['digitizer_reference_baseline'] - pulse.baseline - 0.5,
-                           central_bounds=hit_bounds)       # TODO: Recompute central bounds in an intelligent way...
-
-                # Remove hits with 0 or negative area (very rare, but possible due to rigid integration bound)
-                hits_buffer = hits_buffer[hits_buffer['area'] > 0]
-
-                new_hits.append(hits_buffer)
-
-            # Now remake the hits list, then go on to the next peak.
-            hits = np.concatenate(new_hits)
+        all_hits = self.event.all_hits
+        if np.any(np.diff(all_hits['found_in_pulse']) < 0):
+            all_hits = np.sort(all_hits, order='found_in_pulse')
 
+        # Hits in the same pulse never start at the same sample
+        def hit_key(hits):
+            return hits['found_in_pulse'].astype(np.int64) * (self.event.length() + 1) + hits['left']
+
+        all_hits = all_hits[True ^ np.in1d(hit_key(all_hits), hit_key(old_hits))]
+        new_hits = new_hits[np.argsort(new_hits['found_in_pulse'], kind='mergesort')]
+        self.event.all_hits = np.insert(all_hits,
+                                        np.searchsorted(all_hits['found_in_pulse'], new_hits['found_in_pulse'],
+                                                        side='right'),
+                                        new_hits)
+
+    def split_peak(self, peak, split_points, hits):
+        """Yields new peaks split from peak at split_points = sample indices within peak, from hits: peak's hits
+        after splitting those that straddle the split points (see split_hits).
+        Samples at the split points will fall to the left (so if we split [0, 5] on 2, you get [0, 2] and [3, 5]).
+        """
         # Next, split the peaks, sorting hits to the right peak by their maximum index.
         # Iterate over left, right bounds of the new peaks
         boundaries = list(zip([0] + [y+1 for y in split_points], split_points + [float('inf')]))
@@ -116,7 +143,94 @@ class LocalMinimumClustering(plugin.ClusteringPlugin):
             yield self.build_peak(hits=hs, detector=peak.detector, left=l, right=r)
 
 
-@numba.jit(nopython=True)
+@jit([numba.int64(numba.from_dtype(datastructure.Hit.get_dtype())[:], numba.int64[:], numba.int64[:], numba.int64[:],
+                  t[:], numba.int64[:], numba.int64[:], numba.int64[:], numba.float64[:],
+                  numba.float64[:], numba.float64[:], numba.float64, numba.float64,
+                  numba.from_dtype(datastructure.Hit.get_dtype())[:], numba.int64[:], numba.int64[:],
+                  numba.from_dtype(datastructure.Hit.get_dtype())[:])
+      for t in raw_data_types],
+     nopython=True)
+def split_hits(hits, peak_hit_start, split_points, peak_split_start,
+               samples, offsets, n_samples, pulse_lefts, baselines,
+               noise_sigmas, adc_to_pe, reference_baseline, dt,
+               result, result_origin, result_peak_start, piece_buffer):
+    """Split the hits of several peaks at split points, and write the resulting hits to result.
+      - hits, peak_hit_start: hits of the peaks. The hits of peak i are hits[peak_hit_start[i]:peak_hit_start[i + 1]]
+      - split_points, peak_split_start: sorted indices in the event at which to split each peak, likewise.
+      - samples, ..., noise_sigmas: PulseTable columns of the pulses the hits were found in
+      - adc_to_pe: per-channel gain conversion factor
+      - piece_buffer: three hits, the last of which must be all zeros
+    For each split point x, the hits of the peak with left <= x < right are split into [left, x] and [x + 1, right].
+    Their properties are computed by build_hits_raw, and pieces with zero or negative area (very rare, but possible due
+    to rigid integration bound) are removed. The other hits are kept in order, the pieces come after them.
+    The hits of peak i are written to result[result_peak_start[i]:result_peak_start[i + 1]]. For each hit in result,
+    result_origin holds the index in hits it was copied from, or -1 for new hits.
+    Returns the number of hits in result, or HITS_BUFFER_FULL if it does not fit in result.
+    """
+    n_result = 0
+    # Bounds, channel and pulse of the hits to split at one split point
+    to_split = np.zeros((len(result), 4), dtype=np.int64)
+    hit_bounds = np.zeros((2, 2), dtype=np.int64)
+
+    for peak_i in range(len(peak_hit_start) - 1):
+        result_peak_start[peak_i] = n_result
+        first_hit = n_result
+        if n_result + peak_hit_start[peak_i + 1] - peak_hit_start[peak_i] > len(result):
+            return HITS_BUFFER_FULL
+        for hit_i in range(peak_hit_start[peak_i], peak_hit_start[peak_i + 1]):
+            result[n_result] = hits[hit_i]
+            result_origin[n_result] = hit_i
+            n_result += 1
+
+        for split_i in range(peak_split_start[peak_i], peak_split_start[peak_i + 1]):
+            x = split_points[split_i]
+
+            # Keep the hits that don't have to be split, remember the ones that do
+            n_kept = first_hit
+            n_to_split = 0
+            for i in range(first_hit, n_result):
+                if result[i].left <= x < result[i].right:
+                    to_split[n_to_split, 0] = result[i].left
+                    to_split[n_to_split, 1] = result[i].right
+                    to_split[n_to_split, 2] = result[i].channel
+                    to_split[n_to_split, 3] = result[i].found_in_pulse
+                    n_to_split += 1
+                else:
+                    result[n_kept] = result[i]
+                    result_origin[n_kept] = result_origin[i]
+                    n_kept += 1
+            n_result = n_kept
+
+            for i in range(n_to_split):
+                if n_result + 2 > len(result):
+                    return HITS_BUFFER_FULL
+                channel = to_split[i, 2]
+                pulse_i = to_split[i, 3]
+                pulse_left = pulse_lefts[pulse_i]
+                # build_hits_raw expects hit bounds relative to pulse start
+                hit_bounds[0, 0] = to_split[i, 0] - pulse_left
+                hit_bounds[0, 1] = x - pulse_left
+                hit_bounds[1, 0] = x + 1 - pulse_left
+                hit_bounds[1, 1] = to_split[i, 1] - pulse_left
+                piece_buffer[0] = piece_buffer[2]
+                piece_buffer[1] = piece_buffer[2]
+                baseline_to_subtract = reference_baseline - baselines[pulse_i]
+                build_hits_raw(samples[offsets[pulse_i]:offsets[pulse_i] + n_samples[pulse_i]],
+                               baseline_to_subtract, 0.0, hit_bounds, piece_buffer[:2],
+                               adc_to_pe[channel], channel, noise_sigmas[pulse_i] * adc_to_pe[channel], dt,
+                               pulse_left, pulse_i, baseline_to_subtract - 0.5,
+                               hit_bounds)   # TODO: Recompute central bounds in an intelligent way...
+                for j in range(2):
+                    if piece_buffer[j].area > 0:
+                        result[n_result] = piece_buffer[j]
+                        result_origin[n_result] = -1
+                        n_result += 1
+
+    result_peak_start[len(peak_hit_start) - 1] = n_result
+    return n_result
+
+
+@jit(nopython=True)
 def find_split_points(w, min_height, min_ratio):
     """"Finds local minima in w,
     whose peaks to the left and right both satisfy:
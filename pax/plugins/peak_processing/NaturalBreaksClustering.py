@@ -1,5 +1,6 @@
 import numpy as np
 import numba
+from pax.numba_cache import jit
 from scipy.interpolate import InterpolatedUnivariateSpline
 
 from pax import plugin, dsputils
@@ -9,8 +10,8 @@ class NaturalBreaksClustering(plugin.ClusteringPlugin):
     """Split peaks by a variation on the 'natural breaks' algorithm.
     Any gaps (distances between hits) in peaks larger than min_gap_size_for_break are tested by computing a
     'goodness of split' for splitting the cluster at that point.
-    If it is larger than min_split_goodness(n_hits), the cluster is split at that gap and the declustering is
-    called recursively for the newly minted clusters.
+    If it is larger than min_split_goodness(n_hits), the cluster is split at that gap, and the newly minted clusters
+    are tested in turn (we keep a stack of clusters still to test, rather than recursing).
 
     The threshold function min_split_goodness(n_hits) has to be chosen so that S1s and S2s are not split up.
     This can be done by simulating them with pax's integrated waveform simulator.
@@ -39,51 +40,76 @@ class NaturalBreaksClustering(plugin.ClusteringPlugin):
 
         self.log.debug("Clustering hits %d-%d" % (hits[0]['center'], hits[-1]['center']))
 
-        # Compute gaps between hits, select large enough gaps to test
-        gaps = dsputils.gaps_between_hits(hits)[1:]            # Remember first "gap" is zero: throw it away
-        selection = gaps > self.config['min_gap_size_for_break'] / self.dt
-        split_indices = np.arange(1, len(gaps) + 1)[selection]
-        gaps = gaps[selection]
-
-        # Look for good split points
-        gos_observed = np.zeros(len(gaps))
-        compute_every_split_goodness(gaps, split_indices,
-                                     hits['center'], hits['sum_absolute_deviation'], hits['area'],
-                                     gos_observed)
-
-        # Find the split point with the largest goodness of split
-        if len(gos_observed):
-            max_split_ii = np.argmax(gos_observed)
-            split_i = split_indices[max_split_ii]
-            split_goodness = gos_observed[max_split_ii]
-            split_threshold = self.min_split_goodness(np.log10(peak.area))
-
-            # Should we split? If so, recurse.
-            if split_goodness > split_threshold:
-                self.log.debug("SPLITTING at %d  (%s > %s)" % (split_i, split_goodness, split_threshold))
-                peak_l = self.build_peak(hits=hits[:split_i],
-                                         detector=peak.detector,
-                                         birthing_split_goodness=split_goodness,
-                                         birthing_split_fraction=np.sum(hits['area'][:split_i]) / peak.area)
-                peak_r = self.build_peak(hits=hits[split_i:],
-                                         detector=peak.detector,
-                                         birthing_split_goodness=split_goodness,
-                                         birthing_split_fraction=np.sum(hits['area'][split_i:]) / peak.area)
-                return self.cluster_peak(peak_l) + self.cluster_peak(peak_r)
+        # Compute gaps between hits, select large enough gaps to test.
+        # Clusters are only split at gaps, so the gaps within a cluster don't depend on hits outside it:
+        # we need to compute them only once.
+        gaps = dsputils.gaps_between_hits(hits)
+        can_split = gaps > self.config['min_gap_size_for_break'] / self.dt
+        can_split[0] = False                        # Remember first "gap" is zero
+
+        # Clusters still to be tested, as (start, stop) indices in hits and kwargs for building their peak.
+        # Instead of recursing, we take clusters from the end of the list, and put the right cluster on the list
+        # before the left one, so the final clusters come out in time order.
+        todo = [(0, n_hits, dict())]
+        result = []
+        while todo:
+            start, stop, peak_kwargs = todo.pop()
+            cluster_hits = hits[start:stop]
+
+            if stop - start > 1:
+                # Look for good split points
+                split_indices = np.where(can_split[start + 1:stop])[0] + 1
+                gos_observed = np.zeros(len(split_indices))
+                compute_every_split_goodness(gaps[start:stop][split_indices], split_indices,
+                                             cluster_hits['center'], cluster_hits['sum_absolute_deviation'],
+                                             cluster_hits['area'],
+                                             gos_observed)
             else:
-                self.log.debug("Proposed split at %d not good enough (%0.3f < %0.3f)" % (
-                    split_i, split_goodness, split_threshold))
+                gos_observed = []
+
+            # Find the split point with the largest goodness of split
+            if len(gos_observed):
+                if start == 0 and stop == n_hits:
+                    area = peak.area
+                else:
+                    # Same as the area build_peak would compute for the cluster
+                    area = np.bincount(cluster_hits['channel'].astype(np.int16), minlength=self.config['n_channels'],
+                                       weights=cluster_hits['area']).sum()
+                max_split_ii = np.argmax(gos_observed)
+                split_i = split_indices[max_split_ii]
+                split_goodness = gos_observed[max_split_ii]
+                split_threshold = self.min_split_goodness(np.log10(area))
 
-            # If we get here, no clustering was needed
-            peak.interior_split_goodness = split_goodness
-            peak.interior_split_fraction = min(np.sum(hits['area'][:max_split_ii]),
-                                               np.sum(hits['area'][max_split_ii:])) / peak.area
+                # Should we split? If so, test the new clusters later.
+                if split_goodness > split_threshold:
+                    self.log.debug("SPLITTING at %d  (%s > %s)" % (split_i, split_goodness, split_threshold))
+                    for cluster_start, cluster_stop in ((start + split_i, stop), (start, start + split_i)):
+                        todo.append((cluster_start, cluster_stop, dict(
+                            birthing_split_goodness=split_goodness,
+                            birthing_split_fraction=np.sum(hits['area'][cluster_start:cluster_stop]) / area)))
+                    continue
+                else:
+                    self.log.debug("Proposed split at %d not good enough (%0.3f < %0.3f)" % (
+                        split_i, split_goodness, split_threshold))
+
+                # If we get here, no clustering was needed
+                peak_kwargs['interior_split_goodness'] = split_goodness
+                peak_kwargs['interior_split_fraction'] = min(np.sum(cluster_hits['area'][:max_split_ii]),
+                                                             np.sum(cluster_hits['area'][max_split_ii:])) / area
+
+            # This is a final cluster: only now build a peak for it
+            if start == 0 and stop == n_hits:
+                for k, v in peak_kwargs.items():
+                    setattr(peak, k, v)
+                result.append(peak)
+            else:
+                result.append(self.build_peak(hits=cluster_hits, detector=peak.detector, **peak_kwargs))
 
-        return [peak]
+        return result
 
 
-@numba.jit(numba.float64(numba.float64[:], numba.float64[:], numba.float64[:]),
-           nopython=True)
+@jit(numba.float64(numba.float64[:], numba.float64[:], numba.float64[:]),
+     nopython=True)
 def _sad_fallback(x, areas, fallback):
     # While there is a one-pass algorithm for variance, I haven't found one for sad.. maybe it doesn't exists
     # First calculate the weighted mean.
@@ -101,8 +127,8 @@ def _sad_fallback(x, areas, fallback):
     return sad
 
 
-@numba.jit(numba.float64(numba.int64, numba.float64[:], numba.float64[:], numba.float64[:]),
-           nopython=True)
+@jit(numba.float64(numba.int64, numba.float64[:], numba.float64[:], numba.float64[:]),
+     nopython=True)
 def compute_split_goodness(split_index, center, deviation, area):
     """Return "goodness of split" for splitting hits >= split_index into right cluster, < into left.
        left, right: left, right indices of hits
@@ -120,15 +146,112 @@ def compute_split_goodness(split_index, center, deviation, area):
     return 1 - numerator / denominator
 
 
-@numba.jit(numba.void(numba.int64[:], numba.int64[:],
-                      numba.float64[:], numba.float64[:], numba.float64[:],
-                      numba.float64[:]),
-           nopython=True)
+@jit(nopython=True)
+def _fenwick_add(tree, i, value):
+    """Add value to element i of the Fenwick tree (binary indexed tree) tree, which has one more entry than elements"""
+    i += 1
+    while i < len(tree):
+        tree[i] += value
+        i += i & -i
+
+
+@jit(nopython=True)
+def _fenwick_sum(tree, n):
+    """Return the sum of the first n elements of the Fenwick tree tree"""
+    result = 0.0
+    while n > 0:
+        result += tree[n]
+        n -= n & -n
+    return result
+
+
+@jit(nopython=True)
+def _prefix_sad_fallback(x, areas, fallback, sizes, results):
+    """Store _sad_fallback of the first sizes[i] elements of x, areas, fallback in results[i], for all (ascending)
+    sizes at once, in O(n log n) time.
+    An element contributes (x - mean) * area if x - fallback > mean, (mean - x) * area if x + fallback < mean,
+    and fallback * area otherwise. So we keep the areas and area-weighted values of the x -/+ fallback of the
+    elements seen so far in Fenwick trees, indexed by their rank, and query those above / below the mean.
+    """
+    n = len(x)
+    hi = x - fallback       # Element is above the mean (contributes x - mean) if hi > mean
+    lo = x + fallback       # Element is below the mean (contributes mean - x) if lo < mean
+    hi_order = np.argsort(hi)
+    lo_order = np.argsort(lo)
+    hi_sorted = hi[hi_order]
+    lo_sorted = lo[lo_order]
+    hi_rank = np.zeros(n, dtype=np.int64)
+    lo_rank = np.zeros(n, dtype=np.int64)
+    for i in range(n):
+        hi_rank[hi_order[i]] = i
+        lo_rank[lo_order[i]] = i
+
+    hi_areas = np.zeros(n + 1)
+    hi_moments = np.zeros(n + 1)
+    lo_areas = np.zeros(n + 1)
+    lo_moments = np.zeros(n + 1)
+    sum_areas = 0.0
+    sum_moments = 0.0
+    sum_fallback = 0.0
+    size_i = 0
+    for i in range(n):
+        if size_i == len(sizes):
+            break
+        _fenwick_add(hi_areas, hi_rank[i], areas[i])
+        _fenwick_add(hi_moments, hi_rank[i], areas[i] * hi[i])
+        _fenwick_add(lo_areas, lo_rank[i], areas[i])
+        _fenwick_add(lo_moments, lo_rank[i], areas[i] * lo[i])
+        sum_areas += areas[i]
+        sum_moments += areas[i] * x[i]
+        sum_fallback += areas[i] * fallback[i]
+
+        while size_i < len(sizes) and sizes[size_i] == i + 1:
+            mean = sum_moments / sum_areas
+            sad = sum_fallback
+
+            # Elements with x - fallback > mean
+            n_below = np.searchsorted(hi_sorted, mean, side='right')
+            area_above = sum_areas - _fenwick_sum(hi_areas, n_below)
+            moment_above = (sum_moments - sum_fallback) - _fenwick_sum(hi_moments, n_below)
+            sad += moment_above - mean * area_above
+
+            # Elements with x + fallback < mean
+            n_below = np.searchsorted(lo_sorted, mean, side='left')
+            sad += mean * _fenwick_sum(lo_areas, n_below) - _fenwick_sum(lo_moments, n_below)
+
+            results[size_i] = sad
+            size_i += 1
+
+
+@jit(numba.void(numba.int64[:], numba.int64[:],
+                numba.float64[:], numba.float64[:], numba.float64[:],
+                numba.float64[:]),
+     nopython=True)
 def compute_every_split_goodness(gaps, split_indices,
                                  center, deviation, area,
                                  results):
-    """Computes the "goodness of split" for several split points: see compute_split_goodness"""
-    for gap_i, gap in enumerate(gaps):
-        # Index of hit to split on = index first hit that will go to right cluster
-        split_i = split_indices[gap_i]
-        results[gap_i] = compute_split_goodness(split_i, center, deviation, area)
+    """Computes the "goodness of split" for several split points: see compute_split_goodness.
+    split_indices must be sorted. Rather than computing the sad of both clusters for each split point, we compute
+    the sads of all left and right clusters in two passes over the hits (see _prefix_sad_fallback).
+    """
+    n = len(center)
+    n_splits = len(split_indices)
+    if n_splits == 0:
+        return
+    for split_i in split_indices:
+        if split_i > n - 1 or split_i <= 0:
+            raise ValueError("Ridiculous split index received!")
+
+    # Shifting the centers doesn't change the sad, but avoids losing precision in the moment sums
+    x = center - center[0]
+
+    left_sad = np.zeros(n_splits)
+    _prefix_sad_fallback(x, area, deviation, split_indices, left_sad)
+
+    # For the right clusters, do the same on the reversed hits
+    right_sad = np.zeros(n_splits)
+    _prefix_sad_fallback(x[::-1], area[::-1], deviation[::-1], n - split_indices[::-1], right_sad)
+
+    denominator = _sad_fallback(center, areas=area, fallback=deviation)
+    for gap_i in range(n_splits):
+        results[gap_i] = 1 - (left_sad[gap_i] + right_sad[n_splits - 1 - gap_i]) / denominator
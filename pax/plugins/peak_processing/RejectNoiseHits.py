@@ -17,6 +17,7 @@ class RejectNoiseHits(plugin.ClusteringPlugin):
         self.base_penalties = {int(k): v for k, v in self.config.get('base_penalties', {}).items()}
 
     def transform_event(self, event):
+        self.peak_table = None
         # Penalty for each noise pulse
         penalty_per_ch = event.noise_pulses_in * self.config['penalty_per_noise_pulse']
 
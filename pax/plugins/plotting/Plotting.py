@@ -210,7 +210,7 @@ class PlotBase(plugin.OutputPlugin):
 
         for w in self.config['waveforms_to_plot']:
             waveform = event.get_sum_waveform(w['internal_name'])
-            wv = (waveform.samples[lefti:righti + 1] + y_offset) * scale
+            wv = (waveform.get_samples(lefti, righti) + y_offset) * scale
             y_min = min(y_min, np.min(wv))
             y_max = max(y_max, np.max(wv))
             ax.plot(xvalues,
@@ -462,7 +462,7 @@ class PlotChannelWaveforms3D(PlotBase):
             )
 
         # Plot the sum waveform
-        w = event.get_sum_waveform('tpc').samples[int(t_start / dt):int(t_end / dt) + 1]
+        w = event.get_sum_waveform('tpc').get_samples(int(t_start / dt), min(int(t_end / dt), event.length() - 1))
         ax.plot(
             np.linspace(t_start, t_end, len(w)) / units.us,
             (channels_end + 1) * np.ones(len(w)),
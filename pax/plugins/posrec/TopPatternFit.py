@@ -129,7 +129,8 @@ class PosRecTopPatternFunctionFit(PosRecTopPatternFit):
         qes = np.array(c['quantum_efficiencies'])
 
         # Change the pattern fitter instance so it uses TPFF
-        self.pf = PatternFitter(filename=utils.data_file_name(c['s2_fitted_patterns_file']),
-                                zoom_factor=c.get('s2_fitted_patterns_zoom_factor', 1),
-                                adjust_to_qe=qes[c['channels_top']],
-                                default_errors=c['relative_qe_error'] + c['relative_gain_error'])
+        self.pf = utils.cached_resource(PatternFitter,
+                                        filename=utils.data_file_name(c['s2_fitted_patterns_file']),
+                                        zoom_factor=c.get('s2_fitted_patterns_zoom_factor', 1),
+                                        adjust_to_qe=qes[c['channels_top']],
+                                        default_errors=c['relative_qe_error'] + c['relative_gain_error'])
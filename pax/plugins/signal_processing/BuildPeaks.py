@@ -14,6 +14,7 @@ class GapSizeClustering(plugin.ClusteringPlugin):
         self.gap_threshold = self.config['max_gap_size_in_cluster'] / self.dt
 
     def transform_event(self, event):
+        self.peak_table = None
         # Cluster hits in each detector separately
         # Assumes detector channel mappings are non-overlapping
         for detector, channels in self.config['channels_in_detector'].items():
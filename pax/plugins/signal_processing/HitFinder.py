@@ -1,9 +1,17 @@
 import numpy as np
 import numba
+from pax.numba_cache import jit
 
 import os
 
 from pax import plugin, datastructure, dsputils
+from pax.dsputils import find_intervals_above_threshold_raw, extend_intervals, raw_data_types
+from pax.plugins.signal_processing.PulseProperties import PulseProperties
+
+# Interrupts returned by the hitfinder kernels: the caller must grow the buffer, then resume hitfinding
+# Negative, since positive numbers indicate the number of hits found during normal operation
+HITS_BUFFER_FULL = -1
+HIT_BOUNDS_BUFFER_FULL = -2
 
 
 class FindHits(plugin.TransformPlugin):
@@ -38,9 +46,8 @@ class FindHits(plugin.TransformPlugin):
     Edge case:
 
     *) After large peaks the zero-length encoding can fail, making a huge pulse with many hits.
-       If more than max_hits_per_pulse hits are found in a pulse, the rest will be ignored.
-       If this threshold is set too low, you risk missing some hits in such events.
-       If set too high, it will degrade performance. Don't set to infinity, we need to allocate memory for this...
+       The hitfinder's buffers are allocated once, for max_hits_per_pulse hits per pulse. If a pulse has more hits,
+       the buffers are grown (and stay grown for the next events). All hits are always found.
 
     Debugging tip:
     If you get an error from one of the numba methods in this plugin (exception from native function blahblah)
@@ -63,125 +70,203 @@ class FindHits(plugin.TransformPlugin):
 
         self.always_find_single_hit = self.config.get('always_find_single_hit')
 
+        # Per-channel lookup tables, so we can do these conversions for all pulses at once
+        self.gains = np.array(c['gains'], dtype=np.float64)
+        self.adc_to_pe = np.array([dsputils.adc_to_pe(c, ch) for ch in range(len(c['gains']))], dtype=np.float64)
+
+        # Allocate numpy arrays to hold numba hitfinder results. These are grown when needed, see find_all_hits.
+        # -1 is a placeholder for values that should never appear (0 would be bad as it often IS a possible value)
+        self.hit_bounds_buffer = -1 * np.ones((self.max_hits_per_pulse, 2), dtype=np.int64)
+        self.central_bounds_buffer = -1 * np.ones((self.max_hits_per_pulse, 2), dtype=np.int64)
+        self.hits_buffer = np.zeros(self.max_hits_per_pulse, dtype=datastructure.Hit.get_dtype())
+        if self.always_find_single_hit:
+            self.single_hit_bounds = np.array(self.always_find_single_hit, dtype=np.int64)
+        else:
+            self.single_hit_bounds = np.zeros(0, dtype=np.int64)
+
     def transform_event(self, event):
-        dt = self.config['sample_duration']
-        hits_per_pulse = []
+        c = self.config
+        dt = c['sample_duration']
+        left_extension = c['left_extension'] // dt
+        right_extension = c['right_extension'] // dt
 
-        left_extension = self.config['left_extension'] // dt
-        right_extension = self.config['right_extension'] // dt
+        pulses = event.get_pulse_table()
 
-        # Allocate numpy arrays to hold numba hitfinder results
-        # -1 is a placeholder for values that should never appear (0 would be bad as it often IS a possible value)
-        hit_bounds_buffer = -1 * np.ones((self.max_hits_per_pulse, 2), dtype=np.int64)
-        hits_buffer = np.zeros(self.max_hits_per_pulse, dtype=datastructure.Hit.get_dtype())
-
-        for pulse_i, pulse in enumerate(event.pulses):
-            start = pulse.left
-            stop = pulse.right
-            channel = pulse.channel
-            pmt_gain = self.config['gains'][channel]
-
-            # Check the pulse properties have been computed
-            if np.isnan(pulse.minimum):
-                raise RuntimeError("Attempt to perform hitfinding on pulses whose properties have not been computed!")
-
-            # Retrieve waveform as floats: needed to subtract baseline (which can be in-between ADC counts)
-            w = pulse.raw_data.astype(np.float64)
-
-            # Subtract the baseline and invert(so hits point up from baseline)
-            w = self.reference_baseline - w
-            w -= pulse.baseline
-
-            # Don't do hitfinding in dead channels, pulse property computation was enough
-            # Could refactor pulse property computation to separate plugin,
-            # but that would mean waveform has to be converted to floats twice
-            if pmt_gain == 0:
-                continue
+        # Check the pulse properties have been computed
+        if np.any(np.isnan(pulses.minimum)):
+            raise RuntimeError("Attempt to perform hitfinding on pulses whose properties have not been computed!")
 
-            # Compute hitfinder threshold to use
-            # Rounding down is ok, since hitfinder uses >, not >= for threshold crossing testing.
-            pulse.hitfinder_threshold = int(max(self.config['height_over_noise_threshold'] * pulse.noise_sigma,
-                                                self.config['absolute_adc_counts_threshold'],
-                                                - self.config['height_over_min_threshold'] * pulse.minimum))
-            if self.always_find_single_hit:
-                # The config specifies a single range to integrate. Useful for gain calibration
-                hit_bounds_buffer[0] = self.always_find_single_hit
-                n_hits_found = 1
+        # Don't do hitfinding in dead channels, pulse property computation was enough
+        do_hitfinding = self.gains[pulses.channel] != 0
+        if not np.any(do_hitfinding):
+            self.log.warning("Event has no pulses??!")
+            return event
+
+        # Compute hitfinder threshold to use
+        # Rounding down is ok, since hitfinder uses >, not >= for threshold crossing testing.
+        thresholds = np.maximum(np.maximum(c['height_over_noise_threshold'] * pulses.noise_sigma,
+                                           c['absolute_adc_counts_threshold']),
+                                - c['height_over_min_threshold'] * pulses.minimum).astype(np.int64)
+        pulses.hitfinder_threshold[do_hitfinding] = thresholds[do_hitfinding]
+
+        # Convert area, noise_sigma and height from adc counts -> pe
+        adc_to_pe = self.adc_to_pe[pulses.channel]
+        noise_sigma_pe = pulses.noise_sigma * adc_to_pe
+
+        # If the DAQ pulse was ADC-saturated (clipped), the raw waveform dropped to 0,
+        # i.e. we went digitizer_reference_baseline above the reference baseline
+        # i.e. we went digitizer_reference_baseline - pulse.baseline above baseline
+        # 0.5 is needed to avoid floating-point rounding errors to cause saturation not to be reported
+        # Somehow happens only when you use simulated data -- apparently np.clip rounds slightly different
+        saturation_thresholds = self.reference_baseline - pulses.baseline - 0.5
+
+        args = (pulses.samples, pulses.offset, pulses.n_samples, pulses.left, pulses.channel,
+                pulses.baseline, pulses.hitfinder_threshold,
+                adc_to_pe, noise_sigma_pe, saturation_thresholds, do_hitfinding,
+                float(self.reference_baseline), dt, left_extension, right_extension,
+                self.single_hit_bounds)
+
+        if dsputils.use_parallel_kernels(c, len(pulses)):
+            # Count the hits in each pulse, then find them again and store them in their place in the hits array
+            n_hits_found = np.zeros(len(pulses), dtype=np.int64)
+            count_hits_parallel(*(args + (len(self.hit_bounds_buffer), n_hits_found)))
+            first_hit = np.cumsum(n_hits_found) - n_hits_found
+            hits = np.zeros(n_hits_found.sum(), dtype=datastructure.Hit.get_dtype())
+            find_hits_parallel(*(args + (len(self.hit_bounds_buffer), first_hit, hits)))
+            pulses.n_hits_found[do_hitfinding] = n_hits_found[do_hitfinding]
 
-            else:
-                # Call the numba hit finder -- see its docstring for description
-                n_hits_found = dsputils.find_intervals_above_threshold(w,
-                                                                       threshold=float(pulse.hitfinder_threshold),
-                                                                       result_buffer=hit_bounds_buffer)
-
-            # Only view the part of hit_bounds_buffer that contains hits found in this event
-            # The rest of hit_bounds_buffer contains -1's or stuff from previous pulses
-            pulse.n_hits_found = n_hits_found
-            hit_bounds_found = hit_bounds_buffer[:n_hits_found]
-
-            if self.always_find_single_hit:
-                central_bounds = hit_bounds_found
-            else:
-                # Extend the boundaries of each hit, to be sure we integrate everything.
-                # The original bounds are preserved: they are used in clustering
-                central_bounds = hit_bounds_found.copy()
-                dsputils.extend_intervals(w, hit_bounds_found, left_extension, right_extension)
-
-            # If no hits were found, this is a noise pulse: update the noise pulse count
-            if n_hits_found == 0:
-                event.noise_pulses_in[channel] += 1
-                # Don't 'continue' to the next pulse! There's stuff left to do!
-            elif n_hits_found >= self.max_hits_per_pulse:
-                self.log.debug("Pulse %s-%s in channel %s has more than %s hits. "
-                               "This usually indicates a zero-length encoding breakdown after a very large S2. "
-                               "Further hits in this pulse have been ignored." % (start, stop, channel,
-                                                                                  self.max_hits_per_pulse))
-
-            # Store the found hits in the datastructure
-            # Convert area, noise_sigma and height from adc counts -> pe
-            adc_to_pe = dsputils.adc_to_pe(self.config, channel)
-            noise_sigma_pe = pulse.noise_sigma * adc_to_pe
-
-            # If the DAQ pulse was ADC-saturated (clipped), the raw waveform dropped to 0,
-            # i.e. we went digitizer_reference_baseline above the reference baseline
-            # i.e. we went digitizer_reference_baseline - pulse.baseline above baseline
-            # 0.5 is needed to avoid floating-point rounding errors to cause saturation not to be reported
-            # Somehow happens only when you use simulated data -- apparently np.clip rounds slightly different
-            saturation_threshold = self.reference_baseline - pulse.baseline - 0.5
-
-            build_hits(w, hit_bounds_found, hits_buffer,
-                       adc_to_pe, channel, noise_sigma_pe, dt, start, pulse_i, saturation_threshold, central_bounds)
-            hits = hits_buffer[:n_hits_found].copy()
-            hits_per_pulse.append(hits)
-
-        if len(hits_per_pulse):
-            event.all_hits = np.concatenate(hits_per_pulse)
-
-            if not self.always_find_single_hit:
-                # Remove hits with 0 or negative area (very rare, but possible due to rigid integration bound)
-                # In always-find-single-hit mode (for PMT calibrations) this is undesirable
-                event.all_hits = event.all_hits[event.all_hits['area'] > 0]
-
-            self.log.debug("Found %d hits in %d pulses" % (len(event.all_hits), len(event.pulses)))
         else:
-            self.log.warning("Event has no pulses??!")
+            def find(first_pulse, first_hit):
+                return find_hits(*(args + (self.hit_bounds_buffer, self.central_bounds_buffer,
+                                           self.hits_buffer, pulses.n_hits_found, first_pulse, first_hit)))
 
+            hits = self.find_all_hits(pulses, find)
+
+        self.store_hits(event, pulses, do_hitfinding, hits)
         return event
 
+    def find_all_hits(self, pulses, find):
+        """Return the hits found by find(first_pulse, first_hit), a call to one of the event-wide hitfinder kernels
+        using this plugin's buffers. If a buffer is full, the kernel returns an interrupt and the pulse it stopped at:
+        we grow the buffer and resume.
+        """
+        pulse_i = n_hits = 0
+        while True:
+            result, pulse_i, n_hits = find(pulse_i, n_hits)
+
+            if result >= 0:
+                break
+
+            elif result == HITS_BUFFER_FULL:
+                self.log.debug("Hits buffer is full, growing it.")
+                new_size = max(2 * len(self.hits_buffer), n_hits + len(self.hit_bounds_buffer))
+                new_hits = np.zeros(new_size, dtype=self.hits_buffer.dtype)
+                new_hits[:n_hits] = self.hits_buffer[:n_hits]
+                self.hits_buffer = new_hits
+
+            elif result == HIT_BOUNDS_BUFFER_FULL:
+                self.log.debug("Pulse %s-%s in channel %s has at least %s hits. This usually indicates a zero-length "
+                               "encoding breakdown after a very large S2. Growing the hit bounds buffer." % (
+                                   pulses.left[pulse_i], pulses.right[pulse_i], pulses.channel[pulse_i],
+                                   len(self.hit_bounds_buffer)))
+                self.hit_bounds_buffer = grow_bounds_buffer(self.hit_bounds_buffer)
+                self.central_bounds_buffer = grow_bounds_buffer(self.central_bounds_buffer)
 
-@numba.jit(numba.void(numba.float64[:], numba.int64[:, :],
-                      numba.from_dtype(datastructure.Hit.get_dtype())[:],
-                      numba.float64, numba.int64, numba.float64, numba.int64, numba.int64, numba.int64, numba.float64,
-                      numba.int64[:, :]),
-           nopython=True)
-def build_hits(w, hit_bounds,
-               hits_buffer,
-               adc_to_pe, channel, noise_sigma_pe, dt, start, pulse_i, saturation_threshold,
-               central_bounds):
-    """Populates hits_buffer with properties from hits indicated by hit_bounds.
-        hit_bounds should be a numpy array of (left, right) bounds (inclusive) in w
-    Returns nothing.
+            else:
+                raise ValueError("Unknown hitfinder interrupt %d!" % result)
+
+        # The buffer will be reused for the next event
+        return self.hits_buffer[:n_hits].copy()
+
+    def store_hits(self, event, pulses, do_hitfinding, hits):
+        """Store the hits found in the pulses in event.all_hits, and update the noise pulse count"""
+        # Pulses without hits are noise pulses: update the noise pulse count
+        searched = np.where(do_hitfinding)[0]
+        n_hits_found = pulses.n_hits_found[searched]
+        np.add.at(event.noise_pulses_in, pulses.channel[searched[n_hits_found == 0]], 1)
+
+        event.all_hits = hits
+
+        if not self.always_find_single_hit:
+            # Remove hits with 0 or negative area (very rare, but possible due to rigid integration bound)
+            # In always-find-single-hit mode (for PMT calibrations) this is undesirable
+            event.all_hits = event.all_hits[event.all_hits['area'] > 0]
+
+        self.log.debug("Found %d hits in %d pulses" % (len(event.all_hits), len(event.pulses)))
+
+
+class FindHitsAndPulseProperties(FindHits):
+    """Computes the pulse properties and finds hits in one pass over the raw data of each pulse.
+    Gives the same results as PulseProperties.PulseProperties followed by HitFinder.FindHits, so you can replace
+    the two by this plugin if no plugin in between them needs (or changes) the pulse properties. The settings are
+    taken from the HitFinder and PulseProperties sections of the configuration.
+
+    The hitfinder threshold depends on the noise level and minimum of the pulse, which we only know at the end of the
+    pass. During the pass, we therefore find intervals above absolute_adc_counts_threshold (which the threshold is
+    never below). Afterwards we look for hits only in these intervals. If there are too many of them, we fall back to
+    searching the entire pulse again.
+
+    If the pulse properties have already been computed, the data-shrinking option of PulseProperties is active,
+    or the event has enough pulses to use the multi-threaded kernels, this just runs the two plugins in sequence.
     """
+
+    def startup(self):
+        FindHits.startup(self)
+
+        # The PulseProperties settings: this plugin lives in the HitFinder module, so they are not in self.config
+        pp_config = {}
+        for section_name in ('DEFAULT', 'PulseProperties', 'PulseProperties.PulseProperties'):
+            pp_config.update(self.processor.config.get(section_name, {}))
+        self.pulse_properties = PulseProperties(pp_config, processor=self.processor)
+        self.baseline_samples = pp_config.get('baseline_samples', 50)
+        self.shrink_data_threshold = pp_config.get('shrink_data_threshold', float('inf'))
+
+        self.candidate_bounds_buffer = -1 * np.ones((self.max_hits_per_pulse, 2), dtype=np.int64)
+
+    def transform_event(self, event):
+        c = self.config
+        dt = c['sample_duration']
+        left_extension = c['left_extension'] // dt
+        right_extension = c['right_extension'] // dt
+
+        pulses = event.get_pulse_table()
+        if (len(pulses) > self.shrink_data_threshold or not np.all(np.isnan(pulses.minimum)) or
+                dsputils.use_parallel_kernels(c, len(pulses))):
+            event = self.pulse_properties.transform_event(event)
+            return FindHits.transform_event(self, event)
+
+        # Don't do hitfinding in dead channels, pulse property computation is enough
+        do_hitfinding = self.gains[pulses.channel] != 0
+        adc_to_pe = self.adc_to_pe[pulses.channel]
+
+        # The threshold can't be below the absolute threshold (rounded down, see FindHits)
+        candidate_threshold = float(int(c['absolute_adc_counts_threshold']))
+
+        def find(first_pulse, first_hit):
+            return find_hits_and_pulse_properties(
+                pulses.samples, pulses.offset, pulses.n_samples, pulses.left, pulses.channel,
+                float(self.reference_baseline), self.baseline_samples,
+                pulses.baseline, pulses.baseline_increase, pulses.noise_sigma, pulses.minimum, pulses.maximum,
+                float(c['height_over_noise_threshold']), float(c['absolute_adc_counts_threshold']),
+                float(c['height_over_min_threshold']), candidate_threshold, pulses.hitfinder_threshold,
+                adc_to_pe, do_hitfinding, dt, left_extension, right_extension, self.single_hit_bounds,
+                self.hit_bounds_buffer, self.central_bounds_buffer, self.candidate_bounds_buffer,
+                self.hits_buffer, pulses.n_hits_found, first_pulse, first_hit)
+
+        hits = self.find_all_hits(pulses, find)
+        if not np.any(do_hitfinding):
+            self.log.warning("Event has no pulses??!")
+            return event
+        self.store_hits(event, pulses, do_hitfinding, hits)
+        return event
+
+
+@jit(nopython=True)
+def _build_hits(w, reference_baseline, sign, baseline, hit_bounds,
+                hits_buffer,
+                adc_to_pe, channel, noise_sigma_pe, dt, start, pulse_i, saturation_threshold,
+                central_bounds):
+    """build_hits for the waveform (reference_baseline + sign * w) - baseline"""
     for hit_i in range(len(hit_bounds)):
         amplitude = -999.9
         argmax = -1
@@ -191,7 +276,9 @@ def build_hits(w, hit_bounds,
         saturation_count = 0
         left = hit_bounds[hit_i, 0]
         right = hit_bounds[hit_i, 1]
-        for i, x in enumerate(w[left:right + 1]):
+        n = min(right + 1, len(w)) - left
+        for i in range(n):
+            x = (reference_baseline + sign * w[left + i]) - baseline
             if x > amplitude:
                 amplitude = x
                 argmax = i
@@ -206,7 +293,8 @@ def build_hits(w, hit_bounds,
         # would throw a divide by zero exception.
         if area != 0:
             center /= area
-            for i, x in enumerate(w[left:right + 1]):
+            for i in range(n):
+                x = (reference_baseline + sign * w[left + i]) - baseline
                 deviation += x * abs(i - center)
             deviation /= area
 
@@ -221,7 +309,361 @@ def build_hits(w, hit_bounds,
         hits_buffer[hit_i].index_of_maximum = start + left + argmax
         hits_buffer[hit_i].n_saturated = saturation_count
         hits_buffer[hit_i].area = area * adc_to_pe
-        hits_buffer[hit_i].height = w[argmax + left] * adc_to_pe
+        hits_buffer[hit_i].height = ((reference_baseline + sign * w[argmax + left]) - baseline) * adc_to_pe
 
         hits_buffer[hit_i].left_central = central_bounds[hit_i][0] + start
         hits_buffer[hit_i].right_central = central_bounds[hit_i][1] + start
+
+
+@jit(numba.void(numba.float64[:], numba.int64[:, :],
+                numba.from_dtype(datastructure.Hit.get_dtype())[:],
+                numba.float64, numba.int64, numba.float64, numba.int64, numba.int64, numba.int64, numba.float64,
+                numba.int64[:, :]),
+     nopython=True)
+def build_hits(w, hit_bounds,
+               hits_buffer,
+               adc_to_pe, channel, noise_sigma_pe, dt, start, pulse_i, saturation_threshold,
+               central_bounds):
+    """Populates hits_buffer with properties from hits indicated by hit_bounds.
+        hit_bounds should be a numpy array of (left, right) bounds (inclusive) in w
+    Returns nothing.
+    """
+    _build_hits(w, 0.0, 1.0, 0.0, hit_bounds, hits_buffer,
+                adc_to_pe, channel, noise_sigma_pe, dt, start, pulse_i, saturation_threshold,
+                central_bounds)
+
+
+@jit([numba.void(t[:], numba.float64, numba.float64, numba.int64[:, :],
+                 numba.from_dtype(datastructure.Hit.get_dtype())[:],
+                 numba.float64, numba.int64, numba.float64, numba.int64, numba.int64, numba.int64, numba.float64,
+                 numba.int64[:, :])
+      for t in raw_data_types],
+     nopython=True)
+def build_hits_raw(raw_data, reference_baseline, baseline, hit_bounds,
+                   hits_buffer,
+                   adc_to_pe, channel, noise_sigma_pe, dt, start, pulse_i, saturation_threshold,
+                   central_bounds):
+    """Like build_hits, for the waveform (reference_baseline - raw_data) - baseline, which is computed on the fly
+    (so the raw data need not be converted to a float waveform first).
+    """
+    _build_hits(raw_data, reference_baseline, -1.0, baseline, hit_bounds, hits_buffer,
+                adc_to_pe, channel, noise_sigma_pe, dt, start, pulse_i, saturation_threshold,
+                central_bounds)
+
+
+@jit(nopython=True)
+def _find_pulse_hit_bounds(raw_data, reference_baseline, baseline, threshold, left_extension, right_extension,
+                           single_hit_bounds, hit_bounds_buffer, central_bounds_buffer):
+    """Find the hits in the raw data of one pulse: store their (extended) bounds in hit_bounds_buffer and the
+    original bounds in central_bounds_buffer. Returns the number of hits found, or HIT_BOUNDS_BUFFER_FULL if
+    hit_bounds_buffer filled up (so there may be more hits).
+    """
+    if len(single_hit_bounds):
+        # The config specifies a single range to integrate. Useful for gain calibration
+        hit_bounds_buffer[0, 0] = single_hit_bounds[0]
+        hit_bounds_buffer[0, 1] = single_hit_bounds[1]
+        central_bounds_buffer[0, 0] = single_hit_bounds[0]
+        central_bounds_buffer[0, 1] = single_hit_bounds[1]
+        return 1
+
+    # Call the numba hit finder -- see its docstring for description
+    n_found = find_intervals_above_threshold_raw(raw_data, reference_baseline, baseline, threshold, hit_bounds_buffer)
+    if n_found == len(hit_bounds_buffer):
+        return HIT_BOUNDS_BUFFER_FULL
+
+    # Extend the boundaries of each hit, to be sure we integrate everything.
+    # The original bounds are preserved: they are used in clustering
+    central_bounds_buffer[:n_found] = hit_bounds_buffer[:n_found]
+    extend_intervals(raw_data, hit_bounds_buffer[:n_found], left_extension, right_extension)
+    return n_found
+
+
+@jit(nopython=True)
+def _find_pulse_hit_bounds_growing(raw_data, reference_baseline, baseline, threshold, left_extension,
+                                   right_extension, single_hit_bounds, buffer_size):
+    """_find_pulse_hit_bounds with newly allocated buffers, starting at buffer_size and grown until all hits fit.
+    Returns (number of hits found, hit_bounds_buffer, central_bounds_buffer).
+    """
+    while True:
+        hit_bounds_buffer = np.empty((buffer_size, 2), dtype=np.int64)
+        central_bounds_buffer = np.empty((buffer_size, 2), dtype=np.int64)
+        n_found = _find_pulse_hit_bounds(raw_data, reference_baseline, baseline, threshold,
+                                         left_extension, right_extension, single_hit_bounds,
+                                         hit_bounds_buffer, central_bounds_buffer)
+        if n_found != HIT_BOUNDS_BUFFER_FULL:
+            return n_found, hit_bounds_buffer, central_bounds_buffer
+        buffer_size *= 2
+
+
+def grow_bounds_buffer(buffer):
+    """Return a new hit bounds buffer twice as long as buffer. The contents are not copied."""
+    return -1 * np.ones((2 * len(buffer), 2), dtype=np.int64)
+
+
+@jit([numba.types.UniTuple(numba.int64, 3)(t[:], numba.int64[:], numba.int64[:], numba.int64[:],
+                                           numba.int64[:],
+                                           numba.float64[:], numba.int64[:],
+                                           numba.float64[:], numba.float64[:], numba.float64[:], numba.boolean[:],
+                                           numba.float64, numba.int64, numba.int64, numba.int64, numba.int64[:],
+                                           numba.int64[:, :], numba.int64[:, :],
+                                           numba.from_dtype(datastructure.Hit.get_dtype())[:], numba.int64[:],
+                                           numba.int64, numba.int64)
+      for t in raw_data_types],
+     nopython=True)
+def find_hits(samples, offsets, n_samples, lefts, channels,
+              baselines, thresholds,
+              adc_to_pe, noise_sigma_pe, saturation_thresholds, do_hitfinding,
+              reference_baseline, dt, left_extension, right_extension, single_hit_bounds,
+              hit_bounds_buffer, central_bounds_buffer,
+              hits, n_hits_found, first_pulse, first_hit):
+    """Find hits in all pulses of an event (from first_pulse onwards) and store them in hits (from first_hit onwards).
+    The pulses are given as columns of a PulseTable, the other per-pulse arguments are arrays with one entry per
+    pulse. Pulses for which do_hitfinding is False are skipped. The number of hits found in each pulse is stored
+    in n_hits_found.
+    The raw samples are used directly: the baseline-corrected, inverted waveform (so hits point up from baseline)
+    is computed on the fly.
+    If single_hit_bounds is not empty, it is used as the (only) hit in each pulse.
+    Returns (result, index of the pulse we stopped at, number of hits stored). The result is the number of hits
+    found, or an interrupt if a buffer is full:
+      - HITS_BUFFER_FULL: the hits of the pulse we stopped at do not fit in hits;
+      - HIT_BOUNDS_BUFFER_FULL: the pulse we stopped at has too many hits for hit_bounds_buffer.
+    Call again with a larger buffer, first_pulse and first_hit set to the returned values, to continue.
+    """
+    n_hits_stored = first_hit
+    for pulse_i in range(first_pulse, len(offsets)):
+        if not do_hitfinding[pulse_i]:
+            continue
+
+        offset = offsets[pulse_i]
+        raw_data = samples[offset:offset + n_samples[pulse_i]]
+        baseline = baselines[pulse_i]
+
+        n_found = _find_pulse_hit_bounds(raw_data, reference_baseline, baseline, float(thresholds[pulse_i]),
+                                         left_extension, right_extension, single_hit_bounds,
+                                         hit_bounds_buffer, central_bounds_buffer)
+        if n_found == HIT_BOUNDS_BUFFER_FULL:
+            return HIT_BOUNDS_BUFFER_FULL, pulse_i, n_hits_stored
+
+        if n_hits_stored + n_found > len(hits):
+            return HITS_BUFFER_FULL, pulse_i, n_hits_stored
+        n_hits_found[pulse_i] = n_found
+
+        build_hits_raw(raw_data, reference_baseline, baseline, hit_bounds_buffer[:n_found],
+                       hits[n_hits_stored:n_hits_stored + n_found],
+                       adc_to_pe[pulse_i], channels[pulse_i], noise_sigma_pe[pulse_i], dt, lefts[pulse_i], pulse_i,
+                       saturation_thresholds[pulse_i], central_bounds_buffer[:n_found])
+        n_hits_stored += n_found
+
+    return n_hits_stored, len(offsets), n_hits_stored
+
+
+def _pulse_kernel_signature(return_type, sample_type, *extra_arg_types):
+    """Signature of the multi-threaded hitfinder kernels, which take the same pulse arguments as find_hits,
+    then max_hits_per_pulse and extra_arg_types.
+    """
+    return return_type(sample_type[:], numba.int64[:], numba.int64[:], numba.int64[:], numba.int64[:],
+                       numba.float64[:], numba.int64[:],
+                       numba.float64[:], numba.float64[:], numba.float64[:], numba.boolean[:],
+                       numba.float64, numba.int64, numba.int64, numba.int64, numba.int64[:],
+                       numba.int64, *extra_arg_types)
+
+
+@jit([_pulse_kernel_signature(numba.void, t, numba.int64[:]) for t in raw_data_types],
+     nopython=True, parallel=True)
+def count_hits_parallel(samples, offsets, n_samples, lefts, channels,
+                        baselines, thresholds,
+                        adc_to_pe, noise_sigma_pe, saturation_thresholds, do_hitfinding,
+                        reference_baseline, dt, left_extension, right_extension, single_hit_bounds,
+                        max_hits_per_pulse, n_hits_found):
+    """First pass of the multi-threaded hitfinder: store the number of hits in each pulse in n_hits_found
+    (0 for pulses where do_hitfinding is False). Arguments are as for find_hits, but each pulse uses its own
+    hit bounds buffers, which start at length max_hits_per_pulse and grow as needed.
+    """
+    for pulse_i in numba.prange(len(offsets)):
+        if not do_hitfinding[pulse_i]:
+            n_hits_found[pulse_i] = 0
+            continue
+        offset = offsets[pulse_i]
+        n_hits_found[pulse_i] = _find_pulse_hit_bounds_growing(samples[offset:offset + n_samples[pulse_i]],
+                                                               reference_baseline, baselines[pulse_i],
+                                                               float(thresholds[pulse_i]),
+                                                               left_extension, right_extension, single_hit_bounds,
+                                                               max_hits_per_pulse)[0]
+
+
+@jit([_pulse_kernel_signature(numba.void, t, numba.int64[:], numba.from_dtype(datastructure.Hit.get_dtype())[:])
+      for t in raw_data_types],
+     nopython=True, parallel=True)
+def find_hits_parallel(samples, offsets, n_samples, lefts, channels,
+                       baselines, thresholds,
+                       adc_to_pe, noise_sigma_pe, saturation_thresholds, do_hitfinding,
+                       reference_baseline, dt, left_extension, right_extension, single_hit_bounds,
+                       max_hits_per_pulse, first_hit, hits):
+    """Second pass of the multi-threaded hitfinder: find the hits of each pulse again, and store them in
+    hits[first_hit[pulse_i]:], as counted by count_hits_parallel. Gives the same hits as find_hits.
+    """
+    for pulse_i in numba.prange(len(offsets)):
+        if not do_hitfinding[pulse_i]:
+            continue
+        offset = offsets[pulse_i]
+        raw_data = samples[offset:offset + n_samples[pulse_i]]
+        baseline = baselines[pulse_i]
+        n_found, hit_bounds_buffer, central_bounds_buffer = _find_pulse_hit_bounds_growing(
+            raw_data, reference_baseline, baseline, float(thresholds[pulse_i]),
+            left_extension, right_extension, single_hit_bounds, max_hits_per_pulse)
+        start = first_hit[pulse_i]
+        build_hits_raw(raw_data, reference_baseline, baseline, hit_bounds_buffer[:n_found],
+                       hits[start:start + n_found],
+                       adc_to_pe[pulse_i], channels[pulse_i], noise_sigma_pe[pulse_i], dt, lefts[pulse_i], pulse_i,
+                       saturation_thresholds[pulse_i], central_bounds_buffer[:n_found])
+
+
+@jit([numba.types.UniTuple(numba.int64, 3)(t[:], numba.int64[:], numba.int64[:], numba.int64[:], numba.int64[:],
+                                           numba.float64, numba.int64,
+                                           numba.float64[:], numba.float64[:], numba.float64[:], numba.float64[:],
+                                           numba.float64[:],
+                                           numba.float64, numba.float64, numba.float64, numba.float64,
+                                           numba.int64[:],
+                                           numba.float64[:], numba.boolean[:],
+                                           numba.int64, numba.int64, numba.int64, numba.int64[:],
+                                           numba.int64[:, :], numba.int64[:, :], numba.int64[:, :],
+                                           numba.from_dtype(datastructure.Hit.get_dtype())[:], numba.int64[:],
+                                           numba.int64, numba.int64)
+      for t in raw_data_types],
+     nopython=True)
+def find_hits_and_pulse_properties(samples, offsets, n_samples, lefts, channels,
+                                   reference_baseline, baseline_samples,
+                                   baselines, baseline_increases, noise_sigmas, minima, maxima,
+                                   height_over_noise_threshold, absolute_adc_counts_threshold,
+                                   height_over_min_threshold, candidate_threshold, thresholds,
+                                   adc_to_pe, do_hitfinding, dt, left_extension, right_extension, single_hit_bounds,
+                                   hit_bounds_buffer, central_bounds_buffer, candidate_bounds_buffer,
+                                   hits, n_hits_found, first_pulse, first_hit):
+    """Compute the pulse properties (as PulseProperties.compute_raw_pulse_properties does) and find hits (as
+    find_hits does) in all pulses of an event, in one pass over the samples of each pulse.
+    The pulse properties and hitfinder thresholds are stored in the baselines, ..., maxima and thresholds arrays.
+    Intervals above candidate_threshold, a lower bound on the hitfinder threshold, are found during the pass
+    and stored in candidate_bounds_buffer; once the threshold is known, we search only these for hits.
+    See find_hits for the other arguments and the return value.
+    """
+    candidate_buffer_size = len(candidate_bounds_buffer)
+    n_hits_stored = first_hit
+    for pulse_i in range(first_pulse, len(offsets)):
+        offset = offsets[pulse_i]
+        raw_data = samples[offset:offset + n_samples[pulse_i]]
+        n = len(raw_data)
+        hitfinding = do_hitfinding[pulse_i]
+
+        # Compute the baseline before and after the self-trigger
+        baseline = 0.0
+        n_baseline = min(baseline_samples, n)
+        for i in range(n_baseline):
+            baseline += reference_baseline + -1.0 * raw_data[i]
+        baseline /= n_baseline
+
+        baseline_after = 0.0
+        for i in range(n - n_baseline, n):
+            baseline_after += reference_baseline + -1.0 * raw_data[i]
+        baseline_after /= n_baseline
+
+        # Main pass: min, max, noise and intervals above the candidate threshold
+        n_noise = 0
+        m2 = 0.0
+        max_a = -1.0e6
+        min_a = 1.0e6
+        in_interval = False
+        n_candidates = 0
+        candidates_overflow = False
+        current_interval_start = -1
+        for i in range(n):
+            x = reference_baseline + -1.0 * raw_data[i]
+            if x > max_a:
+                max_a = x
+            if x < min_a:
+                min_a = x
+            if x < baseline:
+                delta = x - baseline
+                n_noise += 1
+                m2 += delta*(x-baseline)
+
+            if not hitfinding or candidates_overflow:
+                continue
+            y = x - baseline
+            if not in_interval and y > candidate_threshold:
+                in_interval = True
+                current_interval_start = i
+            if in_interval and (y <= candidate_threshold or i == n - 1):
+                in_interval = False
+                candidate_bounds_buffer[n_candidates, 0] = current_interval_start
+                candidate_bounds_buffer[n_candidates, 1] = i - 1 if y <= candidate_threshold else i
+                n_candidates += 1
+                if n_candidates == candidate_buffer_size:
+                    candidates_overflow = True
+
+        if n_noise == 0:
+            # Should only happen if w = baseline everywhere
+            noise = 0.0
+        else:
+            noise = (m2/n_noise)**0.5
+
+        baselines[pulse_i] = baseline
+        baseline_increases[pulse_i] = baseline_after - baseline
+        noise_sigmas[pulse_i] = noise
+        minima[pulse_i] = min_a - baseline
+        maxima[pulse_i] = max_a - baseline
+
+        if not hitfinding:
+            continue
+
+        # Rounding down is ok, since hitfinder uses >, not >= for threshold crossing testing.
+        threshold = numba.int64(max(max(height_over_noise_threshold * noise, absolute_adc_counts_threshold),
+                                    - height_over_min_threshold * minima[pulse_i]))
+        thresholds[pulse_i] = threshold
+
+        if len(single_hit_bounds):
+            # The config specifies a single range to integrate. Useful for gain calibration
+            hit_bounds_buffer[0, 0] = single_hit_bounds[0]
+            hit_bounds_buffer[0, 1] = single_hit_bounds[1]
+            n_found = 1
+            central_bounds = hit_bounds_buffer[:1]
+        else:
+            if candidates_overflow:
+                # Too many candidate intervals, search the whole pulse again
+                n_found = find_intervals_above_threshold_raw(raw_data, reference_baseline, baseline,
+                                                             float(threshold), hit_bounds_buffer)
+            else:
+                # Hits are parts of the candidate intervals
+                n_found = 0
+                for candidate_i in range(n_candidates):
+                    if n_found == len(hit_bounds_buffer):
+                        # There may be more hits: caller must grow the buffer
+                        break
+                    left = candidate_bounds_buffer[candidate_i, 0]
+                    right = candidate_bounds_buffer[candidate_i, 1]
+                    n_new = find_intervals_above_threshold_raw(raw_data[left:right + 1], reference_baseline, baseline,
+                                                               float(threshold), hit_bounds_buffer[n_found:])
+                    for j in range(n_found, n_found + n_new):
+                        hit_bounds_buffer[j, 0] += left
+                        hit_bounds_buffer[j, 1] += left
+                    n_found += n_new
+
+            if n_found == len(hit_bounds_buffer):
+                return HIT_BOUNDS_BUFFER_FULL, pulse_i, n_hits_stored
+
+            # Extend the boundaries of each hit, to be sure we integrate everything.
+            # The original bounds are preserved: they are used in clustering
+            central_bounds = central_bounds_buffer[:n_found]
+            central_bounds[:, :] = hit_bounds_buffer[:n_found]
+            extend_intervals(raw_data, hit_bounds_buffer[:n_found], left_extension, right_extension)
+
+        if n_hits_stored + n_found > len(hits):
+            return HITS_BUFFER_FULL, pulse_i, n_hits_stored
+        n_hits_found[pulse_i] = n_found
+
+        build_hits_raw(raw_data, reference_baseline, baseline, hit_bounds_buffer[:n_found],
+                       hits[n_hits_stored:n_hits_stored + n_found],
+                       adc_to_pe[pulse_i], channels[pulse_i], noise * adc_to_pe[pulse_i], dt, lefts[pulse_i],
+                       pulse_i, (reference_baseline - baseline) - 0.5, central_bounds)
+        n_hits_stored += n_found
+
+    return n_hits_stored, len(offsets), n_hits_stored
@@ -1,7 +1,9 @@
 import numba
+from pax.numba_cache import jit
 import numpy as np
 
-from pax import plugin
+from pax import plugin, dsputils
+from pax.dsputils import raw_data_types
 
 
 class PulseProperties(plugin.TransformPlugin):
@@ -15,39 +17,38 @@ class PulseProperties(plugin.TransformPlugin):
 
     def transform_event(self, event):
         # Local variables are marginally faster to access in inner loop, so we don't put these in startup.
-        reference_baseline = self.config['digitizer_reference_baseline']
+        reference_baseline = float(self.config['digitizer_reference_baseline'])
 
         n_baseline = self.config.get('baseline_samples', 50)
 
         shrink_data_threshold = self.config.get('shrink_data_threshold', float('inf'))
         shrink_data_samples = self.config.get('shrink_data_samples', n_baseline)
 
-        n_pulses = len(event.pulses)
-        warning_given = self.warning_given
-
-        for pulse_i, pulse in enumerate(event.pulses):
-            if not np.isnan(pulse.minimum):
-                if not warning_given:
-                    self.log.info("Pulse properties have already been computed, doing nothing.")
-                    self.warning_given = True
-                return event
-
-            # Retrieve waveform as floats: needed to subtract baseline (which can be in between ADC counts)
-            w = pulse.raw_data.astype(np.float64)
-
-            # Subtract reference baseline, invert (so hits point up from baseline)
-            # This is convenient so we don't have to reinterpret min, max, etc
-            w = reference_baseline - w
-
-            _results = compute_pulse_properties(w, n_baseline)
-            pulse.baseline, pulse.baseline_increase, pulse.noise_sigma, pulse.minimum, pulse.maximum = _results
-
-            if n_pulses > shrink_data_threshold:
+        pulses = event.get_pulse_table()
+        n_pulses = len(pulses)
+
+        # Properties are computed up to the first pulse which already has them
+        already_done = np.where(~np.isnan(pulses.minimum))[0]
+        n_todo = already_done[0] if len(already_done) else n_pulses
+
+        # The waveform is inverted (so hits point up from baseline) and the reference baseline is subtracted
+        # on the fly. This is convenient so we don't have to reinterpret min, max, etc
+        if dsputils.use_parallel_kernels(self.config, n_todo):
+            kernel = compute_pulse_table_properties_parallel
+        else:
+            kernel = compute_pulse_table_properties
+        kernel(pulses.samples, pulses.offset[:n_todo], pulses.n_samples[:n_todo], reference_baseline, n_baseline,
+               pulses.baseline[:n_todo], pulses.baseline_increase[:n_todo], pulses.noise_sigma[:n_todo],
+               pulses.minimum[:n_todo], pulses.maximum[:n_todo])
+
+        if n_pulses > shrink_data_threshold:
+            for pulse_i in range(n_todo):
                 # Remove the start and end of each pulse, which don't contain much useful information, but
-                # takes up a lot of space
-                pulse.raw_data = pulse.raw_data[shrink_data_samples:-shrink_data_samples]
-                pulse.right -= n_baseline
-                pulse.left += n_baseline
+                # takes up a lot of space. The table just points to a smaller part of its sample buffer.
+                raw_data = pulses.get_raw_data(pulse_i)
+                pulses.set_raw_data(pulse_i, raw_data[shrink_data_samples:-shrink_data_samples])
+                pulses.right[pulse_i] -= n_baseline
+                pulses.left[pulse_i] += n_baseline
 
                 # Store some "advanced" pulse properties as ints rather than floats to save space
                 # TODO: disabled, seems to freak out ROOT output??
@@ -57,32 +58,26 @@ class PulseProperties(plugin.TransformPlugin):
                 # pulse.baseline = int(round(pulse.baseline))
                 # pulse.baseline_increase = int(round(pulse.baseline_increase))
 
+        if n_todo < n_pulses and not self.warning_given:
+            self.log.info("Pulse properties have already been computed, doing nothing.")
+            self.warning_given = True
+
         return event
 
 
-@numba.jit(numba.typeof((1.0, 1.0, 1.0, 1.0, 1.0))(numba.float64[:], numba.int64),
-           nopython=True)
-def compute_pulse_properties(w, baseline_samples):
-    """Compute basic pulse properties quickly
-    :param w: Raw pulse waveform in ADC counts
-    :param baseline_samples: number of samples to use for baseline computation at the start of the pulse
-    :return: (baseline, baseline_increase, noise_sigma, min, max);
-      baseline is the average of the first baseline_samples in the pulse
-      baseline_increase = baseline_after - baseline_before
-      min and max relative to baseline
-      noise_sigma is the std of samples below baseline
-    Does not modify w. Does not assume anything about inversion of w!!
-    """
+@jit(nopython=True)
+def _compute_pulse_properties(w, reference_baseline, sign, baseline_samples):
+    """compute_pulse_properties for the waveform reference_baseline + sign * w"""
     # Compute the baseline before and after the self-trigger
     baseline = 0.0
     baseline_samples = min(baseline_samples, len(w))
-    for x in w[:baseline_samples]:
-        baseline += x
+    for i in range(baseline_samples):
+        baseline += reference_baseline + sign * w[i]
     baseline /= baseline_samples
 
     baseline_after = 0.0
-    for x in w[-baseline_samples:]:
-        baseline_after += x
+    for i in range(len(w) - baseline_samples, len(w)):
+        baseline_after += reference_baseline + sign * w[i]
     baseline_after /= baseline_samples
 
     baseline_increase = baseline_after - baseline
@@ -93,7 +88,8 @@ def compute_pulse_properties(w, baseline_samples):
     max_a = -1.0e6  # Running max amplitude
     min_a = 1.0e6   # Running min amplitude
 
-    for x in w:
+    for i in range(len(w)):
+        x = reference_baseline + sign * w[i]
         if x > max_a:
             max_a = x
         if x < min_a:
@@ -110,3 +106,66 @@ def compute_pulse_properties(w, baseline_samples):
         noise = (m2/n)**0.5
 
     return baseline, baseline_increase, noise, min_a - baseline, max_a - baseline
+
+
+@jit(numba.typeof((1.0, 1.0, 1.0, 1.0, 1.0))(numba.float64[:], numba.int64),
+     nopython=True)
+def compute_pulse_properties(w, baseline_samples):
+    """Compute basic pulse properties quickly
+    :param w: Raw pulse waveform in ADC counts
+    :param baseline_samples: number of samples to use for baseline computation at the start of the pulse
+    :return: (baseline, baseline_increase, noise_sigma, min, max);
+      baseline is the average of the first baseline_samples in the pulse
+      baseline_increase = baseline_after - baseline_before
+      min and max relative to baseline
+      noise_sigma is the std of samples below baseline
+    Does not modify w. Does not assume anything about inversion of w!!
+    """
+    return _compute_pulse_properties(w, 0.0, 1.0, baseline_samples)
+
+
+@jit([numba.typeof((1.0, 1.0, 1.0, 1.0, 1.0))(t[:], numba.float64, numba.int64) for t in raw_data_types],
+     nopython=True)
+def compute_raw_pulse_properties(raw_data, reference_baseline, baseline_samples):
+    """Like compute_pulse_properties, for the waveform reference_baseline - raw_data (i.e. inverted so hits point
+    up), which is computed on the fly from the raw data.
+    """
+    return _compute_pulse_properties(raw_data, reference_baseline, -1.0, baseline_samples)
+
+
+@jit(nopython=True)
+def _store_pulse_properties(samples, offsets, n_samples, reference_baseline, baseline_samples,
+                            baselines, baseline_increases, noise_sigmas, minima, maxima, pulse_i):
+    raw_data = samples[offsets[pulse_i]:offsets[pulse_i] + n_samples[pulse_i]]
+    result = _compute_pulse_properties(raw_data, reference_baseline, -1.0, baseline_samples)
+    baselines[pulse_i] = result[0]
+    baseline_increases[pulse_i] = result[1]
+    noise_sigmas[pulse_i] = result[2]
+    minima[pulse_i] = result[3]
+    maxima[pulse_i] = result[4]
+
+
+def _pulse_table_properties_signatures():
+    return [numba.void(t[:], numba.int64[:], numba.int64[:], numba.float64, numba.int64,
+                       numba.float64[:], numba.float64[:], numba.float64[:], numba.float64[:], numba.float64[:])
+            for t in raw_data_types]
+
+
+@jit(_pulse_table_properties_signatures(), nopython=True)
+def compute_pulse_table_properties(samples, offsets, n_samples, reference_baseline, baseline_samples,
+                                   baselines, baseline_increases, noise_sigmas, minima, maxima):
+    """Compute the properties of all pulses in a PulseTable (given by its samples, offset and n_samples columns),
+    as compute_raw_pulse_properties does, and store them in the baselines, ..., maxima arrays.
+    """
+    for pulse_i in range(len(offsets)):
+        _store_pulse_properties(samples, offsets, n_samples, reference_baseline, baseline_samples,
+                                baselines, baseline_increases, noise_sigmas, minima, maxima, pulse_i)
+
+
+@jit(_pulse_table_properties_signatures(), nopython=True, parallel=True)
+def compute_pulse_table_properties_parallel(samples, offsets, n_samples, reference_baseline, baseline_samples,
+                                            baselines, baseline_increases, noise_sigmas, minima, maxima):
+    """Multi-threaded version of compute_pulse_table_properties, for events with many pulses"""
+    for pulse_i in numba.prange(len(offsets)):
+        _store_pulse_properties(samples, offsets, n_samples, reference_baseline, baseline_samples,
+                                baselines, baseline_increases, noise_sigmas, minima, maxima, pulse_i)
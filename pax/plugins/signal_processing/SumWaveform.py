@@ -1,94 +1,204 @@
 import numpy as np
 import numba
+from pax.numba_cache import jit
 
-from pax import plugin, datastructure, recarray_tools, dsputils
+from pax import plugin, datastructure, dsputils
+from pax.dsputils import raw_data_types
 
 
 class SumWaveform(plugin.TransformPlugin):
+    """Build the sum waveforms of each detector, both from the whole pulses ('_raw') and from the hits only
+    (except for hits which were rejected, e.g. by RejectNoiseHits). The tpc hits-only sum waveform is split in
+    tpc_top and tpc_bottom, tpc is their sum.
+
+    All sum waveforms are accumulated in one pass over the pulses by a numba kernel, using lookup tables of which
+    sum waveforms each channel contributes to.
+
+    For events longer than sparse_above_event_duration, the sum waveforms are sparse: only the samples in intervals
+    covered by pulses (of channels contributing to any sum waveform) are stored, so their memory scales with the
+    covered time rather than the event length. Use SumWaveform.get_samples to get the samples of a peak.
+    """
 
     def startup(self):
-        self.detector_by_channel = dsputils.get_detector_by_channel(self.config)
+        c = self.config
+        detectors = list(c['channels_in_detector'].keys())
+
+        # Sum waveforms, in the order in which they appear in event.sum_waveforms: (name, detector, channels)
+        self.waveform_specs = [(detector + postfix, detector, c['channels_in_detector'][detector])
+                               for postfix in ('', '_raw')
+                               for detector in detectors]
+        self.waveform_specs += [('tpc_%s' % q, 'tpc', c['channels_%s' % q]) for q in ('top', 'bottom')]
+        waveform_index = {name: i for i, (name, _, _) in enumerate(self.waveform_specs)}
+        self.tpc_rows = [waveform_index[name] for name in ('tpc', 'tpc_top', 'tpc_bottom')]
+
+        # Per-channel lookup tables: index of the hits-only and raw sum waveform (-1 for dead channels,
+        # or channels not in any detector), and the conversion factor from ADC counts to pe/bin.
+        n_channels = c['n_channels']
+        self.hits_waveform_index = -1 * np.ones(n_channels, dtype=np.int64)
+        self.raw_waveform_index = -1 * np.ones(n_channels, dtype=np.int64)
+        channels_top = set(c['channels_top'])
+        for channel, detector in dsputils.get_detector_by_channel(c).items():
+            if channel >= n_channels or c['gains'][channel] == 0:
+                continue
+            if detector == 'tpc':
+                self.hits_waveform_index[channel] = waveform_index['tpc_top' if channel in channels_top
+                                                                  else 'tpc_bottom']
+            else:
+                self.hits_waveform_index[channel] = waveform_index[detector]
+            self.raw_waveform_index[channel] = waveform_index[detector + '_raw']
+        self.adc_to_pe = np.array([dsputils.adc_to_pe(c, ch) for ch in range(n_channels)], dtype=np.float64)
 
     def transform_event(self, event):
+        pulses = event.get_pulse_table()
 
-        # Initialize empty waveforms for each detector
-        # One with only hits, one with raw data
-        for postfix in ('', '_raw'):
-            for detector, chs in self.config['channels_in_detector'].items():
-                event.sum_waveforms.append(datastructure.SumWaveform(
-                    samples=np.zeros(event.length(), dtype=np.float32),
-                    name=detector + postfix,
-                    channel_list=np.array(list(chs), dtype=np.uint16),
-                    detector=detector
-                ))
-
-        # Make dictionary mapping pulse -> non-rejected hits found in pulse
-        # Assumes hits are still sorted by pulse
+        # The hits (except rejected ones) of each pulse, sorted by left boundary.
+        # Event.all_hits is sorted by pulse, as other plugins expect that.
         event.all_hits = np.sort(event.all_hits, order='found_in_pulse')
-        hits_per_pulse = recarray_tools.dict_group_by(event.all_hits[True ^ event.all_hits['is_rejected']],
-                                                      'found_in_pulse')
-
-        # Add top and bottom tpc sum waveforms
-        for q in ('top', 'bottom'):
+        hits = event.all_hits[True ^ event.all_hits['is_rejected']]
+        hits = hits[np.lexsort((hits['left'], hits['found_in_pulse']))]
+        pulse_hit_start = np.searchsorted(hits['found_in_pulse'], np.arange(len(pulses) + 1)).astype(np.int64)
+
+        sparse = event.length() * self.config['sample_duration'] > self.config.get('sparse_above_event_duration',
+                                                                                   float('inf'))
+        if sparse:
+            # Find the intervals covered by the pulses, and where each pulse starts in the concatenated intervals
+            contributing = np.where(self.raw_waveform_index[pulses.channel] >= 0)[0]
+            interval_left, interval_offset, covered_positions, n_covered = covered_intervals(
+                pulses.left[contributing], pulses.left[contributing] + pulses.n_samples[contributing] - 1)
+            positions = np.zeros(len(pulses), dtype=np.int64)
+            positions[contributing] = covered_positions
+            sparse_kwargs = dict(is_sparse=True, interval_left=interval_left, interval_offset=interval_offset)
+        else:
+            positions = pulses.left
+            n_covered = event.length()
+            sparse_kwargs = {}
+        hit_shift = (positions - pulses.left)[hits['found_in_pulse']]
+
+        # All sum waveforms are rows of one array
+        sum_waveforms = np.zeros((len(self.waveform_specs), n_covered), dtype=np.float32)
+        args = (pulses.samples, pulses.offset, pulses.n_samples, positions, pulses.channel, pulses.baseline,
+                hits['left'] + hit_shift, hits['right'] + hit_shift, pulse_hit_start,
+                self.hits_waveform_index, self.raw_waveform_index, self.adc_to_pe,
+                float(self.config['digitizer_reference_baseline']), sum_waveforms)
+        if dsputils.use_parallel_kernels(self.config, len(pulses)):
+            add_to_sum_waveforms_parallel(*(args + (4 * numba.config.NUMBA_NUM_THREADS,)))
+        else:
+            add_to_sum_waveforms(*(args + (0, n_covered)))
+
+        # The tpc sum waveform is the sum of the top and bottom ones
+        tpc, tpc_top, tpc_bottom = self.tpc_rows
+        np.add(sum_waveforms[tpc_top], sum_waveforms[tpc_bottom], out=sum_waveforms[tpc])
+
+        for i, (name, detector, channels) in enumerate(self.waveform_specs):
             event.sum_waveforms.append(datastructure.SumWaveform(
-                samples=np.zeros(event.length(), dtype=np.float32),
-                name='tpc_%s' % q,
-                channel_list=np.array(self.config['channels_%s' % q], dtype=np.uint16),
-                detector='tpc'
+                samples=sum_waveforms[i],
+                name=name,
+                channel_list=np.array(list(channels), dtype=np.uint16),
+                detector=detector,
+                **sparse_kwargs
             ))
 
-        for pulse_i, pulse in enumerate(event.pulses):
-            channel = pulse.channel
-
-            # Do some initialization only when we switch channel
-            # The 'current_channel' variable can't be pulled outside the loop, that would hurt performance
-            # (trust me, try it and time it)
-            if pulse_i == 0 or channel != current_channel:      # noqa
-                current_channel = channel                       # noqa
-                detector = self.detector_by_channel[channel]
-                adc_to_pe = dsputils.adc_to_pe(self.config, channel)
-
-                if detector == 'tpc':
-                    if channel in self.config['channels_top']:
-                        sum_w = event.get_sum_waveform('tpc_top')
-                    else:
-                        sum_w = event.get_sum_waveform('tpc_bottom')
-                else:
-                    sum_w = event.get_sum_waveform(detector)
-
-            # Don't consider dead channels
-            if self.config['gains'][channel] == 0:
-                continue
-
-            # Get the pulse waveform in pe/bin
-            baseline_to_subtract = self.config['digitizer_reference_baseline'] - pulse.baseline
-            w = baseline_to_subtract - pulse.raw_data.astype(np.float64)
-            w *= adc_to_pe
-
-            sum_w_raw = event.get_sum_waveform(detector+'_raw').samples
-            sum_w_raw[pulse.left:pulse.right+1] += w
-
-            hits = hits_per_pulse.get(pulse_i, None)
-            if hits is None:
-                continue
-
-            w_hits_only = w.copy()
-            # Obtain an array of same length as w, indicating whether the sample is in a hit or not
-            mask = np.zeros(len(w), dtype=np.bool)
-            set_if_in_ranges(mask, hits['left'] - pulse.left, hits['right'] - pulse.left)
-            w_hits_only[True ^ mask] = 0
-
-            sum_w.samples[pulse.left:pulse.right+1] += w_hits_only
-
-        # Sum the tpc top and bottom tpc waveforms
-        event.get_sum_waveform('tpc').samples = event.get_sum_waveform('tpc_top').samples + \
-            event.get_sum_waveform('tpc_bottom').samples
-
         return event
 
 
-@numba.jit(numba.void(numba.bool_[:], numba.int64[:], numba.int64[:]), nopython=True)
-def set_if_in_ranges(w, left, right):
-    """Set samples in w to True between ranges indicated by left and right (both inclusive)"""
-    for i in range(len(left)):
-        w[left[i]:right[i]+1] = True
+def covered_intervals(lefts, rights):
+    """Return the intervals covered by the inclusive bounds [lefts, rights] (e.g. of pulses) as
+    (interval_left, interval_offset, positions, n_covered):
+      - interval_left: sorted left bounds of the intervals. Overlapping or adjacent bounds are merged in one interval.
+      - interval_offset: index of the first sample of each interval, if the samples of all intervals are concatenated
+      - positions: index of each of the lefts in the concatenated intervals
+      - n_covered: total number of samples in the intervals
+    """
+    n = len(lefts)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), 0
+    order = np.argsort(lefts, kind='mergesort')
+    lefts = lefts[order].astype(np.int64)
+    reach = np.maximum.accumulate(rights[order].astype(np.int64))
+
+    starts_interval = np.ones(n, dtype=np.bool_)
+    starts_interval[1:] = lefts[1:] > reach[:-1] + 1
+    interval_i = np.cumsum(starts_interval) - 1
+    interval_left = lefts[starts_interval]
+    interval_right = reach[np.concatenate((np.where(starts_interval)[0][1:] - 1, [n - 1]))]
+
+    interval_length = interval_right - interval_left + 1
+    interval_offset = np.concatenate(([0], np.cumsum(interval_length)[:-1])).astype(np.int64)
+    positions = np.zeros(n, dtype=np.int64)
+    positions[order] = interval_offset[interval_i] + lefts - interval_left[interval_i]
+    return interval_left, interval_offset, positions, int(interval_length.sum())
+
+
+def _sum_waveform_kernel_signature(sample_type, *extra_arg_types):
+    return numba.void(sample_type[:], numba.int64[:], numba.int64[:], numba.int64[:], numba.int64[:],
+                      numba.float64[:],
+                      numba.int64[:], numba.int64[:], numba.int64[:],
+                      numba.int64[:], numba.int64[:], numba.float64[:],
+                      numba.float64, numba.float32[:, :], *extra_arg_types)
+
+
+@jit([_sum_waveform_kernel_signature(t, numba.int64, numba.int64) for t in raw_data_types],
+     nopython=True)
+def add_to_sum_waveforms(samples, offsets, n_samples, positions, channels, baselines,
+                         hit_lefts, hit_rights, pulse_hit_start,
+                         hits_waveform_index, raw_waveform_index, adc_to_pe,
+                         reference_baseline, sum_waveforms, start, stop):
+    """Add the pulses of an event (given by PulseTable columns) to the sum waveforms, for samples start to stop
+    (exclusive) in the rows of sum_waveforms.
+      - positions: index in the rows of sum_waveforms of the first sample of each pulse
+      - hit_lefts, hit_rights: bounds of the hits (also as indices in the rows of sum_waveforms), sorted by pulse and
+        left bound. The hits of pulse i are hit_lefts[pulse_hit_start[i]:pulse_hit_start[i + 1]]
+      - hits_waveform_index, raw_waveform_index, adc_to_pe: per-channel lookup tables of the row in sum_waveforms
+        of the hits-only and raw sum waveform the channel is added to (-1 to skip the channel), and the gain
+        conversion factor.
+    Overlapping hits in a pulse contribute their common samples only once.
+    """
+    for pulse_i in range(len(offsets)):
+        channel = channels[pulse_i]
+        raw_row = raw_waveform_index[channel]
+        if raw_row < 0:
+            continue
+        hits_row = hits_waveform_index[channel]
+        left = positions[pulse_i]
+        n = n_samples[pulse_i]
+        # Indices in the pulse that are within start, stop
+        pulse_start = max(0, start - left)
+        pulse_stop = min(n, stop - left)
+        if pulse_start >= pulse_stop:
+            continue
+        offset = offsets[pulse_i]
+        baseline_to_subtract = reference_baseline - baselines[pulse_i]
+        conversion = adc_to_pe[channel]
+
+        # Raw sum waveform: the entire pulse
+        for i in range(pulse_start, pulse_stop):
+            sum_waveforms[raw_row, left + i] += (baseline_to_subtract - samples[offset + i]) * conversion
+
+        # Hits-only sum waveform
+        covered_until = -1
+        for hit_i in range(pulse_hit_start[pulse_i], pulse_hit_start[pulse_i + 1]):
+            hit_right = hit_rights[hit_i] - left
+            first = max(hit_lefts[hit_i] - left, covered_until + 1, pulse_start)
+            for i in range(first, min(hit_right + 1, pulse_stop)):
+                sum_waveforms[hits_row, left + i] += (baseline_to_subtract - samples[offset + i]) * conversion
+            covered_until = max(covered_until, hit_right)
+
+
+@jit([_sum_waveform_kernel_signature(t, numba.int64) for t in raw_data_types],
+     nopython=True, parallel=True)
+def add_to_sum_waveforms_parallel(samples, offsets, n_samples, positions, channels, baselines,
+                                  hit_lefts, hit_rights, pulse_hit_start,
+                                  hits_waveform_index, raw_waveform_index, adc_to_pe,
+                                  reference_baseline, sum_waveforms, n_chunks):
+    """Multi-threaded version of add_to_sum_waveforms, for the entire event.
+    The sum waveforms are split in n_chunks time ranges, each of which is done by one thread: so threads never add
+    to the same sample, and each sample gets its contributions in the same order as in add_to_sum_waveforms.
+    """
+    n_covered = sum_waveforms.shape[1]
+    chunk_size = n_covered // n_chunks + 1
+    for chunk_i in numba.prange(n_chunks):
+        add_to_sum_waveforms(samples, offsets, n_samples, positions, channels, baselines,
+                             hit_lefts, hit_rights, pulse_hit_start,
+                             hits_waveform_index, raw_waveform_index, adc_to_pe,
+                             reference_baseline, sum_waveforms,
+                             chunk_i * chunk_size, min((chunk_i + 1) * chunk_size, n_covered))
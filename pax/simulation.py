@@ -11,8 +11,6 @@ import pickle
 from functools import partial
 
 import numpy as np
-import multihist    # noqa   # Not explicitly used, but pickle of gas gap warping map is in this format
-from scipy import stats
 from scipy.interpolate import interp1d
 
 from pax import units, utils, datastructure
@@ -23,6 +21,10 @@ from pax.utils import Memoize
 log = logging.getLogger('SimulationCore')
 
 
+def load_noise_data(filename):
+    return np.load(filename)['arr_0']
+
+
 class Simulator(object):
 
     def __init__(self, config_to_init):
@@ -79,28 +81,30 @@ class Simulator(object):
 
         # Load real noise data from file, if requested
         if c['real_noise_file']:
-            self.noise_data = np.load(utils.data_file_name(c['real_noise_file']))['arr_0']
+            self.noise_data = utils.cached_resource(load_noise_data, utils.data_file_name(c['real_noise_file']))
             # The silly XENON100 PMT offset again: it's relevant for indexing the array of noise data
             # (which is one row per channel)
             self.channel_offset = 1 if c['pmt_0_is_fake'] else 0
 
         # Load light yields
-        self.s1_light_yield_map = InterpolatingMap(utils.data_file_name(c['s1_light_yield_map']))
-        self.s2_light_yield_map = InterpolatingMap(utils.data_file_name(c['s2_light_yield_map']))
+        self.s1_light_yield_map = utils.cached_resource(InterpolatingMap, utils.data_file_name(c['s1_light_yield_map']))
+        self.s2_light_yield_map = utils.cached_resource(InterpolatingMap, utils.data_file_name(c['s2_light_yield_map']))
 
         # Load transverse field (r,z) distortion map
         if c.get('rz_position_distortion_map'):
-            self.rz_position_distortion_map = InterpolatingMap(utils.data_file_name(c['rz_position_distortion_map']))
+            self.rz_position_distortion_map = utils.cached_resource(
+                InterpolatingMap, utils.data_file_name(c['rz_position_distortion_map']))
         else:
             self.rz_position_distortion_map = None
 
         # Init s2 per pmt lce map
         qes = np.array(c['quantum_efficiencies'])
         if c.get('s2_patterns_file', None) is not None:
-            self.s2_patterns = PatternFitter(filename=utils.data_file_name(c['s2_patterns_file']),
-                                             zoom_factor=c.get('s2_patterns_zoom_factor', 1),
-                                             adjust_to_qe=qes[c['channels_top']],
-                                             default_errors=c['relative_qe_error'] + c['relative_gain_error'])
+            self.s2_patterns = utils.cached_resource(PatternFitter,
+                                                     filename=utils.data_file_name(c['s2_patterns_file']),
+                                                     zoom_factor=c.get('s2_patterns_zoom_factor', 1),
+                                                     adjust_to_qe=qes[c['channels_top']],
+                                                     default_errors=c['relative_qe_error'] + c['relative_gain_error'])
         else:
             self.s2_patterns = None
 
@@ -137,10 +141,11 @@ class Simulator(object):
         # NB: do NOT adjust patterns for QE, map is data derived, so no need.
         log.debug("Initializing s1 patterns...")
         if c.get('s1_patterns_file', None) is not None:
-            self.s1_patterns = PatternFitter(filename=utils.data_file_name(c['s1_patterns_file']),
-                                             zoom_factor=c.get('s1_patterns_zoom_factor', 1),
-                                             adjust_to_qe=qes[c['channels_in_detector']['tpc']],
-                                             default_errors=c['relative_qe_error'] + c['relative_gain_error'])
+            self.s1_patterns = utils.cached_resource(PatternFitter,
+                                                     filename=utils.data_file_name(c['s1_patterns_file']),
+                                                     zoom_factor=c.get('s1_patterns_zoom_factor', 1),
+                                                     adjust_to_qe=qes[c['channels_in_detector']['tpc']],
+                                                     default_errors=c['relative_qe_error'] + c['relative_gain_error'])
         else:
             self.s1_patterns = None
 
@@ -153,6 +158,7 @@ class Simulator(object):
         base_dg = c['elr_gas_gap_length']
         if gas_gap_warping_map is not None:
             with open(utils.data_file_name(gas_gap_warping_map), mode='rb') as infile:
+                # This is a multihist histogram: unpickling imports multihist (which is slow to import) for us
                 mh = pickle.load(infile)
             self.gas_gap_length = lambda x, y: base_dg + mh.lookup([x], [y]).item()
             self.luminescence_converters_dgs = np.linspace(mh.histogram.min(),
@@ -843,6 +849,7 @@ def exp_pulse(t, q, tr, tf):
 @Memoize
 def _truncated_gauss(my_mean, my_std, left_boundary, right_boundary):
     """NB: the mean & std are only used to fix the boundaries, this is still a standardized normal otherwise!"""
+    from scipy import stats     # Slow to import, and only needed if you simulate without a gain distribution
     return stats.truncnorm(
         (left_boundary - my_mean) / my_std,
         (right_boundary - my_mean) / my_std)
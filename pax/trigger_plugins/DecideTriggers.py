@@ -1,5 +1,5 @@
 import numpy as np
-import numba
+from pax.numba_cache import jit
 import random
 from pax.trigger import TriggerPlugin
 from pax.trigger import TriggerSignal
@@ -30,7 +30,7 @@ class DecideTriggers(TriggerPlugin):
         flag_triggers(data.signals, p_matrix=self.p_matrix)
 
 
-@numba.jit(nopython=True)
+@jit(nopython=True)
 def flag_triggers(signals, p_matrix):
     """Decide which signals trigger, modifying signals in-place.
     p_matrix[signal_type][n_pulses] is the probability of a signal of type signal_type and n_pulses pulses to trigger
@@ -1,5 +1,5 @@
 import numpy as np
-import numba
+from pax.numba_cache import jit
 from pax.trigger import TriggerPlugin
 from pax.datastructure import TriggerSignal
 from pax.dsputils import adc_to_pe
@@ -135,7 +135,7 @@ def signal_finder(times, signal_separation,
                           area_per_channel, does_channel_contribute)
 
 
-@numba.jit()
+@jit()
 def _signal_finder(times, signal_separation,
                    signal_buffer,
                    next_save_time, dark_rate_save_interval,
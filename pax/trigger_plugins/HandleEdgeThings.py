@@ -1,5 +1,5 @@
 import numpy as np
-import numba
+from pax.numba_cache import jit
 
 from pax.trigger import TriggerPlugin, pulse_dtype
 from pax.datastructure import TriggerSignal
@@ -70,7 +70,7 @@ class HandleEdgeSignals(TriggerPlugin):
         data.batch_info_doc['signals_saved_for_next_batch'] = len(self.saved_signals)
 
 
-@numba.jit(nopython=True)
+@jit(nopython=True)
 def find_last_break(times, last_time, break_time):
     """Return the last index in times after which there is a gap >= break_time.
     If the last entry in times is further than signal_separation from last_time,
@@ -1,4 +1,4 @@
-import numba
+from pax.numba_cache import jit
 import numpy as np
 from pax.trigger import TriggerPlugin
 from pax.exceptions import TriggerGroupSignals
@@ -44,7 +44,7 @@ class SaveSignals(TriggerPlugin):
                 self.trigger.save_monitor_data('trigger_signals_histogram', hist)
 
 
-@numba.jit(nopython=True)
+@jit(nopython=True)
 def group_signals(signals, event_ranges, signal_indices_buffer, is_in_event):
     """Fill signal_indices_buffer with array of (left, right) indices
     indicating which signals belong in which event range.
@@ -1,5 +1,5 @@
 import numpy as np
-import numba
+from pax.numba_cache import jit
 
 from pax.trigger import TriggerPlugin, pulse_dtype
 
@@ -53,7 +53,7 @@ class SortData(TriggerPlugin):
         del data.input_data
 
 
-@numba.jit(nopython=True)
+@jit(nopython=True)
 def get_pmt_numbers(channels, modules, pmts_buffer, pmt_lookup):
     """Fills pmts_buffer with pmt numbers corresponding to channels, modules according to pmt_lookup matrix:
      - pmt_lookup: lookup matrix for pmt numbers. First index is digitizer module, second is digitizer channel.
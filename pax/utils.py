@@ -6,6 +6,8 @@ e.g. a list clustering routine that isn't in some standard, library but several
 
 import re
 import sys
+import bisect
+import math
 import inspect
 import random
 import string
@@ -69,6 +71,40 @@ class Memoize:
             return self.memoized[args]
 
 
+# Large read-only objects (maps, pattern files, noise data...) already loaded in this process, see cached_resource.
+# None unless process caches are enabled, see core.enable_process_caches.
+resource_cache = None
+
+
+def cached_resource(constructor, *args, **kwargs):
+    """Return constructor(*args, **kwargs). If process caches are enabled (see core.enable_process_caches), reuse the
+    result of an earlier call with the same arguments instead: Processors created later in the same process
+    -- including processes forked from it, see parallel.multiprocess_locally(prewarm=True) -- then share them.
+    Use only for large objects which are never modified after they are loaded, e.g. InterpolatingMaps.
+    """
+    if resource_cache is None:
+        return constructor(*args, **kwargs)
+    key = (constructor, hashable(args), hashable(kwargs))
+    if key not in resource_cache:
+        resource_cache[key] = constructor(*args, **kwargs)
+    return resource_cache[key]
+
+
+def hashable(x):
+    """Return a hashable version of x, converting lists, dicts and numpy arrays to (nested) tuples"""
+    if hasattr(x, 'tolist'):
+        x = x.tolist()
+    if isinstance(x, dict):
+        return tuple(sorted((k, hashable(v)) for k, v in x.items()))
+    if isinstance(x, (list, tuple)):
+        return tuple(hashable(v) for v in x)
+    return x
+
+
+# time.perf_counter is not available on python 2
+perf_counter = getattr(time, 'perf_counter', time.time)
+
+
 class Timer:
     """Simple stopwatch timer
     punch() returns ms since timer creation or last punch
@@ -79,12 +115,96 @@ class Timer:
         self.punch()
 
     def punch(self):
-        now = time.time()
+        now = perf_counter()
         result = (now - self.last_t) * 1000
         self.last_t = now
         return result
 
 
+class LatencyHistogram(object):
+    """Fixed-bucket histogram of the time (in ms) spent on single events.
+    Buckets are logarithmically spaced (buckets_per_decade per factor 10) between min_ms and max_ms; values outside
+    end up in the first or last bucket. Besides the histogram, we keep the time spent vs. the number of pulses in the
+    event, in bins 0, 1, 2-3, 4-7, 8-15, ... pulses.
+    """
+
+    def __init__(self, min_ms=1e-3, max_ms=1e6, buckets_per_decade=20):
+        n_edges = int(round(math.log10(max_ms / min_ms) * buckets_per_decade)) + 1
+        self.edges = [min_ms * 10 ** (i / float(buckets_per_decade)) for i in range(n_edges)]
+        self.counts = [0] * (n_edges + 1)
+        self.n = 0
+        self.total = 0
+        self.max = 0
+        self.by_n_pulses = {}    # pulse bin index -> [number of events, total time (ms)]
+
+    def add(self, t, n_pulses=0):
+        """Record an event which took t ms to process, and had n_pulses pulses"""
+        self.counts[bisect.bisect_left(self.edges, t)] += 1
+        self.n += 1
+        self.total += t
+        self.max = max(self.max, t)
+        b = self.by_n_pulses.setdefault(pulse_bin(n_pulses), [0, 0])
+        b[0] += 1
+        b[1] += t
+
+    def percentile(self, q):
+        """Return the q-th percentile (0-100) of the recorded times, i.e. the upper edge of the bucket it falls in.
+        Returns 0 if nothing has been recorded.
+        """
+        if not self.n:
+            return 0
+        needed = q / 100. * self.n
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= needed and c:
+                return min(self.edges[min(i, len(self.edges) - 1)], self.max)
+        return self.max
+
+    def merge(self, other):
+        """Add the contents of another LatencyHistogram (with the same buckets) to this one"""
+        if other.edges != self.edges:
+            raise ValueError("Cannot merge latency histograms with different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.n += other.n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for k, (n, t) in other.by_n_pulses.items():
+            b = self.by_n_pulses.setdefault(k, [0, 0])
+            b[0] += n
+            b[1] += t
+
+    @classmethod
+    def from_dict(cls, d):
+        """Reconstruct a LatencyHistogram from the output of to_dict"""
+        self = cls.__new__(cls)
+        self.edges = list(d['edges'])
+        self.counts = list(d['counts'])
+        self.n = d['n']
+        self.total = d['total']
+        self.max = d['max']
+        self.by_n_pulses = {pulse_bin(int(label.split('-')[0])): [x['n'], x['total']]
+                            for label, x in d['by_n_pulses'].items()}
+        return self
+
+    def to_dict(self):
+        return dict(edges=self.edges, counts=self.counts, n=self.n, total=self.total, max=self.max,
+                    percentiles={str(q): self.percentile(q) for q in (50, 90, 99)},
+                    by_n_pulses={pulse_bin_label(k): dict(n=n, total=t)
+                                 for k, (n, t) in sorted(self.by_n_pulses.items())})
+
+
+def pulse_bin(n_pulses):
+    """Index of the pulse count bin: 0 for 0 pulses, 1 for 1, 2 for 2-3, 3 for 4-7, etc."""
+    return int(n_pulses).bit_length()
+
+
+def pulse_bin_label(b):
+    if b <= 1:
+        return str(b)
+    return '%d-%d' % (2 ** (b - 1), 2 ** b - 1)
+
+
 def randomstring(n):
     return ''.join(random.choice(string.ascii_letters) for _ in range(n))
 
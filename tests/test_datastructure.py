@@ -7,11 +7,29 @@ test_pax
 
 Tests for `pax` module.
 """
+import os
+import pickle
+import subprocess
+import sys
 import unittest
 
 import numpy as np
 
-from pax.datastructure import Event, Peak, SumWaveform
+from pax.datastructure import Event, Peak, SumWaveform, Pulse, PulseTable, PeakTable, ReconstructedPosition
+
+# Builds and serializes an event; run in a fresh interpreter, since fast model mode is chosen when pax is imported
+FAST_MODEL_SCRIPT = """
+import pickle, sys
+import numpy as np
+from pax.datastructure import Event, Peak, ReconstructedPosition
+e = Event(n_channels=3, start_time=0, length=100, sample_duration=10)
+e.peaks = [Peak(left=np.int64(10), area=np.float32(1.5), reconstructed_positions=[ReconstructedPosition(x=1.0)])]
+e.peaks[0].type = 's1'
+e.peaks[0].hits_per_channel = np.ones(3, dtype=np.int16)
+e.event_number = np.int64(3)
+e = pickle.loads(pickle.dumps(e))
+sys.stdout.write('%s %s' % (hasattr(e.peaks[0], '__dict__'), e.to_json()))
+"""
 
 
 class TestDatastructure(unittest.TestCase):
@@ -139,6 +157,184 @@ class TestDatastructure(unittest.TestCase):
         self.assertIsInstance(w.samples, np.ndarray)
         self.assertEqual(w.samples.dtype, np.float32)
 
+    def test_sparse_sum_waveform(self):
+        # Dense: samples 0-9 of the event
+        dense = np.zeros(10, dtype=np.float32)
+        dense[2:5] = [1, 2, 3]
+        dense[7:9] = [4, 5]
+        w = SumWaveform(samples=dense)
+        np.testing.assert_array_equal(w.get_samples(3, 7), [2, 3, 0, 0, 4])
+
+        # Sparse: only intervals 2-4 and 7-8 are stored
+        w = SumWaveform(samples=np.array([1, 2, 3, 4, 5], dtype=np.float32),
+                        is_sparse=True,
+                        interval_left=np.array([2, 7], dtype=np.int64),
+                        interval_offset=np.array([0, 3], dtype=np.int64))
+        for left, right in ((0, 9), (3, 7), (3, 4), (7, 7), (5, 6), (0, 1), (9, 12)):
+            np.testing.assert_array_equal(w.get_samples(left, right), dense[left:right + 1].tolist() +
+                                          [0] * max(0, right - 9))
+        # Inside one interval we get a view
+        self.assertIs(w.get_samples(3, 4).base, w.samples)
+
+    def test_field_schema(self):
+        schema = Peak.get_field_schema()
+        self.assertIs(Peak.get_field_schema(), schema)
+        self.assertEqual(list(schema.names), sorted(k for k, v in Peak().get_fields_data()))
+        self.assertEqual(schema.kinds['area'], 'scalar')
+        self.assertEqual(schema.kinds['area_per_channel'], 'array')
+        self.assertEqual(schema.kinds['hits'], 'structured_array')
+        self.assertEqual(schema.kinds['reconstructed_positions'], 'list')
+        self.assertEqual(schema.list_field_info, {'reconstructed_positions': ReconstructedPosition})
+        self.assertNotIn('range_50p_area', schema.kinds)
+        self.assertNotIn('get_position_from_preferred_algorithm', schema.kinds)
+
+    def event_with_pulses(self):
+        e = Event.empty_event()
+        e.pulses = [Pulse(channel=i, left=10 * i, raw_data=np.arange(i + 1, dtype=np.int16))
+                    for i in range(4)]
+        return e
+
+    def test_pulse_table(self):
+        e = self.event_with_pulses()
+        as_json = e.to_json()
+        table = e.get_pulse_table()
+        self.assertIs(e.get_pulse_table(), table)
+        self.assertEqual(len(table), 4)
+        np.testing.assert_array_equal(table.samples, [0, 0, 1, 0, 1, 2, 0, 1, 2, 3])
+        np.testing.assert_array_equal(table.offset, [0, 1, 3, 6])
+        np.testing.assert_array_equal(table.channel, [0, 1, 2, 3])
+        np.testing.assert_array_equal(table.right, [0, 11, 22, 33])
+        self.assertEqual(e.to_json(), as_json)
+
+        # Pulses are views into the table
+        pulse = e.pulses[2]
+        self.assertIsInstance(pulse, Pulse)
+        self.assertIs(pulse.get_output_class(), Pulse)
+        self.assertIs(pulse.get_field_schema(), Pulse.get_field_schema())
+        pulse.baseline = 3.5
+        self.assertEqual(table.baseline[2], 3.5)
+        table.noise_sigma[2] = 0.5
+        self.assertEqual(pulse.noise_sigma, 0.5)
+
+        # Shrinking the raw data doesn't copy, other data is appended to the buffer
+        pulse.raw_data = pulse.raw_data[1:]
+        self.assertEqual(len(table.samples), 10)
+        np.testing.assert_array_equal(pulse.raw_data, [1, 2])
+        pulse.raw_data = np.array([7, 7, 7], dtype=np.int16)
+        self.assertEqual(len(table.samples), 13)
+        np.testing.assert_array_equal(pulse.raw_data, [7, 7, 7])
+
+        # The buffer has spare capacity for more data: earlier views remain part of the table
+        raw_data = pulse.raw_data
+        e.pulses[0].raw_data = np.array([8, 8], dtype=np.int16)
+        self.assertTrue(np.may_share_memory(raw_data, table.samples))
+        np.testing.assert_array_equal(table.samples[-5:], [7, 7, 7, 8, 8])
+        e.pulses[0].raw_data = np.array([0], dtype=np.int16)
+        self.assertEqual(len(table.samples), 16)
+        np.testing.assert_array_equal(e.pulses[0].raw_data, [0])
+
+        e = pickle.loads(pickle.dumps(e))
+        np.testing.assert_array_equal(e.pulses[2].raw_data, [7, 7, 7])
+        self.assertIs(e.pulses[0]._table, e.pulses[3]._table)
+
+        # Floating-point raw data (e.g. from DesaturatePulses) is not truncated to int16
+        pulse.raw_data = np.array([0.5, 1.5])
+        self.assertEqual(table.samples.dtype, np.float64)
+        np.testing.assert_array_equal(pulse.raw_data, [0.5, 1.5])
+        np.testing.assert_array_equal(table.get_raw_data(3), [0, 1, 2, 3])
+
+    def test_serialized_arrays(self):
+        e = self.event_with_pulses()
+        d = e.to_dict(convert_numpy_arrays_to='buffer')
+        self.assertEqual(d['pulses'][3]['raw_data'].tobytes(), e.pulses[3].raw_data.tobytes())
+        e2 = Event(**d)
+        np.testing.assert_array_equal(e2.pulses[3].raw_data, [0, 1, 2, 3])
+
+        e2 = Event.from_bson(e.to_bson())
+        np.testing.assert_array_equal(e2.pulses[3].raw_data, [0, 1, 2, 3])
+        self.assertEqual(e2.pulses[3].raw_data.dtype, np.int16)
+        # Decoded arrays are writable, aligned views of one buffer
+        raw_data = e2.pulses[3].raw_data
+        self.assertTrue(raw_data.flags.writeable)
+        self.assertTrue(raw_data.flags.aligned)
+        raw_data[0] = 5
+        np.testing.assert_array_equal(e.pulses[3].raw_data, [0, 1, 2, 3])
+
+    def test_pulse_table_replaced(self):
+        e = self.event_with_pulses()
+        table = e.get_pulse_table()
+        e.pulses = e.pulses[::2]
+        new_table = e.get_pulse_table()
+        self.assertIsNot(new_table, table)
+        np.testing.assert_array_equal(new_table.channel, [0, 2])
+        self.assertEqual(len(PulseTable.from_pulses([])), 0)
+
+    def event_with_peaks(self):
+        e = Event(n_channels=3, start_time=0, length=100, sample_duration=10)
+        e.peaks = [Peak(left=10 * i, area=float(i), type='s%d' % (i % 2 + 1),
+                        area_per_channel=np.arange(3, dtype=np.float64) * i,
+                        hits_per_channel=np.ones(3, dtype=np.int16),
+                        n_saturated_per_channel=np.zeros(3, dtype=np.int16))
+                   for i in range(4)]
+        return e
+
+    def test_peak_table(self):
+        e = self.event_with_peaks()
+        as_json = e.to_json()
+        table = e.get_peak_table()
+        self.assertIs(e.get_peak_table(), table)
+        self.assertEqual(len(table), 4)
+        np.testing.assert_array_equal(table.left, [0, 10, 20, 30])
+        self.assertEqual(table.area_per_channel.shape, (4, 3))
+        np.testing.assert_array_equal(table.area_per_channel[2], [0, 2, 4])
+        self.assertEqual(e.to_json(), as_json)
+
+        # Peaks are views into the table
+        peak = e.peaks[1]
+        self.assertIsInstance(peak, Peak)
+        self.assertEqual(peak.type, 's2')
+        peak.area = 7
+        self.assertEqual(table.area[1], 7)
+        peak.area_per_channel[0] = 1
+        self.assertEqual(table.area_per_channel[1, 0], 1)
+        np.testing.assert_array_equal(peak.contributing_channels, [0, 1, 2])
+        peak.reconstructed_positions.append(ReconstructedPosition(x=1.0))
+        self.assertEqual(len(e.peaks[0].reconstructed_positions), 0)
+
+        # Appending grows the table
+        for i in range(20):
+            table.append(left=i)
+        self.assertEqual(len(table), 24)
+        self.assertEqual(e.peaks[1].area, 7)
+        self.assertEqual(table[-1].left, 19)
+        self.assertEqual(table[-1].type, 'unknown')
+
+        e = pickle.loads(pickle.dumps(e))
+        e.peaks[3].area = 2
+        self.assertEqual(e.get_peak_table().area[3], 2)
+        self.assertIs(e.peaks[0]._table, e.peaks[3]._table)
+
+    def test_peak_table_replaced(self):
+        e = self.event_with_peaks()
+        table = e.get_peak_table()
+        e.peaks = e.peaks[::-2] + [Peak(left=42)]
+        new_table = e.get_peak_table()
+        self.assertIsNot(new_table, table)
+        np.testing.assert_array_equal(new_table.left, [30, 10, 42])
+        np.testing.assert_array_equal(new_table.area_per_channel[2], [0, 0, 0])
+        self.assertEqual(len(PeakTable.from_peaks([], 3)), 0)
+        self.assertEqual(len(PeakTable(3).area), 0)
+
+    def test_fast_model(self):
+        results = {}
+        for fast_model in '01':
+            env = dict(os.environ, PAX_FAST_MODEL=fast_model)
+            results[fast_model] = subprocess.check_output([sys.executable, '-c', FAST_MODEL_SCRIPT],
+                                                          env=env).decode()
+        has_dict, as_json = results['1'].split(' ', 1)
+        self.assertEqual(has_dict, 'False')
+        self.assertEqual(results['0'], 'True ' + as_json)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -53,6 +53,55 @@ class TestHitFinder(unittest.TestCase):
 
         delattr(self, 'pax')
 
+    def process_random_event(self, plugins, max_hits_per_pulse=4, **config):
+        mypax = core.Processor(config_names='XENON100',
+                               just_testing=True,
+                               config_dict={
+                                   'pax': {
+                                       'plugin_group_names': ['test'],
+                                       'encoder_plugin': None,
+                                       'decoder_plugin': None,
+                                       'test': plugins},
+                                   'PulseProperties': config,
+                                   # By default small enough that the hit buffers must grow
+                                   'HitFinder': dict(max_hits_per_pulse=max_hits_per_pulse, **config)})
+        rs = np.random.RandomState(0)
+        e = datastructure.Event(n_channels=mypax.config['DEFAULT']['n_channels'],
+                                start_time=0,
+                                sample_duration=mypax.config['DEFAULT']['sample_duration'],
+                                stop_time=int(1e6),
+                                pulses=[dict(left=1000 * i,
+                                             raw_data=(16000 - rs.randint(-5, 40, size=100)).astype(np.int16),
+                                             channel=i)
+                                        for i in range(10)])
+        return mypax.process_event(e)
+
+    def assert_same_hits(self, e1, e2):
+        np.testing.assert_array_equal(e1.all_hits, e2.all_hits)
+        for field_name in ('baseline', 'baseline_increase', 'noise_sigma', 'minimum', 'maximum',
+                           'hitfinder_threshold', 'n_hits_found'):
+            self.assertEqual([getattr(p, field_name) for p in e1.pulses],
+                             [getattr(p, field_name) for p in e2.pulses])
+        np.testing.assert_array_equal(e1.noise_pulses_in, e2.noise_pulses_in)
+
+    def test_fused_hitfinder(self):
+        # Pulse property computation and hitfinding in one pass must give the same result as the two plugins
+        self.assert_same_hits(self.process_random_event(['PulseProperties.PulseProperties', 'HitFinder.FindHits']),
+                              self.process_random_event(['HitFinder.FindHitsAndPulseProperties']))
+
+    def test_hit_buffers_grow(self):
+        # Small initial hit buffers must not cause hits to be lost
+        plugins = ['PulseProperties.PulseProperties', 'HitFinder.FindHits']
+        e = self.process_random_event(plugins)
+        self.assertGreater(max(p.n_hits_found for p in e.pulses), 4)
+        self.assert_same_hits(e, self.process_random_event(plugins, max_hits_per_pulse=500))
+
+    def test_parallel_hitfinder(self):
+        # The multi-threaded kernels must give the same result as the single-threaded ones
+        plugins = ['PulseProperties.PulseProperties', 'HitFinder.FindHits']
+        self.assert_same_hits(self.process_random_event(plugins, numba_threads=1),
+                              self.process_random_event(plugins, numba_threads=2, parallel_kernel_min_pulses=0))
+
     def test_intervals_above_threshold(self):
         """Test of the "hitfinder part" of the hitfinder
         """
@@ -72,6 +121,17 @@ class TestHitFinder(unittest.TestCase):
             found = result_buffer[:hits_found]
             self.assertEqual(found.tolist(), a)
 
+            # The same intervals must be found on raw (inverted, offset) data, both int16 and float
+            for dtype in (np.int16, np.float64):
+                result_buffer = -1 * np.ones((100, 2), dtype=np.int64)
+                raw_data = (1000 - np.array(test_waveform) - 10).astype(dtype)
+                hits_found = dsputils.find_intervals_above_threshold_raw(raw_data,
+                                                                         reference_baseline=1000.0,
+                                                                         baseline=10.0,
+                                                                         threshold=0,
+                                                                         result_buffer=result_buffer)
+                self.assertEqual(result_buffer[:hits_found].tolist(), a)
+
     def test_left_right_extension(self):
         """Test of the "hitfinder part" of the hitfinder, now with left and right extension enabled
         """
@@ -151,6 +211,44 @@ class TestHitFinder(unittest.TestCase):
                 self.assertAlmostEqual(hits['sum_absolute_deviation'][i],
                                        np.average(np.abs(np.arange(len(hitw)) - (hits['center'][i] - l)), weights=hitw))
 
+            # Hits built from the raw data must be identical
+            raw_hits_buffer = np.zeros(100, dtype=datastructure.Hit.get_dtype())
+            HitFinder.build_hits_raw((1000 - w).astype(np.int16), 1000.0, 0.0,
+                                     raw_hits, raw_hits_buffer, 1, 1, 1, 1, 0, 0, 0, raw_hits)
+            np.testing.assert_array_equal(raw_hits_buffer[:len(raw_hits)], hits[:len(raw_hits)])
+
+    def test_find_hits_in_pulses(self):
+        # Test of the event-wide hitfinder kernel, which stops when the hits array is full so we can grow it
+        pulses = datastructure.PulseTable.from_pulses([
+            datastructure.Pulse(channel=ch, left=100 * ch, baseline=0.0, raw_data=np.array(w, dtype=np.int16))
+            for ch, w in enumerate(([0, -10, 0, -10], [0, 0, 0], [-10, -10, 0, 0, -10]))])
+        n = len(pulses)
+        ones = np.ones(n)
+        # reference_baseline, dt, left_extension, right_extension, single_hit_bounds,
+        # hit_bounds_buffer, central_bounds_buffer
+        args = (pulses.samples, pulses.offset, pulses.n_samples, pulses.left, pulses.channel,
+                pulses.baseline, np.ones(n, dtype=np.int64),
+                ones, ones, 1000 * ones, np.ones(n, dtype=np.bool_),
+                0.0, 1, 0, 0, np.zeros(0, dtype=np.int64),
+                -1 * np.ones((10, 2), dtype=np.int64), -1 * np.ones((10, 2), dtype=np.int64))
+        hits = np.zeros(2, dtype=datastructure.Hit.get_dtype())
+        self.assertEqual(HitFinder.find_hits(*(args + (hits, pulses.n_hits_found, 0, 0))),
+                         (HitFinder.HITS_BUFFER_FULL, 2, 2))
+
+        bigger_hits = np.zeros(4, dtype=datastructure.Hit.get_dtype())
+        bigger_hits[:2] = hits
+        self.assertEqual(HitFinder.find_hits(*(args + (bigger_hits, pulses.n_hits_found, 2, 2))), (4, 3, 4))
+        self.assertEqual(bigger_hits['left'].tolist(), [1, 3, 200, 204])
+        self.assertEqual(bigger_hits['right'].tolist(), [1, 3, 201, 204])
+        self.assertEqual(bigger_hits['found_in_pulse'].tolist(), [0, 0, 2, 2])
+        self.assertEqual(bigger_hits['area'].tolist(), [10, 10, 20, 10])
+        self.assertEqual(pulses.n_hits_found.tolist(), [2, 0, 2])
+
+        # A hit bounds buffer too small for a pulse's hits must also interrupt the hitfinder
+        small_bounds = (-1 * np.ones((2, 2), dtype=np.int64), -1 * np.ones((2, 2), dtype=np.int64))
+        self.assertEqual(HitFinder.find_hits(*(args[:-2] + small_bounds + (bigger_hits, pulses.n_hits_found, 0, 0))),
+                         (HitFinder.HIT_BOUNDS_BUFFER_FULL, 0, 0))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+import numpy as np
+
+from pax import datastructure
+from pax.plugins.signal_processing.HitFinder import build_hits_raw
+from pax.plugins.peak_processing.LocalMinimumClustering import split_hits
+
+
+class TestLocalMinimumClustering(unittest.TestCase):
+
+    def setUp(self):  # noqa
+        self.reference_baseline = 16000.0
+        self.dt = 10.0
+        self.adc_to_pe = np.array([0.01, 0.02, 0.005])
+        rs = np.random.RandomState(0)
+        self.pulses = datastructure.PulseTable.from_pulses([
+            datastructure.Pulse(channel=channel, left=left, right=left + 99,
+                                baseline=rs.uniform(-2, 2), noise_sigma=rs.uniform(1, 3),
+                                raw_data=(self.reference_baseline - rs.randint(-5, 100, 100)).astype(np.int16))
+            for channel, left in ((0, 0), (1, 50), (2, 20))])
+
+    def build_hits(self, raw_data, bounds, pulse_i):
+        """Return hits with bounds (indices in the event) in pulse_i, computed like the hitfinder does"""
+        pulses = self.pulses
+        channel = pulses.channel[pulse_i]
+        hits = np.zeros(len(bounds), dtype=datastructure.Hit.get_dtype())
+        baseline_to_subtract = self.reference_baseline - pulses.baseline[pulse_i]
+        bounds = np.array(bounds, dtype=np.int64) - pulses.left[pulse_i]
+        build_hits_raw(raw_data, baseline_to_subtract, 0.0, bounds, hits,
+                       self.adc_to_pe[channel], channel, pulses.noise_sigma[pulse_i] * self.adc_to_pe[channel],
+                       self.dt, pulses.left[pulse_i], pulse_i, baseline_to_subtract - 0.5, bounds)
+        return hits
+
+    def split_hits_reference(self, hits, split_points):
+        """Split hits at each of split_points in turn, one hit at a time"""
+        for x in split_points:
+            selection = (hits['left'] <= x) & (hits['right'] > x)
+            new_hits = [hits[True ^ selection]]
+            for h in hits[selection]:
+                pulse_i = h['found_in_pulse']
+                raw_data = self.pulses[pulse_i].raw_data
+                pieces = self.build_hits(raw_data, [[h['left'], x], [x + 1, h['right']]], pulse_i)
+                new_hits.append(pieces[pieces['area'] > 0])
+            hits = np.concatenate(new_hits)
+        return hits
+
+    def test_split_hits(self):
+        peak_hits = [np.concatenate([self.build_hits(self.pulses[0].raw_data, [[10, 40], [45, 60]], 0),
+                                     self.build_hits(self.pulses[1].raw_data, [[50, 90]], 1)]),
+                     self.build_hits(self.pulses[2].raw_data, [[20, 30], [32, 110]], 2)]
+        peak_split_points = [[30, 35, 55, 70], [40, 41]]
+
+        hits = np.concatenate(peak_hits)
+        peak_hit_start = np.cumsum([0] + [len(h) for h in peak_hits]).astype(np.int64)
+        split_points = np.concatenate(peak_split_points).astype(np.int64)
+        peak_split_start = np.cumsum([0] + [len(x) for x in peak_split_points]).astype(np.int64)
+        # Too small at first, to test the buffer full interrupt
+        result = np.zeros(len(hits), dtype=hits.dtype)
+        result_origin = np.zeros(len(hits), dtype=np.int64)
+        result_peak_start = np.zeros(len(peak_hits) + 1, dtype=np.int64)
+        piece_buffer = np.zeros(3, dtype=hits.dtype)
+        args = (hits, peak_hit_start, split_points, peak_split_start,
+                self.pulses.samples, self.pulses.offset, self.pulses.n_samples, self.pulses.left,
+                self.pulses.baseline, self.pulses.noise_sigma, self.adc_to_pe, self.reference_baseline, self.dt)
+        self.assertEqual(split_hits(*(args + (result, result_origin, result_peak_start, piece_buffer))), -1)
+
+        result = np.zeros(3 * len(hits), dtype=hits.dtype)
+        result_origin = np.zeros(3 * len(hits), dtype=np.int64)
+        n_hits = split_hits(*(args + (result, result_origin, result_peak_start, piece_buffer)))
+
+        for peak_i, (h, x) in enumerate(zip(peak_hits, peak_split_points)):
+            expected = self.split_hits_reference(h, x)
+            start, stop = result_peak_start[peak_i], result_peak_start[peak_i + 1]
+            np.testing.assert_array_equal(result[start:stop], expected)
+        self.assertEqual(result_peak_start[-1], n_hits)
+
+        # Hits that were not split are copied, the others are new
+        origin = result_origin[:n_hits]
+        np.testing.assert_array_equal(result[:n_hits][origin >= 0], hits[origin[origin >= 0]])
+        self.assertEqual(list(origin[origin >= 0]), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
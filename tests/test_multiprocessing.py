@@ -1,16 +1,26 @@
 import unittest
+import gc
+import multiprocessing
 import shutil
 import os
-from mock import MagicMock
+import threading
+from mock import MagicMock, patch, call
+
+import numpy as np
 
 try:
     import queue
 except ImportError:
     import Queue as queue   # flake8: noqa
 
-from pax.parallel import multiprocess_locally
+from pax import core, utils
+from pax.parallel import multiprocess_locally, multiprocess_configuration, merge_timing_stats
+from pax.parallel import make_merged_timing_report
+from pax.parallel import SharedMemoryQueue, shared_memory
 from pax.plugins.io.Queues import PullFromQueue, PushToQueue, NO_MORE_EVENTS, REGISTER_PUSHER, PUSHER_DONE
-from pax.datastructure import Event
+from pax.datastructure import Event, Pulse
+from pax.utils import LatencyHistogram
+from pax.exceptions import QueueTimeoutException
 
 
 def fake_events(n):
@@ -104,11 +114,205 @@ class TestMultiprocessing(unittest.TestCase):
         # Block sizes are correct
         self.assertEqual([len(x[1]) for x in blocks_out], [10, 10, 2])
 
+    def test_push_adaptive(self):
+        q = queue.Queue()
+        p = PushToQueue(dict(queue=q, target_block_bytes=1000, max_event_block_size=5), processor=MagicMock())
+        events = fake_events(12)
+        for i, e in enumerate(events):
+            # Events 3 and 4 are 'mega events', the rest are tiny
+            n_samples = 1000 if i in (3, 4) else 10
+            e.pulses.append(Pulse(channel=0, left=0, right=n_samples - 1,
+                                  raw_data=np.zeros(n_samples, dtype=np.int16)))
+            p.write_event(e)
+        p.shutdown()
+        blocks_out = [q.get() for _ in range(q.qsize())][:-1]
+        self.assertEqual([x[0] for x in blocks_out], list(range(len(blocks_out))))
+        self.assertEqual([len(x[1]) for x in blocks_out], [4, 1, 5, 2])
+
+        # Time-based: with a target time of zero, every block gets the minimum size
+        q = queue.Queue()
+        p = PushToQueue(dict(queue=q, target_block_time=0, min_event_block_size=3), processor=MagicMock())
+        for e in fake_events(7):
+            p.write_event(e)
+        p.shutdown()
+        blocks_out = [q.get() for _ in range(q.qsize())][:-1]
+        self.assertEqual([len(x[1]) for x in blocks_out], [3, 3, 1])
+
+    def test_push_preserveid_variable_blocks(self):
+        # Blocks of different sizes (e.g. from adaptive block sizing upstream) are pushed on as they are
+        q = queue.Queue()
+        p = PushToQueue(dict(queue=q, preserve_ids=True, event_block_size=2), processor=MagicMock())
+        events = fake_events(9)
+        for block_id, (start, stop) in enumerate([(0, 1), (1, 6), (6, 9)]):
+            for e in events[start:stop]:
+                e.block_id = block_id
+            p.write_events(events[start:stop])
+            # Each block is sent as soon as we're done with it
+            self.assertEqual(q.qsize(), block_id + 1)
+        p.shutdown()
+        blocks_out = [q.get() for _ in range(q.qsize())][:-1]
+        self.assertEqual([x[0] for x in blocks_out], [0, 1, 2])
+        self.assertEqual([len(x[1]) for x in blocks_out], [1, 5, 3])
+
+    def test_pull_latency(self):
+        # The puller should block on the queue until a block arrives, rather than sleep between polls
+        q = MagicMock()
+        events = fake_events(10)
+        q.get.side_effect = [queue.Empty(), (0, events)]
+        p = PullFromQueue(dict(queue=q), processor=MagicMock())
+        with patch('time.sleep') as sleep:
+            block = next(p.get_event_blocks())
+        self.assertEqual(len(block), 10)
+        self.assertEqual(q.get.call_args_list, [call(block=True, timeout=1)] * 2)
+        sleep.assert_not_called()
+
+    def test_push_backpressure(self):
+        # The pusher should block on a full queue until space frees up
+        q = queue.Queue(maxsize=1)
+        p = PushToQueue(dict(queue=q, event_block_size=10), processor=MagicMock())
+        q.put('something in the way')
+        threading.Timer(0.2, q.get).start()
+        for e in fake_events(10):
+            p.write_event(e)
+        self.assertEqual(q.qsize(), 1)
+        self.assertEqual(len(q.get()[1]), 10)
+
+        # ... but not forever
+        q.put('something in the way')
+        p = PushToQueue(dict(queue=q, event_block_size=10, timeout_after_sec=0.1), processor=MagicMock())
+        events = fake_events(10)
+        for e in events[:-1]:
+            p.write_event(e)
+        self.assertRaises(QueueTimeoutException, p.write_event, events[-1])
+
+    def test_worker_numba_threads(self):
+        def numba_threads(config_dict):
+            configs = multiprocess_configuration(2, 'test', dict(config_names='XENON100', config_dict=config_dict),
+                                                 {}, {}, worker_numba_threads=3)
+            return [(process_type, c['config_dict']['DEFAULT'].get('numba_threads')) for process_type, c in configs]
+
+        # By default, only the workers get their share of the cores
+        self.assertEqual(numba_threads({}), [('input', None), ('worker', 3), ('worker', 3), ('output', None)])
+        # ... but we don't override an explicit setting
+        self.assertEqual(numba_threads({'DEFAULT': {'numba_threads': 4}}), [('input', 4), ('worker', 4),
+                                                                             ('worker', 4), ('output', 4)])
+
+    def test_merge_timing_stats(self):
+        def fake_stats(events, plugin_times, waiting=0):
+            plugins = []
+            for name, t in plugin_times:
+                h = LatencyHistogram()
+                for _ in range(events):
+                    h.add(t / events)
+                plugins.append(dict(name=name, total_time_taken=t, time_waiting=waiting, timing=h.to_dict()))
+            return dict(events_processed=events, run_time=1000, plugins=plugins, upstream=[])
+
+        merged = merge_timing_stats([('input', fake_stats(10, [('Input', 100)])),
+                                     ('worker', fake_stats(4, [('Pull', 10), ('Work', 390)], waiting=100)),
+                                     ('worker', fake_stats(6, [('Pull', 10), ('Work', 590)], waiting=100)),
+                                     ('worker', None),
+                                     ('output', fake_stats(10, [('Output', 100)]))],
+                                    wall_time=2000)
+        self.assertEqual(merged['events_processed'], 10)
+        self.assertEqual(merged['events_per_second'], 5)
+        workers = merged['process_types']['worker']
+        self.assertEqual(workers['n_processes'], 2)
+        self.assertEqual(workers['events_processed'], 10)
+        self.assertEqual(workers['waiting_time'], 400)
+        self.assertAlmostEqual(workers['utilization'], 0.5)
+        plugins = {(p['process_type'], p['name']): p for p in merged['plugins']}
+        self.assertEqual(plugins[('worker', 'Work')]['total_time_taken'], 980)
+        self.assertAlmostEqual(plugins[('worker', 'Work')]['cpu_share'], 980 / 1200.)
+        self.assertEqual(plugins[('worker', 'Work')]['timing']['n'], 10)
+        self.assertIn('worker', make_merged_timing_report(merged))
+
+    @unittest.skipIf(shared_memory is None, "Shared memory requires python 3.8 or higher")
+    def test_shared_memory_queue(self):
+        manager = multiprocessing.Manager()
+        q = SharedMemoryQueue(manager, n_slots=2, slot_size=10000)
+        try:
+            events = fake_events(3)
+            for i, e in enumerate(events):
+                e.pulses.append(Pulse(channel=i, left=0, right=99, raw_data=np.arange(100, dtype=np.int16) * i))
+
+            q.put((0, events))                              # Goes through shared memory
+            q.put((1, [fake_events(1)[0]] * 100))           # No numpy arrays, so in-band
+            big = fake_events(1)[0]
+            big.pulses.append(Pulse(channel=0, left=0, right=9999, raw_data=np.zeros(10000, dtype=np.int16)))
+            q.put((2, [big]))                               # Too large for a slot, so in-band
+            self.assertEqual(q.qsize(), 3)
+
+            block_id, events_out = q.get()
+            self.assertEqual(block_id, 0)
+            for i, e in enumerate(events_out):
+                self.assertEqual(e.event_number, i)
+                np.testing.assert_array_equal(e.pulses[0].raw_data, np.arange(100, dtype=np.int16) * i)
+                self.assertTrue(e.pulses[0].raw_data.flags.writeable)
+            self.assertEqual(len(q.get()[1]), 100)
+            self.assertEqual(len(q.get()[1][0].pulses[0].raw_data), 10000)
+
+            # All slots have been released
+            self.assertEqual(q.free_slots.qsize(), 2)
+        finally:
+            q.close()
+            q.unlink()
+
+    @unittest.skipIf(shared_memory is None, "Shared memory requires python 3.8 or higher")
+    def test_shared_memory_queue_full(self):
+        # With more blocks than slots, the pusher waits for a free slot rather than pickling blocks in-band
+        manager = multiprocessing.Manager()
+        q = SharedMemoryQueue(manager, n_slots=2, slot_size=10000)
+        try:
+            events = fake_events(1)
+            events[0].pulses.append(Pulse(channel=0, left=0, right=99, raw_data=np.arange(100, dtype=np.int16)))
+
+            slots_used = []
+            control_get = q.control.get
+
+            def recording_get(*args, **kwargs):
+                message = control_get(*args, **kwargs)
+                slots_used.append(message[0])
+                return message
+            q.control.get = recording_get
+
+            pusher = threading.Thread(target=lambda: [q.put((i, events)) for i in range(5)])
+            pusher.start()
+            pusher.join(timeout=0.5)
+            self.assertTrue(pusher.is_alive())
+            self.assertEqual(q.qsize(), 2)
+
+            for i in range(5):
+                block_id, events_out = q.get(timeout=10)
+                self.assertEqual(block_id, i)
+                np.testing.assert_array_equal(events_out[0].pulses[0].raw_data, np.arange(100, dtype=np.int16))
+            pusher.join()
+            self.assertEqual(len(slots_used), 5)
+            self.assertNotIn(None, slots_used)
+
+            # Without a consumer, a non-blocking put on a full queue fails
+            q.put((5, events))
+            q.put((6, events))
+            self.assertRaises(queue.Full, q.put, (7, events), block=False)
+            self.assertRaises(queue.Full, q.put, (7, events), timeout=0.1)
+        finally:
+            q.close()
+            q.unlink()
+
     def test_multiprocessing(self):
         multiprocess_locally(n_cpus=2,
                              config_names='XENON100',
                              config_dict=dict(pax=dict(stop_after=10)))
 
+    def test_multiprocessing_prewarm(self):
+        multiprocess_locally(n_cpus=2, prewarm=True,
+                             config_names='XENON100',
+                             config_dict=dict(pax=dict(stop_after=10)))
+        # Later processors in this process don't share the prewarmed state, which can be collected again
+        self.assertIsNone(core.plugin_modules)
+        self.assertIsNone(utils.resource_cache)
+        if hasattr(gc, 'get_freeze_count'):
+            self.assertEqual(gc.get_freeze_count(), 0)
+
     def test_process_event_list_multiprocessing(self):
         """Take a list of event numbers from a file, and process them on two cores
         """
@@ -0,0 +1,36 @@
+import unittest
+
+import numpy as np
+
+from pax.plugins.peak_processing.NaturalBreaksClustering import compute_split_goodness, compute_every_split_goodness
+
+
+class TestNaturalBreaksClustering(unittest.TestCase):
+
+    def test_every_split_goodness(self):
+        rs = np.random.RandomState(0)
+        for n_hits in (2, 3, 10, 200):
+            center = np.sort(rs.uniform(1e5, 1e5 + 1000, n_hits))
+            deviation = rs.uniform(0, 20, n_hits)
+            area = rs.exponential(10, n_hits)
+            split_indices = np.arange(1, n_hits, dtype=np.int64)
+            results = np.zeros(len(split_indices))
+            compute_every_split_goodness(np.ones(len(split_indices), dtype=np.int64), split_indices,
+                                         center, deviation, area, results)
+            expected = [compute_split_goodness(split_i, center, deviation, area) for split_i in split_indices]
+            np.testing.assert_allclose(results, expected, rtol=0, atol=1e-9)
+
+            # Only some split points
+            results = np.zeros(len(split_indices[::3]))
+            compute_every_split_goodness(np.ones(len(results), dtype=np.int64), split_indices[::3],
+                                         center, deviation, area, results)
+            np.testing.assert_allclose(results, expected[::3], rtol=0, atol=1e-9)
+
+    def test_split_index_check(self):
+        with self.assertRaises(ValueError):
+            compute_every_split_goodness(np.ones(1, dtype=np.int64), np.array([3], dtype=np.int64),
+                                         np.arange(3, dtype=np.float64), np.ones(3), np.ones(3), np.zeros(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
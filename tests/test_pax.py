@@ -10,9 +10,13 @@ Tests for `pax` module.
 
 import unittest
 import inspect
+import logging
 import tempfile
 import shutil
 import os
+import subprocess
+import sys
+import time
 
 from pax import core, plugin, datastructure
 
@@ -230,5 +234,24 @@ class TestPax(unittest.TestCase):
         shutil.rmtree('plots_test')
 
 
+class TestStartup(unittest.TestCase):
+
+    # Modules which take a long time to import, and which pax should only import when they are used.
+    slow_modules = ['matplotlib', 'pandas', 'h5py', 'rabbitpy', 'psutil', 'multihist', 'scipy.stats', 'ROOT']
+
+    def test_import_time(self):
+        # Import in a fresh interpreter, the test runner has probably imported all sorts of things already
+        code = ("import sys, time; t0 = time.time(); "
+                "import pax.core, pax.formats, pax.parallel, pax.PatternFitter; "
+                "print(time.time() - t0); "
+                "print(','.join(m for m in %s if m in sys.modules))" % self.slow_modules)
+        t0 = time.time()
+        output = subprocess.check_output([sys.executable, '-c', code]).decode().splitlines()
+        import_time, slow_imported = float(output[-2]), output[-1]
+        logging.getLogger('test_pax').info("Importing pax took %0.2f s (%0.2f s including interpreter startup)",
+                                           import_time, time.time() - t0)
+        self.assertEqual(slow_imported, '')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,7 +3,30 @@ import unittest
 import numpy as np
 from numpy import testing as np_testing
 
-from pax.plugins.peak_processing.BasicProperties import integrate_until_fraction, put_w_in_center_of_field
+from pax.datastructure import Hit
+from pax.plugins.peak_processing.BasicProperties import integrate_until_fraction, put_w_in_center_of_field, \
+    compute_peak_hit_properties, compute_sum_waveform_properties, _pairwise_sum, _buffered_pairwise_sum, \
+    SUM_WAVEFORM_ZERO
+
+
+def python_integrate_until_fraction(w, fractions_desired, results):
+    """integrate_until_fraction as it was done in python, with numpy scalars"""
+    area_tot = w.sum()
+    fraction_seen = 0
+    current_fraction_index = 0
+    needed_fraction = fractions_desired[current_fraction_index]
+    for i, x in enumerate(w):
+        fraction_this_sample = x/area_tot
+        while fraction_seen + fraction_this_sample >= needed_fraction:
+            area_needed = area_tot * (needed_fraction - fraction_seen)
+            results[current_fraction_index] = i + area_needed/x
+            current_fraction_index += 1
+            if current_fraction_index > len(fractions_desired) - 1:
+                return
+            needed_fraction = fractions_desired[current_fraction_index]
+        fraction_seen += fraction_this_sample
+    if needed_fraction == 1:
+        results[current_fraction_index] = len(w)
 
 
 class TestPeakProperties(unittest.TestCase):
@@ -22,6 +45,139 @@ class TestPeakProperties(unittest.TestCase):
         integrate_until_fraction(w, fractions_desired, result)
         np_testing.assert_almost_equal(result, fractions_desired, decimal=4)
 
+    def test_peak_hit_properties(self):
+        rs = np.random.RandomState(0)
+        n_channels = 10
+        n_hits = np.array([1, 5, 20])
+        hits = np.zeros(n_hits.sum(), dtype=Hit.get_dtype())
+        hits['channel'] = rs.randint(0, n_channels, len(hits))
+        hits['area'] = rs.exponential(10, len(hits))
+        hits['height'] = rs.exponential(5, len(hits))
+        hits['noise_sigma'] = rs.uniform(0.5, 2, len(hits))
+        hits['center'] = rs.uniform(0, 1000, len(hits))
+        hits['n_saturated'] = rs.randint(0, 3, len(hits))
+        peak_start = np.concatenate(([0], np.cumsum(n_hits))).astype(np.int64)
+
+        hits_per_channel = np.ones((len(n_hits), n_channels), dtype=np.int16)
+        n_saturated_per_channel = np.ones((len(n_hits), n_channels), dtype=np.int16)
+        results = [np.zeros(len(n_hits)) for _ in range(4)]
+        largest_hit_channel = np.zeros(len(n_hits), dtype=np.int64)
+        compute_peak_hit_properties(hits, peak_start, hits_per_channel, n_saturated_per_channel,
+                                    *(results + [largest_hit_channel]))
+        mean_amplitude_to_noise, hit_time_mean, hit_time_std, largest_hit_area = results
+
+        for peak_i in range(len(n_hits)):
+            h = hits[peak_start[peak_i]:peak_start[peak_i + 1]]
+            np_testing.assert_equal(hits_per_channel[peak_i], np.bincount(h['channel'], minlength=n_channels))
+            np_testing.assert_equal(n_saturated_per_channel[peak_i],
+                                    np.bincount(h['channel'], weights=h['n_saturated'], minlength=n_channels))
+            self.assertAlmostEqual(mean_amplitude_to_noise[peak_i],
+                                   np.average(h['height'] / h['noise_sigma'], weights=h['area']))
+            mean = np.average(h['center'], weights=h['area'])
+            self.assertAlmostEqual(hit_time_mean[peak_i], mean)
+            self.assertAlmostEqual(hit_time_std[peak_i], np.average((h['center'] - mean)**2, weights=h['area'])**0.5)
+            self.assertEqual(largest_hit_area[peak_i], h['area'].max())
+            self.assertEqual(largest_hit_channel[peak_i], h['channel'][np.argmax(h['area'])])
+
+    def test_pairwise_sum(self):
+        rs = np.random.RandomState(0)
+        for n in (0, 1, 7, 8, 100, 128, 129, 1000, 10000, 20000):
+            w = rs.normal(0, 10, n).astype(np.float32)
+            self.assertEqual(_pairwise_sum(w, 0, n, np.float32(0)), w.sum())
+            self.assertEqual(_buffered_pairwise_sum(w, 0, n, 0.0), w.sum(dtype=np.float64))
+            x = w.astype(np.float64)
+            self.assertEqual(_pairwise_sum(x, 0, n, 0.0), x.sum())
+
+    def test_sum_waveform_properties(self):
+        rs = np.random.RandomState(0)
+        dt = 10.0
+        tight_coincidence_samples = 5.0
+        n_channels = 10
+        field_length = 251
+        fractions_desired = np.linspace(0, 1, 21)
+        samples = rs.exponential(1, 30000).astype(np.float32) - 0.2
+        samples[590:611] = 0
+        top_samples = (samples * 0.3).astype(np.float32)
+        lefts = np.array([10, 100, 600, 700, 5000], dtype=np.int64)
+        rights = np.array([30, 500, 605, 1900, 25000], dtype=np.int64)
+        n_peaks = len(lefts)
+
+        hits = np.zeros(20 * n_peaks, dtype=Hit.get_dtype())
+        hits['channel'] = rs.randint(0, n_channels, len(hits))
+        peak_hit_start = np.arange(0, len(hits) + 1, 20, dtype=np.int64)
+        for peak_i in range(n_peaks):
+            hits['index_of_maximum'][peak_hit_start[peak_i]:peak_hit_start[peak_i + 1]] = rs.randint(
+                lefts[peak_i], rights[peak_i] + 1, 20)
+
+        def compute(*intervals):
+            results = dict(status=np.zeros(n_peaks, dtype=np.int64),
+                           center_time=np.zeros(n_peaks),
+                           index_of_maximum=np.zeros(n_peaks, dtype=np.int64),
+                           height=np.zeros(n_peaks),
+                           area_midpoint=np.zeros(n_peaks),
+                           range_area_decile=np.zeros((n_peaks, 11)),
+                           area_decile_from_midpoint=np.zeros((n_peaks, 11)),
+                           tight_coincidence=np.zeros(n_peaks, dtype=np.int64),
+                           sum_waveform=np.zeros((n_peaks, field_length), dtype=np.float32),
+                           sum_waveform_top=np.zeros((n_peaks, field_length), dtype=np.float32))
+            compute_sum_waveform_properties(
+                np.arange(n_peaks), lefts, rights, hits, peak_hit_start,
+                *(intervals + (True, fractions_desired, dt, tight_coincidence_samples, n_channels) +
+                  tuple(results[k] for k in ('status', 'center_time', 'index_of_maximum', 'height', 'area_midpoint',
+                                             'range_area_decile', 'area_decile_from_midpoint', 'tight_coincidence',
+                                             'sum_waveform', 'sum_waveform_top'))))
+            return results
+
+        # Dense sum waveform: one interval
+        dense_intervals = (np.zeros(1, dtype=np.int64), np.array([len(samples) - 1]), np.zeros(1, dtype=np.int64))
+        results = compute(samples, *dense_intervals + (top_samples,) + dense_intervals)
+
+        # Compare with the properties computed peak by peak with numpy
+        for peak_i in range(n_peaks):
+            left = lefts[peak_i]
+            w = samples[left:rights[peak_i] + 1]
+            if w.sum() == 0:
+                self.assertEqual(results['status'][peak_i], SUM_WAVEFORM_ZERO)
+                np_testing.assert_equal(results['sum_waveform'][peak_i], 0)
+                continue
+            self.assertEqual(results['status'][peak_i], 0)
+            center_time = (left + np.average(np.arange(len(w)), weights=np.clip(w, 0, float('inf')))) * dt
+            self.assertEqual(results['center_time'][peak_i], center_time)
+            self.assertEqual(results['index_of_maximum'][peak_i], left + np.argmax(w))
+            self.assertEqual(results['height'][peak_i], w.max())
+
+            area_times = np.ones(21) * float('nan')
+            python_integrate_until_fraction(w, fractions_desired, area_times)
+            area_times *= dt
+            self.assertEqual(results['area_midpoint'][peak_i], area_times[10] + left * dt)
+            np_testing.assert_array_equal(results['range_area_decile'][peak_i], area_times[10:] - area_times[10::-1])
+            np_testing.assert_array_equal(results['area_decile_from_midpoint'][peak_i],
+                                          area_times[::2] - area_times[10])
+
+            x = hits['index_of_maximum'][peak_hit_start[peak_i]:peak_hit_start[peak_i + 1]]
+            channels = hits['channel'][peak_hit_start[peak_i]:peak_hit_start[peak_i + 1]]
+            index_of_maximum = results['index_of_maximum'][peak_i]
+            self.assertEqual(results['tight_coincidence'][peak_i],
+                             len(np.unique(channels[(x >= index_of_maximum - tight_coincidence_samples) &
+                                                    (x <= index_of_maximum + tight_coincidence_samples)])))
+
+            cog_idx = int(round(center_time / dt)) - left
+            for key, source in (('sum_waveform', w), ('sum_waveform_top', top_samples[left:rights[peak_i] + 1])):
+                field = np.zeros(field_length, dtype=np.float32)
+                put_w_in_center_of_field(source, field, cog_idx)
+                np_testing.assert_array_equal(results[key][peak_i], field)
+
+        # Sparse sum waveform, with the zero samples 590-610 left out: same results,
+        # even for the peak straddling the gap.
+        lefts[2] = 580
+        dense_results = compute(samples, *dense_intervals + (top_samples,) + dense_intervals)
+        sparse_intervals = (np.array([0, 611]), np.array([589, len(samples) - 1]), np.array([0, 590]))
+        keep = np.ones(len(samples), dtype=np.bool_)
+        keep[590:611] = False
+        sparse_results = compute(samples[keep], *sparse_intervals + (top_samples[keep],) + sparse_intervals)
+        for key, value in dense_results.items():
+            np_testing.assert_array_equal(sparse_results[key], value)
+
     def test_store_waveform(self):
         field = np.zeros(5)
         put_w_in_center_of_field(np.ones(3), field, 0)
@@ -0,0 +1,243 @@
+import json
+import os
+import tempfile
+import unittest
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue   # flake8: noqa
+
+from mock import MagicMock
+import numpy as np
+
+import pax
+from pax import core, dsputils, numba_cache, plugin, utils
+from pax.datastructure import Event, Peak, Hit
+from pax.plugins.io.Queues import PullFromQueue, NO_MORE_EVENTS
+
+
+def fake_events(n):
+    result = []
+    for i in range(n):
+        e = Event(n_channels=1, start_time=0, length=100, sample_duration=10)
+        e.event_number = i
+        result.append(e)
+    return result
+
+
+class PerEventPlugin(plugin.TransformPlugin):
+
+    def startup(self):
+        self.calls = []
+
+    def transform_event(self, event):
+        self.calls.append(event.event_number)
+        event.dataset_name = 'per_event'
+        return event
+
+
+class BatchedPlugin(plugin.TransformPlugin):
+
+    def startup(self):
+        self.calls = []
+
+    def transform_event(self, event):
+        return self.transform_events([event])[0]
+
+    def transform_events(self, events):
+        self.calls.append([e.event_number for e in events])
+        for e in events:
+            e.block_id = len(events)
+        return events
+
+
+class BatchedOutput(plugin.OutputPlugin):
+
+    def startup(self):
+        self.written = []
+
+    def write_event(self, event):
+        self.write_events([event])
+
+    def write_events(self, events):
+        self.written.append([e.event_number for e in events])
+
+
+class DropOddEvents(plugin.TransformPlugin):
+
+    def transform_events(self, events):
+        return [e for e in events if e.event_number % 2 == 0]
+
+
+class RebuildPeaks(plugin.ClusteringPlugin):
+
+    def cluster_peak(self, peak):
+        return [self.build_peak(hits=peak.hits, detector=peak.detector)]
+
+
+class TestBatchedPlugins(unittest.TestCase):
+
+    def setUp(self):
+        self.pax = core.Processor(just_testing=True, config_dict={'pax': {'plugin_group_names': []}})
+        self.per_event = PerEventPlugin({}, processor=self.pax)
+        self.batched = BatchedPlugin({}, processor=self.pax)
+        self.output = BatchedOutput({'output_name': 'nothing'}, processor=self.pax)
+        self.pax.action_plugins = [self.per_event, self.batched, self.output]
+
+    def test_has_batched_hook(self):
+        self.assertFalse(self.per_event.has_batched_hook())
+        self.assertTrue(self.batched.has_batched_hook())
+        self.assertTrue(self.output.has_batched_hook())
+
+    def test_process_events(self):
+        events = self.pax.process_events(fake_events(5))
+        self.assertEqual([e.event_number for e in events], list(range(5)))
+        self.assertEqual(self.per_event.calls, list(range(5)))
+        self.assertEqual(self.batched.calls, [list(range(5))])
+        self.assertEqual(self.output.written, [list(range(5))])
+        for e in events:
+            self.assertEqual(e.dataset_name, 'per_event')
+            self.assertEqual(e.block_id, 5)
+
+    def test_process_event(self):
+        # The single-event path still works for plugins with a batched hook
+        event = self.pax.process_event(fake_events(1)[0])
+        self.assertEqual(event.block_id, 1)
+        self.assertEqual(self.output.written, [[0]])
+
+    def test_batch_drops_events(self):
+        dropper = DropOddEvents({}, processor=self.pax)
+        self.pax.action_plugins = [self.per_event, dropper, self.batched, self.output]
+        events = self.pax.process_events(fake_events(5))
+        self.assertEqual([e.event_number for e in events], [0, 2, 4])
+        self.assertEqual(self.output.written, [[0, 2, 4]])
+        # Dropping all events
+        self.assertEqual(self.pax.process_events(fake_events(2)[1:]), [])
+        self.assertEqual(self.pax.process_events([]), [])
+        self.assertEqual(self.per_event.timing.n, 6)
+        self.assertEqual(dropper.timing.n, 6)
+        self.assertEqual(self.batched.timing.n, 3)
+        self.assertEqual(self.output.timing.n, 3)
+
+    def test_batch_checks_events(self):
+        with self.assertRaises(RuntimeError):
+            self.batched.process_events([fake_events(1)[0], 'not an event'])
+
+    def test_pull_blocks(self):
+        q = queue.Queue()
+        p = PullFromQueue(dict(queue=q, ordered_pull=True), processor=MagicMock())
+        events = fake_events(15)
+        q.put((1, events[10:]))
+        q.put((0, events[:10]))
+        q.put((NO_MORE_EVENTS, None))
+        blocks = list(p.get_event_blocks())
+        self.assertEqual([[e.event_number for e in b] for b in blocks],
+                         [list(range(10)), list(range(10, 15))])
+
+
+class TestClusteringPlugin(unittest.TestCase):
+
+    def test_peak_table_per_event(self):
+        pax = core.Processor(just_testing=True, config_dict={'pax': {'plugin_group_names': []}})
+        p = RebuildPeaks({'n_channels': 3}, processor=pax)
+        hits = np.zeros(2, dtype=Hit.get_dtype())
+        hits['channel'] = [0, 1]
+        hits['area'] = 1
+        for i in range(3):
+            # Calling transform_event directly (not through process_event) must not reuse the table either
+            event = Event(n_channels=3, start_time=0, length=100, sample_duration=10)
+            event.peaks = [Peak(hits=hits.copy(), detector='tpc')]
+            event = p.transform_event(event)
+            self.assertEqual(len(event.peaks[0]._table), 1)
+            self.assertIs(event.peaks[0].get_output_class(), Peak)
+
+
+class TestTiming(unittest.TestCase):
+
+    def test_latency_histogram(self):
+        h = utils.LatencyHistogram()
+        for t in range(1, 101):
+            h.add(float(t), n_pulses=t)
+        self.assertEqual(h.n, 100)
+        self.assertEqual(h.max, 100)
+        # Buckets are 20 per decade, so percentiles are accurate to about 12%
+        self.assertAlmostEqual(h.percentile(50), 50, delta=6)
+        self.assertAlmostEqual(h.percentile(90), 90, delta=11)
+        self.assertAlmostEqual(h.percentile(99), 99, delta=1)
+        self.assertEqual(h.by_n_pulses[utils.pulse_bin(1)], [1, 1])
+        self.assertEqual(h.by_n_pulses[utils.pulse_bin(64)][0], 100 - 63)
+        h.merge(h)
+        self.assertEqual(h.n, 200)
+        self.assertAlmostEqual(h.percentile(50), 50, delta=6)
+
+    def test_pulse_bins(self):
+        self.assertEqual([utils.pulse_bin(n) for n in (0, 1, 2, 3, 4, 7, 8)], [0, 1, 2, 2, 3, 3, 4])
+        self.assertEqual(utils.pulse_bin_label(3), '4-7')
+
+    def test_timing_stats(self):
+        pax = core.Processor(just_testing=True, config_dict={'pax': {'plugin_group_names': []}})
+        pax.action_plugins = [PerEventPlugin({}, processor=pax), BatchedPlugin({}, processor=pax)]
+        pax.process_events(fake_events(5))
+        pax.process_event(fake_events(1)[0])
+        for p in pax.action_plugins:
+            self.assertEqual(p.timing.n, 6)
+        pax.make_timing_report(6)
+
+        fd, filename = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            pax.write_timing_stats(filename)
+            with open(filename) as f:
+                stats = json.load(f)
+        finally:
+            os.remove(filename)
+        self.assertEqual([p['name'] for p in stats['plugins']], ['PerEventPlugin', 'BatchedPlugin'])
+        self.assertEqual(stats['plugins'][0]['timing']['n'], 6)
+
+
+class TestCaches(unittest.TestCase):
+
+    def tearDown(self):
+        core.enable_process_caches(False)
+
+    def test_plugin_modules_reused(self):
+        config = {'pax': {'plugin_group_names': ['dsp'], 'dsp': ['CheckPulses.SortPulses']}}
+        pax1 = core.Processor(config_dict=config, just_testing=True)
+        pax2 = core.Processor(config_dict=config, just_testing=True)
+        # Only shared in prewarm mode
+        self.assertIsNot(type(pax1.action_plugins[0]), type(pax2.action_plugins[0]))
+        core.enable_process_caches()
+        pax1 = core.Processor(config_dict=config, just_testing=True)
+        pax2 = core.Processor(config_dict=config, just_testing=True)
+        self.assertIs(type(pax1.action_plugins[0]), type(pax2.action_plugins[0]))
+
+    def test_cached_resource(self):
+        self.assertIsNot(utils.cached_resource(list, [1]), utils.cached_resource(list, [1]))
+        core.enable_process_caches()
+        calls = []
+
+        def load(filename, weights=None):
+            calls.append(filename)
+            return [filename]
+
+        a = utils.cached_resource(load, 'some_file', weights=np.array([1, 2]))
+        b = utils.cached_resource(load, 'some_file', weights=np.array([1, 2]))
+        c = utils.cached_resource(load, 'some_file', weights=np.array([1, 3]))
+        self.assertIs(a, b)
+        self.assertIsNot(a, c)
+        self.assertEqual(calls, ['some_file', 'some_file'])
+
+    def test_numba_cache(self):
+        self.assertIn(pax.__version__, numba_cache.get_cache_dir())
+        # Editing any kernel module (not just the one defining a kernel) must give a new cache directory
+        self.assertTrue(numba_cache.get_cache_dir().endswith(numba_cache.kernel_sources_hash()))
+        modules = [os.path.basename(path) for path in numba_cache.kernel_modules()]
+        self.assertIn('dsputils.py', modules)
+        self.assertIn('HitFinder.py', modules)
+        if numba_cache.cache_enabled:
+            self.assertNotEqual(type(dsputils.find_intervals_above_threshold._cache).__name__, 'NullCache')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,7 @@ import os
 
 import h5py
 
-from pax import core
+from pax import core, datastructure
 import gc
 
 plugins_to_test = [
@@ -72,6 +72,38 @@ class TestReprocessing(unittest.TestCase):
             gc.collect()        # Somehow this is necessary to really close all files file...
             os.remove(output2_filename)
 
+    def test_reprocess_decoded_events(self):
+        """Clustering and peak property plugins work on events decoded from MessagePack or BSON"""
+        mypax = core.Processor(config_names='XENON100', config_dict={'pax': {
+            'events_to_process': [0],
+            'pre_output': [],
+            'encoder_plugin': None,
+            'output': 'Dummy.DummyOutput'}})
+        mypax.run()
+        event = mypax.get_plugin_by_name('DummyOutput').last_event
+        n_peaks = len(event.peaks)
+        del mypax
+
+        plugin_names = ['MessagePack.EncodeMessagePack', 'MessagePack.DecodeMessagePack',
+                        'BSON.EncodeZBSON', 'BSON.DecodeZBSON',
+                        'NaturalBreaksClustering.NaturalBreaksClustering',
+                        'BasicProperties.BasicProperties',
+                        'BasicProperties.SumWaveformProperties']
+        mypax = core.Processor(config_names='XENON100', just_testing=True, config_dict={
+            'pax': {'plugin_group_names': ['test'],
+                    'test': plugin_names},
+            'MessagePack': {'fields_to_ignore': []},
+            'BSON': {'fields_to_ignore': []}})
+        for encoder, decoder in (('EncodeMessagePack', 'DecodeMessagePack'), ('EncodeZBSON', 'DecodeZBSON')):
+            data = mypax.get_plugin_by_name(encoder).encode_event(event)
+            decoded_event = mypax.get_plugin_by_name(decoder).decode_event(data)
+            self.assertIsInstance(decoded_event, datastructure.Event)
+            self.assertTrue(decoded_event.peaks[0].hits.flags.writeable)
+            for plugin_name in plugin_names[4:]:
+                plugin = mypax.get_plugin_by_name(plugin_name.split('.')[1])
+                decoded_event = plugin.process_event(decoded_event)
+            self.assertGreaterEqual(len(decoded_event.peaks), n_peaks)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+
+import numpy as np
+
+from pax import core, datastructure, dsputils
+from pax.plugins.signal_processing.SumWaveform import covered_intervals
+
+
+class TestSumWaveform(unittest.TestCase):
+
+    def setUp(self):  # noqa
+        self.pax = core.Processor(config_names='XENON100',
+                                  just_testing=True,
+                                  config_dict={
+                                      'pax': {
+                                          'plugin_group_names': ['test'],
+                                          'test':               'SumWaveform.SumWaveform'}})
+        self.plugin = self.pax.get_plugin_by_name('SumWaveform')
+        self.config = self.pax.config['DEFAULT']
+
+    def tearDown(self):
+        delattr(self, 'pax')
+        delattr(self, 'plugin')
+
+    def make_event(self):
+        event = datastructure.Event(n_channels=self.config['n_channels'],
+                                    start_time=0,
+                                    length=100,
+                                    sample_duration=self.config['sample_duration'])
+        rs = np.random.RandomState(0)
+        # Top, bottom, veto and dead channel
+        for channel, left in ((1, 10), (100, 20), (200, 0), (0, 10), (1, 60)):
+            event.pulses.append(datastructure.Pulse(
+                channel=channel,
+                left=left,
+                right=left + 29,
+                baseline=rs.uniform(-2, 2),
+                raw_data=(self.config['digitizer_reference_baseline'] - rs.randint(0, 100, 30)).astype(np.int16)))
+        hits = np.zeros(5, dtype=datastructure.Hit.get_dtype())
+        # Overlapping hits, a rejected hit, hits in the veto and the dead channel
+        for i, (pulse_i, left, right, is_rejected) in enumerate(((0, 15, 20, False), (0, 18, 25, False),
+                                                                 (1, 22, 24, True), (2, 3, 5, False),
+                                                                 (3, 12, 13, False))):
+            hits[i]['found_in_pulse'] = pulse_i
+            hits[i]['channel'] = event.pulses[pulse_i].channel
+            hits[i]['left'] = left
+            hits[i]['right'] = right
+            hits[i]['is_rejected'] = is_rejected
+        event.all_hits = hits
+        return event
+
+    def expected_sum_waveforms(self, event):
+        result = {name: np.zeros(event.length(), dtype=np.float32)
+                  for name in ('tpc_top', 'tpc_bottom', 'veto', 'tpc_raw', 'veto_raw')}
+        for pulse_i, pulse in enumerate(event.pulses):
+            if self.config['gains'][pulse.channel] == 0:
+                continue
+            w = (self.config['digitizer_reference_baseline'] - pulse.baseline) - pulse.raw_data.astype(np.float64)
+            w *= dsputils.adc_to_pe(self.config, pulse.channel)
+            detector = 'veto' if pulse.channel > 178 else 'tpc'
+            result[detector + '_raw'][pulse.left:pulse.right + 1] += w
+
+            mask = np.zeros(len(w), dtype=np.bool_)
+            for hit in event.all_hits:
+                if hit['found_in_pulse'] == pulse_i and not hit['is_rejected']:
+                    mask[hit['left'] - pulse.left:hit['right'] - pulse.left + 1] = True
+            w[True ^ mask] = 0
+            if detector == 'tpc':
+                detector = 'tpc_top' if pulse.channel < 99 else 'tpc_bottom'
+            result[detector][pulse.left:pulse.right + 1] += w
+        result['tpc'] = result['tpc_top'] + result['tpc_bottom']
+        return result
+
+    def test_sum_waveforms(self):
+        event = self.make_event()
+        expected = self.expected_sum_waveforms(event)
+        event = self.plugin.transform_event(event)
+        self.assertEqual(sorted(event.get_sum_waveform_names()), sorted(expected.keys()))
+        for name, w in expected.items():
+            sw = event.get_sum_waveform(name)
+            # Short events get ordinary sum waveforms
+            self.assertFalse(sw.is_sparse)
+            np.testing.assert_array_equal(sw.samples, w)
+
+    def test_sparse_sum_waveforms(self):
+        self.plugin.config['sparse_above_event_duration'] = 0
+        event = self.make_event()
+        expected = self.expected_sum_waveforms(event)
+        event = self.plugin.transform_event(event)
+        self.assertEqual(sorted(event.get_sum_waveform_names()), sorted(expected.keys()))
+        for name, w in expected.items():
+            sw = event.get_sum_waveform(name)
+            np.testing.assert_array_equal(sw.get_samples(0, event.length() - 1), w)
+            # Only the samples covered by pulses in non-dead channels, 0-49 and 60-89, are stored
+            self.assertTrue(sw.is_sparse)
+            self.assertEqual(len(sw.samples), 80)
+            np.testing.assert_array_equal(sw.interval_left, [0, 60])
+            np.testing.assert_array_equal(sw.interval_offset, [0, 50])
+
+    def test_parallel_sum_waveforms(self):
+        for sparse_above in (float('inf'), 0):
+            self.plugin.config['sparse_above_event_duration'] = sparse_above
+            self.plugin.config['numba_threads'] = 1
+            event = self.plugin.transform_event(self.make_event())
+            self.plugin.config['numba_threads'] = 2
+            self.plugin.config['parallel_kernel_min_pulses'] = 0
+            parallel_event = self.plugin.transform_event(self.make_event())
+            for name in event.get_sum_waveform_names():
+                np.testing.assert_array_equal(parallel_event.get_sum_waveform(name).samples,
+                                              event.get_sum_waveform(name).samples)
+
+    def test_covered_intervals(self):
+        interval_left, interval_offset, positions, n_covered = covered_intervals(
+            np.array([20, 0, 5, 30, 40]), np.array([29, 9, 12, 35, 40]))
+        np.testing.assert_array_equal(interval_left, [0, 20, 40])
+        np.testing.assert_array_equal(interval_offset, [0, 13, 29])
+        np.testing.assert_array_equal(positions, [13, 0, 5, 23, 29])
+        self.assertEqual(n_covered, 30)
+
+
+if __name__ == '__main__':
+    unittest.main()